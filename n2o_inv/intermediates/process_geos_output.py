@@ -1,12 +1,28 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import configparser
+import hashlib
+import json
+import multiprocessing
+import os
 from pathlib import Path
 import re
 import sys
+import time
 
 import numpy as np
 import pandas as pd
 import xarray as xr
 
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+from n2o_inv.intermediates import tracers
+from n2o_inv.obs import obs_cache
+from n2o_inv.utils import instrument
+
 def monthly_mean_obspack_id(site, date):
     """
     Generate a new obspack id for the monthly mean data.
@@ -16,33 +32,76 @@ def monthly_mean_obspack_id(site, date):
     obspack_id = f"obspack_multi-species_1_CCGGSurfaceFlask_v2.0_2021-02-09~n2o_{site}_surface-flask_1_ccgg_Event~{identifier}"
     return obspack_id
 
-def obspack_geos_preprocess(ds, obspack_obs, no_regions):
+def monthly_mean_obspack_ids(sites, dates):
+    """
+    Generate the monthly mean obspack ids for every (site, date) pair at once,
+    as a (site, date) array.
+    """
+    sites = np.asarray(sites, dtype=str)[:, np.newaxis]
+    months = np.asarray(pd.to_datetime(np.asarray(dates)).strftime("%Y%m"), dtype=str)[np.newaxis, :]
+    identifier = np.char.add(sites, months)
+    prefix = np.char.add("obspack_multi-species_1_CCGGSurfaceFlask_v2.0_2021-02-09~n2o_", sites)
+    obspack_id = np.char.add(np.char.add(prefix, "_surface-flask_1_ccgg_Event~"), identifier)
+    return obspack_id.astype("<U200")
+
+def make_obspack_index(obspack_obs):
+    """
+    Build a hash index from obspack_id to the row of that observation in obspack_obs,
+    so each geoschem file can be matched without re-sorting all the observations.
+    Repeated ids map to their first row, as with np.intersect1d.
+    """
+    obspack_ids = pd.Index(obspack_obs["obspack_id"].values)
+    first_occurrence = ~obspack_ids.duplicated()
+    return pd.Series(np.flatnonzero(first_occurrence), index=obspack_ids[first_occurrence])
+
+def match_obspack_ids(geos_ids, obspack_obs, obs_index=None):
+    """
+    Match the obspack ids in a geoschem file to the observations, returning the rows of
+    the geoschem file to keep and the matching rows of obspack_obs. Only the first of any
+    repeated geoschem id is kept.
+    """
+    if obs_index is None:
+        obs_index = make_obspack_index(obspack_obs)
+
+    geos_ids = pd.Index(geos_ids)
+    obs_rows = obs_index.index.get_indexer(geos_ids)
+    geo_keep = (obs_rows >= 0) & ~geos_ids.duplicated()
+    # need to make ds obs have the same values as the observations obs
+    intersection_indices_obs = np.sort(obs_index.values[obs_rows[geo_keep]])
+    intersection_indices_geo = np.flatnonzero(geo_keep)
+
+    # check the kept geoschem ids line up with the observations
+    if not (obspack_obs.obspack_id[intersection_indices_obs].values == geos_ids[intersection_indices_geo]).all():
+        raise ValueError("obspack obs and geoschem values don't align")
+
+    return intersection_indices_geo, intersection_indices_obs
+
+def obspack_geos_preprocess(ds, obspack_obs, no_regions, obs_index=None, stacked=False):
     """
     Preprocess geoschem output for reading into xarray: make coord monotonically increase,
-    drop unwanted vars, and turn mf to ppb.
+    drop unwanted vars, and turn mf to ppb. With stacked, the tracers are a single CH4_R
+    variable with a region dimension (see tracers.stack_tracers).
     """ 
     # match to obspack based on id
-    intersection = np.intersect1d(ds.obspack_id, obspack_obs.obspack_id, return_indices=True)
-    # need to make ds obs have the same values as the observations obs
-    intersection_indices_obs = np.sort(intersection[2])
-    intersection_indices_geo = np.sort(intersection[1])
+    intersection_indices_geo, intersection_indices_obs = match_obspack_ids(ds.obspack_id.values,
+                                                                           obspack_obs, obs_index)
 
     # only process if file contains desired obs, otherwise this function returns None
-    if len(intersection[2]) > 0:
+    if len(intersection_indices_obs) > 0:
         # geoschem file might contain unwanted ob, remove these
-        if len(obspack_obs.obspack_id[intersection_indices_obs]) < len(ds.obspack_id.values):
+        if len(intersection_indices_obs) < len(ds.obspack_id.values):
             ds = ds.isel(obs=intersection_indices_geo, drop=True)
             
         # take the obspack dimensions
-        if (obspack_obs.obspack_id[intersection_indices_obs].values == ds.obspack_id.values).all():
-            ds = ds.assign_coords(obs=obspack_obs.obs[intersection_indices_obs].values)
-        else:
-            raise ValueError("obspack obs and geoschem values don't align")
+        ds = ds.assign_coords(obs=obspack_obs.obs[intersection_indices_obs].values)
         
         wanted_var = [f"CH4_R{region:02d}" for region in range(0, no_regions+1)]
         ds = ds[wanted_var]
         
         ds = ds * 1e9
+
+        if stacked:
+            ds = xr.Dataset({"CH4_R": tracers.stack_tracers(ds, "CH4_R", no_regions+1)})
         
         return ds
 
@@ -62,9 +121,26 @@ def read_obs(obspack_dir, spinup_start, perturb_end, final_end):
         obspack_obs = load.load()
     return obspack_obs
 
-def read_geos(output_dir, obspack_obs, no_regions, first_year, last_year):
+def ordered_bounded_map(executor, func, items, max_in_flight):
     """
-    Read in obspack geoschem files as xarray dataset.
+    Submit func for each item to an executor, yielding the results in the same order as
+    items. At most max_in_flight items are being worked on or waiting to be collected
+    at any time, which caps the memory held by partly processed items.
+    """
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be at least 1")
+
+    in_flight = deque()
+    for item in items:
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+        in_flight.append(executor.submit(func, item))
+    while in_flight:
+        yield in_flight.popleft().result()
+
+def list_geos_files(output_dir, first_year, last_year):
+    """
+    Find the daily obspack geoschem files to read in, in date order.
     """
     geos_files = []
     for y in range(first_year, last_year+1):
@@ -78,43 +154,386 @@ def read_geos(output_dir, obspack_obs, no_regions, first_year, last_year):
     # check stopping in right place
     print(geos_files[-1])
 
-    xr_list = []
-    for ds in geos_files:
-        with  xr.open_dataset(ds) as load:
-            ds_pp = obspack_geos_preprocess(load.load(), obspack_obs, no_regions)
-        xr_list.append(ds_pp)
+    return geos_files
+
+def read_netcdf4_obspack_ids(nc_var):
+    """
+    Read the obspack ids from a netCDF4 variable, turning a char array into one fixed
+    width byte string per obs as xarray does. Every id is needed to match the obs, so
+    all the rows are read, but without working out a mask that would be thrown away.
+    """
+    nc_var.set_auto_mask(False)
+    obspack_ids = nc_var[:]
+    if obspack_ids.dtype.kind == "S" and obspack_ids.ndim == 2:
+        width = obspack_ids.shape[1]
+        obspack_ids = np.ascontiguousarray(obspack_ids).view(f"S{width}")[:, 0]
+    return obspack_ids
+
+def netcdf4_tracer_dtype(nc_var):
+    """
+    The dtype of a tracer netCDF4 variable once it is in ppb, as xarray gives it: ints are
+    turned into floats, either by their missing values or by the scaling.
+    """
+    if nc_var.dtype.kind == "f":
+        return nc_var.dtype
+    return np.dtype("float64")
+
+def read_netcdf4_tracer(nc_var, rows, out):
+    """
+    Read the wanted rows (sorted, as match_obspack_ids gives them) of a tracer netCDF4
+    variable into out, with missing values as nan. Only the span from the first to the
+    last wanted row is read from the file.
+    """
+    start, stop = rows[0], rows[-1] + 1
+    values = nc_var[start:stop]
+    if np.ma.isMaskedArray(values):
+        values = values.astype(out.dtype).filled(np.nan)
+    out[:] = values[rows - start]
+
+def read_geos_file_netcdf4(geos_file, obspack_obs, no_regions, obs_index=None, stacked=False):
+    """
+    Read in and preprocess a single obspack geoschem file with netCDF4 directly, giving
+    the same result as obspack_geos_preprocess. Only obspack_id and the wanted tracers are
+    read, into one (region, obs) buffer sized for the obs that are kept, skipping the
+    decoding of all the other geoschem diagnostics. With stacked, that buffer is returned
+    as a single CH4_R variable, otherwise each tracer is a view of its row.
+    """
+    wanted_var = tracers.tracer_names("CH4_R", no_regions+1)
+    with netCDF4.Dataset(geos_file) as nc:
+        geos_ids = read_netcdf4_obspack_ids(nc["obspack_id"])
+        intersection_indices_geo, intersection_indices_obs = match_obspack_ids(geos_ids, obspack_obs,
+                                                                               obs_index)
+
+        # only process if file contains desired obs, otherwise this function returns None
+        if len(intersection_indices_obs) == 0:
+            return None
+
+        dtypes = [netcdf4_tracer_dtype(nc[var]) for var in wanted_var]
+        buffer = np.empty((len(wanted_var), len(intersection_indices_geo)), dtype=np.result_type(*dtypes))
+        for region, var in enumerate(wanted_var):
+            read_netcdf4_tracer(nc[var], intersection_indices_geo, buffer[region])
+
+    # turn mf to ppb
+    buffer *= 1e9
+
+    obs = obspack_obs.obs[intersection_indices_obs].values
+    if stacked:
+        return xr.Dataset({"CH4_R": (("region", "obs"), buffer)},
+                          coords={"region": np.arange(len(wanted_var)), "obs": obs})
+    # the rows only need copying if the tracers have different dtypes
+    return xr.Dataset({var: (("obs"), buffer[region].astype(dtype, copy=False))
+                       for region, (var, dtype) in enumerate(zip(wanted_var, dtypes))},
+                      coords={"obs": obs})
+
+def read_geos_file(geos_file, obspack_obs, no_regions, obs_index=None, low_level=None, stacked=False):
+    """
+    Read in and preprocess a single obspack geoschem file. By default (low_level=None)
+    this uses read_geos_file_netcdf4 if netCDF4 is installed, otherwise it loads the whole
+    file with xarray. stacked is passed on to the reader.
+    """
+    if low_level is None:
+        low_level = netCDF4 is not None
+    if low_level:
+        return read_geos_file_netcdf4(geos_file, obspack_obs, no_regions, obs_index, stacked)
+
+    with xr.open_dataset(geos_file) as load:
+        ds_pp = obspack_geos_preprocess(load.load(), obspack_obs, no_regions, obs_index, stacked)
+    return ds_pp
+
+# observations shared with the read_geos worker processes
+_read_geos_worker_state = {}
+
+def _init_read_geos_worker(obspack_obs, no_regions, obs_index, low_level, stacked):
+    _read_geos_worker_state.update(obspack_obs=obspack_obs, no_regions=no_regions, obs_index=obs_index,
+                                   low_level=low_level, stacked=stacked)
+
+def _read_geos_file_worker(geos_file):
+    return read_geos_file(geos_file, **_read_geos_worker_state)
+
+def read_geos(output_dir, obspack_obs, no_regions, first_year, last_year, n_workers=1, max_in_flight=None,
+              obs_index=None, low_level=None, stacked=False):
+    """
+    Read in obspack geoschem files as xarray dataset.
+
+    With n_workers > 1 the daily files are read and preprocessed in a pool of worker
+    processes (netCDF is not thread safe), with no more than max_in_flight files
+    (default 2 * n_workers) in progress at once. The files are always combined in
+    date order. obs_index can be passed in to share one make_obspack_index between
+    several runs using the same observations. low_level and stacked are passed on to
+    read_geos_file, with stacked the tracers are one (region, obs) CH4_R variable.
+    """
+    geos_files = list_geos_files(output_dir, first_year, last_year)
+    xr_list = read_geos_files(geos_files, obspack_obs, no_regions, n_workers, max_in_flight, obs_index,
+                              low_level, stacked)
     
     obspack_geos = xr.concat(filter(None, xr_list), dim="obs")
     
     return obspack_geos
 
-def read_geos_constant(output_dir, obspack_obs, no_regions, first_year, last_year):
+def read_geos_files(geos_files, obspack_obs, no_regions, n_workers=1, max_in_flight=None, obs_index=None,
+                    low_level=None, stacked=False):
+    """
+    Read in and preprocess a list of obspack geoschem files, returning a list with the
+    preprocessed dataset (or None if it has no wanted obs) for each file in order.
+    """
+    # build the obspack_id lookup once rather than once per file
+    if obs_index is None:
+        obs_index = make_obspack_index(obspack_obs)
+
+    if n_workers > 1:
+        if max_in_flight is None:
+            max_in_flight = 2 * n_workers
+        # forked workers share the observations rather than each getting a pickled copy
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_read_geos_worker,
+                                 initargs=(obspack_obs, no_regions, obs_index, low_level, stacked)) as executor:
+            xr_list = list(ordered_bounded_map(executor, _read_geos_file_worker, geos_files, max_in_flight))
+    else:
+        xr_list = [read_geos_file(geos_file, obspack_obs, no_regions, obs_index, low_level, stacked)
+                   for geos_file in geos_files]
+
+    return xr_list
+
+def file_fingerprint(geos_file, previous=None):
+    """
+    Record the size, modification time and sha256 hash of a file. The hash is reused
+    from a previous fingerprint if the size and modification time haven't changed.
+    """
+    stat = geos_file.stat()
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous is not None and all(previous.get(key) == fingerprint[key] for key in ("size", "mtime_ns")):
+        fingerprint["sha256"] = previous["sha256"]
+    else:
+        sha256 = hashlib.sha256()
+        with open(geos_file, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                sha256.update(block)
+        fingerprint["sha256"] = sha256.hexdigest()
+    return fingerprint
+
+def obs_fingerprint(obspack_obs, no_regions):
+    """
+    Hash the observations that geoschem files are matched to, so cached matches can be
+    thrown away if the observations change.
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(str(no_regions).encode())
+    sha256.update(np.asarray(obspack_obs["obspack_id"].values, dtype=bytes).tobytes())
+    sha256.update(np.ascontiguousarray(obspack_obs["obs"].values).tobytes())
+    return sha256.hexdigest()
+
+def read_manifest(manifest_file):
+    """
+    Read in a read_geos_incremental manifest, or an empty one if it doesn't exist yet.
+    """
+    if manifest_file.is_file():
+        with open(manifest_file) as f:
+            return json.load(f)
+    return {"obs_fingerprint": None, "files": {}}
+
+def write_manifest(manifest, manifest_file):
+    """
+    Save a read_geos_incremental manifest, replacing any old one in a single step so a
+    killed job can't leave it half written.
+    """
+    tmp_file = manifest_file.with_name(manifest_file.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+def read_geos_incremental(output_dir, obspack_obs, no_regions, first_year, last_year, cache_dir=None,
+                          n_workers=1, max_in_flight=None, obs_index=None, record=None):
+    """
+    Read in obspack geoschem files as xarray dataset, only reading files that are new or
+    have changed since the last call.
+
+    The preprocessed output of each call is appended to cache_dir (default output_dir/read_geos_cache)
+    as a new chunk file, and manifest.json records the size, modification time and hash of
+    every file read, along with where its preprocessed obs are in the chunks. Files that
+    have gone are dropped from the manifest. Gives the same result as read_geos.
+
+    If record is given (e.g. an instrument.stage record), the number of geoschem files
+    read and the number reused from the cache are added to it.
+    """
+    if cache_dir is None:
+        cache_dir = output_dir / "read_geos_cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file = cache_dir / "manifest.json"
+
+    geos_files = list_geos_files(output_dir, first_year, last_year)
+
+    # cached matches are only valid for the same observations
+    manifest = read_manifest(manifest_file)
+    fingerprint = obs_fingerprint(obspack_obs, no_regions)
+    if manifest["obs_fingerprint"] != fingerprint:
+        manifest = {"obs_fingerprint": fingerprint, "files": {}}
+
+    # work out which files need reading
+    new_files = []
+    for geos_file in geos_files:
+        entry = manifest["files"].get(geos_file.name)
+        fingerprint = file_fingerprint(geos_file, entry)
+        if entry is None or entry["sha256"] != fingerprint["sha256"]:
+            new_files.append((geos_file, fingerprint))
+        else:
+            entry.update(fingerprint)
+    if record is not None:
+        record["files_read"] = record.get("files_read", 0) + len(new_files)
+        record["files_reused"] = record.get("files_reused", 0) + len(geos_files) - len(new_files)
+
+    # forget files that have gone, so their chunks can be removed
+    wanted_names = {geos_file.name for geos_file in geos_files}
+    manifest["files"] = {name: entry for name, entry in manifest["files"].items() if name in wanted_names}
+
+    if new_files:
+        new_geos = read_geos_files([geos_file for geos_file, _ in new_files], obspack_obs, no_regions,
+                                   n_workers, max_in_flight, obs_index)
+
+        # save the new files' obs as one chunk, recording where each file's obs are
+        chunk_name = f"chunk_{time.time_ns()}.nc"
+        start = 0
+        for (geos_file, fingerprint), ds_pp in zip(new_files, new_geos):
+            if ds_pp is None:
+                fingerprint.update(chunk=None, start=0, stop=0)
+            else:
+                stop = start + len(ds_pp["obs"])
+                fingerprint.update(chunk=chunk_name, start=start, stop=stop)
+                start = stop
+            manifest["files"][geos_file.name] = fingerprint
+        if start > 0:
+            tmp_chunk = cache_dir / (chunk_name + ".tmp")
+            xr.concat(filter(None, new_geos), dim="obs").to_netcdf(tmp_chunk)
+            os.replace(tmp_chunk, cache_dir / chunk_name)
+
+    # remove chunks no file refers to any more
+    used_chunks = {entry["chunk"] for entry in manifest["files"].values()}
+    for chunk_file in cache_dir.glob("chunk_*.nc"):
+        if chunk_file.name not in used_chunks:
+            chunk_file.unlink()
+    write_manifest(manifest, manifest_file)
+
+    # put together the cached obs in file order
+    chunks = {}
+    xr_list = []
+    for geos_file in geos_files:
+        entry = manifest["files"][geos_file.name]
+        if entry["chunk"] is None:
+            continue
+        if entry["chunk"] not in chunks:
+            with xr.open_dataset(cache_dir / entry["chunk"]) as load:
+                chunks[entry["chunk"]] = load.load()
+        xr_list.append(chunks[entry["chunk"]].isel(obs=slice(entry["start"], entry["stop"])))
+
+    obspack_geos = xr.concat(xr_list, dim="obs")
+
+    return obspack_geos
+
+def read_geos_constant(output_dir, obspack_obs, no_regions, first_year, last_year, n_workers=1, max_in_flight=None,
+                       incremental=False, record=None):
     """
     Read in obspack geoschem files as xarray dataset for constant met run.
     """
     obspack_geos_list = []
     for output_dir_ext in sorted((output_dir).glob("su_??")):
         print(output_dir_ext)
-        obspack_geos = read_geos(output_dir_ext, obspack_obs, no_regions, first_year, last_year)
+        if incremental:
+            obspack_geos = read_geos_incremental(output_dir_ext, obspack_obs, no_regions, first_year, last_year,
+                                                 n_workers=n_workers, max_in_flight=max_in_flight, record=record)
+        else:
+            obspack_geos = read_geos(output_dir_ext, obspack_obs, no_regions, first_year, last_year,
+                                     n_workers, max_in_flight)
         obspack_geos_list.append(obspack_geos)
 
     complete_obspack_geos = xr.merge(obspack_geos_list)
     return complete_obspack_geos
 
+def parse_obspack_sites(obspack_ids, chunk_size=65536):
+    """
+    Find the three letter site in each obspack id (e.g. mhd in "...~n2o_mhd_surface...")
+    by slicing the bytes of the ids, returning a (n_obs, 3) uint8 array. The site
+    follows the first "~"; ids that aren't laid out like that fall back to a regex.
+    """
+    obspack_ids = np.asarray(obspack_ids)
+    if obspack_ids.dtype.kind != "S":
+        obspack_ids = obspack_ids.astype(bytes)
+    width = obspack_ids.dtype.itemsize
+    chars = np.ascontiguousarray(obspack_ids).view(np.uint8).reshape(len(obspack_ids), width)
+    marker = np.frombuffer(b"~n2o_", dtype=np.uint8)
+
+    site_chars = np.zeros((len(obspack_ids), 3), dtype=np.uint8)
+    # in chunks, so the byte comparisons don't take much memory
+    for start in range(0, len(obspack_ids), chunk_size):
+        chunk = chars[start:start + chunk_size]
+        rows = np.arange(len(chunk))
+        first = np.argmax(chunk == marker[0], axis=1)
+        # the marker, three characters, then "_", all inside the id
+        positions = first[:, None] + np.arange(9)
+        laid_out = positions[:, -1] < width
+        laid_out[laid_out] = ((chunk[rows[laid_out, None], positions[laid_out, :5]] == marker).all(axis=1) &
+                              (chunk[rows[laid_out], positions[laid_out, 8]] == ord("_")))
+        site_chars[start:start + chunk_size][laid_out] = chunk[rows[laid_out, None], positions[laid_out, 5:8]]
+
+        for row in np.flatnonzero(~laid_out):
+            match = re.search(b"~n2o_(.{3})_", obspack_ids[start + row])
+            if match is None:
+                raise ValueError(f"can't find the site in obspack id {obspack_ids[start + row]}")
+            site_chars[start + row] = np.frombuffer(match.group(1), dtype=np.uint8)
+
+    return site_chars
+
+def site_codes(combined):
+    """
+    Give each observation an integer site code, for the combination of the site in its
+    obspack_id and its network. Returns the codes and the table of site names they index
+    (e.g. "mhdNOAAsurf"), which is in alphabetical order.
+    """
+    site_chars = parse_obspack_sites(combined["obspack_id"].values).astype(np.int64)
+    site_key = (site_chars[:, 0] << 16) | (site_chars[:, 1] << 8) | site_chars[:, 2]
+    networks, network_codes = np.unique(combined["network"].values, return_inverse=True)
+
+    keys, codes = np.unique(site_key * len(networks) + network_codes, return_inverse=True)
+    site_names = [bytes([key >> 16, (key >> 8) & 255, key & 255]).decode("utf-8")
+                  for key in keys // len(networks)]
+    table = np.array([site + str(networks[network])
+                      for site, network in zip(site_names, keys % len(networks))], dtype=str)
+    return codes, table
+
+def remap_site_codes(codes, table, site_map):
+    """
+    Rename sites (e.g. merge AGAGE and NOAA sites) by remapping the site codes, returning
+    the new codes and table. Sites not in site_map keep their names.
+    """
+    new_table, remap = np.unique([site_map.get(site, site) for site in table], return_inverse=True)
+    return remap[codes], new_table
+
+def site_table_codes(sites):
+    """
+    Give each of an array of site names an integer code, returning the codes and the
+    table of site names they index, in alphabetical order as site_codes.
+    """
+    table, codes = np.unique(np.asarray(sites).astype(str), return_inverse=True)
+    return codes, table
+
 def find_unique_sites(combined):
     """
     Extract the site for each observation, and find the unique ones.
     """
-    list_of_sites = []
+    codes, unique_sites = site_codes(combined)
+    list_of_sites = unique_sites[codes].tolist()
 
-    for i, elem in enumerate(combined["obspack_id"].values):
-        site = re.search("~n2o_(.{3})_", elem.decode("utf-8")).group(1)
-        network = combined["network"].values[i]
-        list_of_sites.append(site+network)
+    return list_of_sites, unique_sites
 
-    unique_sites = np.unique(list_of_sites)
+def combine_measurement_unc(unc_std, unc_med):
+    """
+    Combine the monthly variability and typical measurement error into a single
+    measurement uncertainty. Works on DataArrays of any shape.
+    """
+    # if only one point, std is nan...
+    unc_comb = unc_std.where(~np.isnan(unc_std), unc_med)
+    # or if small number of obs etc, can easily get small std, so use typical value if that uncertainty is greater
+    unc_comb = unc_comb.where(unc_std > unc_med, unc_med)
 
-    return list_of_sites, unique_sites
+    return unc_comb
 
 def monthly_measurement_unc(onesite):
     """
@@ -123,69 +542,201 @@ def monthly_measurement_unc(onesite):
     # get variation in measurements over month and typical measurement error
     onesite_resampled_unc_std = onesite["obs_value"].resample(obs_time="M").std()
     onesite_resampled_unc_med = onesite["obs_value_unc"].resample(obs_time="M").median()
-    # if only one point, std is nan...
-    onesite_resampled_unc_comb = onesite_resampled_unc_std.where(~np.isnan(onesite_resampled_unc_std), 
-                                                                 onesite_resampled_unc_med)
-    # or if small number of obs etc, can easily get small std, so use typical value if that uncertainty is greater
-    onesite_resampled_unc_comb = onesite_resampled_unc_comb.where(onesite_resampled_unc_std > onesite_resampled_unc_med, 
-                                                                  onesite_resampled_unc_med)
 
-    return onesite_resampled_unc_comb
+    return combine_measurement_unc(onesite_resampled_unc_std, onesite_resampled_unc_med)
 
+def site_month_groups(site, obs_time):
+    """
+    Sort observations by (site, month) so every site-month is a contiguous group. The
+    sites are integer site codes.
 
-if __name__ == "__main__":
-    # read in variables from the config file
-    config = configparser.ConfigParser()
-    config.read('../../config.ini')
-    NO_REGIONS = int(config["inversion_constants"]["no_regions"])
-    CASE = config["inversion_constants"]["case"]
-    CONSTANT_CASE = config["inversion_constants"]["constant_case"]
-    AGAGE_SITES = config["inversion_constants"]["agage_sites"].split(",")
-    OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
-    GEOSOUT_DIR = Path(config["paths"]["geos_out"])
-    SPINUP_START = pd.to_datetime(config["dates"]["spinup_start"])
-    FINAL_END = pd.to_datetime(config["dates"]["final_end"])
-    CONSTANT_END = pd.to_datetime(config["dates"]["constant_end"])
+    Returns the order that sorts the observations, the start of each group in that order,
+    the site index and month of each group, and the sorted site codes the index refers to.
+    """
+    unique_sites, site_index = np.unique(site, return_inverse=True)
+    month = np.asarray(obs_time).astype("datetime64[M]")
+    first_month = month.min()
+    month_index = (month - first_month).astype(int)
+    n_months = month_index.max() + 1
 
-    # commandline arguments
-    iterator = int(sys.argv[1])   # index of output folder to process
-    first_year = int(sys.argv[2]) # first year to process geoschem output for
-    last_year = int(sys.argv[3])  # last year to process geoschem output for
-    output_file = sys.argv[4]     # name of output mole fraction file to save
+    group_key = site_index.astype(np.int64) * n_months + month_index
+    order = np.argsort(group_key, kind="stable")
+    sorted_key = group_key[order]
+    starts = np.flatnonzero(np.r_[True, sorted_key[1:] != sorted_key[:-1]])
 
-    # read in geoschem output in each directory
-    geoschem_out_dirs = list(sorted(GEOSOUT_DIR.iterdir()))
-    print(iterator)
-    output_dir = geoschem_out_dirs[iterator]
-    print(output_dir)
+    group_site = sorted_key[starts] // n_months
+    group_month = first_month + (sorted_key[starts] % n_months)
 
-    # read in observations
-    print("Reading in obs...")
-    obs_file = OBSPACK_DIR / "baseline_obs.nc"
+    return order, starts, group_site, group_month, unique_sites
+
+def grouped_nanmean(values, order, starts):
+    """
+    Mean of each group, ignoring nans, for values sorted into contiguous groups.
+    """
+    sorted_values = values[order].astype(np.float64)
+    valid = ~np.isnan(sorted_values)
+    sums = np.add.reduceat(np.where(valid, sorted_values, 0), starts)
+    counts = np.add.reduceat(valid, starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+def grouped_nanstd(values, order, starts):
+    """
+    Population standard deviation of each group, ignoring nans.
+    """
+    sorted_values = values[order].astype(np.float64)
+    valid = ~np.isnan(sorted_values)
+    counts = np.add.reduceat(valid, starts)
+    group_mean = grouped_nanmean(values, order, starts)
+    # broadcast each group mean back to its members
+    group_sizes = np.diff(np.r_[starts, len(sorted_values)])
+    deviation = sorted_values - np.repeat(group_mean, group_sizes)
+    sum_sq = np.add.reduceat(np.where(valid, deviation**2, 0), starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.sqrt(sum_sq / counts)
+
+def grouped_nanmedian(values, order, starts):
+    """
+    Median of each group, ignoring nans.
+    """
+    sorted_values = values[order].astype(np.float64)
+    group_sizes = np.diff(np.r_[starts, len(sorted_values)])
+    group_id = np.repeat(np.arange(len(starts)), group_sizes)
+    # sort by value within each group, nans go to the end of their group
+    within = np.lexsort((sorted_values, group_id))
+    sorted_values = sorted_values[within]
+    counts = np.add.reduceat(~np.isnan(sorted_values), starts)
+
+    medians = np.full(len(starts), np.nan)
+    has_values = counts > 0
+    lower = starts[has_values] + (counts[has_values] - 1) // 2
+    upper = starts[has_values] + counts[has_values] // 2
+    medians[has_values] = (sorted_values[lower] + sorted_values[upper]) / 2
+    return medians
+
+def site_month_grid(group_site, group_month, unique_sites):
+    """
+    Work out the monthly time axis matching resampling each site separately and
+    concatenating: every month from each site's first to last month.
+    """
+    months = []
+    for i in range(len(unique_sites)):
+        site_months = group_month[group_site == i]
+        months.append(np.arange(site_months.min(), site_months.max() + 1))
+    months = np.unique(np.concatenate(months))
+    # resample labels months by their last day
+    month_ends = (months + 1).astype("datetime64[D]") - np.timedelta64(1, "D")
+    return months, month_ends.astype("datetime64[ns]")
+
+def _grouped_to_grid(group_values, group_site, group_month, months, n_sites, dtype):
+    """
+    Put one value per (site, month) group onto a (site, obs_time) grid, nan elsewhere.
+    """
+    grid = np.full((n_sites, len(months)), np.nan, dtype=dtype)
+    grid[group_site, np.searchsorted(months, group_month)] = group_values
+    return grid
+
+def site_monthly_measurement_unc(combined):
+    """
+    Calculate the monthly measurement error for every site at once, as a
+    (site, obs_time) DataArray.
+    """
+    order, starts, group_site, group_month, unique_codes = site_month_groups(combined["site_code"].values,
+                                                                             combined["obs_time"].values)
+    unique_sites = combined["site_table"].values[unique_codes]
+    months, month_ends = site_month_grid(group_site, group_month, unique_sites)
+    return _site_monthly_measurement_unc(combined, order, starts, group_site, group_month,
+                                         months, month_ends, unique_sites)
+
+def _site_monthly_measurement_unc(combined, order, starts, group_site, group_month, months, month_ends, unique_sites):
+    coords = {"site": unique_sites, "obs_time": month_ends}
+    unc_std = grouped_nanstd(combined["obs_value"].values, order, starts)
+    unc_med = grouped_nanmedian(combined["obs_value_unc"].values, order, starts)
+    unc_std = xr.DataArray(_grouped_to_grid(unc_std, group_site, group_month, months, len(unique_sites), np.float64),
+                           dims=("site", "obs_time"), coords=coords)
+    unc_med = xr.DataArray(_grouped_to_grid(unc_med, group_site, group_month, months, len(unique_sites), np.float64),
+                           dims=("site", "obs_time"), coords=coords)
+    return combine_measurement_unc(unc_std, unc_med)
+
+def site_monthly_mean(combined):
+    """
+    Make the monthly mean of every numeric variable at every site in one pass, with the
+    measurement uncertainty from the monthly variability. Gives the same result as
+    resampling each site to monthly means and concatenating along a site dimension. The
+    sites are the site_code and site_table of combine_obs_geos.
+    """
+    order, starts, group_site, group_month, unique_codes = site_month_groups(combined["site_code"].values,
+                                                                             combined["obs_time"].values)
+    unique_sites = combined["site_table"].values[unique_codes]
+    months, month_ends = site_month_grid(group_site, group_month, unique_sites)
+
+    site_combined = xr.Dataset(coords={"obs_time": month_ends})
+    for var in combined.data_vars:
+        values = combined[var].values
+        if var == "site_code" or not (np.issubdtype(values.dtype, np.number) or values.dtype == bool):
+            continue
+        dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64
+        group_mean = grouped_nanmean(values, order, starts)
+        site_combined[var] = (("site", "obs_time"), _grouped_to_grid(group_mean, group_site, group_month,
+                                                                    months, len(unique_sites), dtype))
+
+    site_combined["site"] = (("site"), unique_sites)
+    # calculate measurement uncertainty
+    site_combined["obs_value_unc"] = _site_monthly_measurement_unc(combined, order, starts, group_site, group_month,
+                                                                   months, month_ends, unique_sites)
+
+    return site_combined
+
+
+def read_baseline_obs(obs_file, first_year, last_year):
+    """
+    Read in the baseline observations, keeping those needed for the years being processed.
+    If the observations have been cached by obs_cache.py they are memory mapped, and
+    only the wanted years are copied.
+    """
     if obs_file.is_file():
-        with xr.open_dataset(obs_file) as load:
-            obspack_obs = load.load()
+        obspack_obs = obs_cache.open_obs(obs_file)
     else:
         raise IOError("Need to create a baseline obsfile!")
 
     # cut unwanted years
+    wanted = ((obspack_obs["time"] >= pd.to_datetime(f"{first_year - 1}-12-31 23:55")) &
+              (obspack_obs["time"] < pd.to_datetime(f"{last_year}-12-31 23:55")))
+    obspack_obs = obspack_obs.isel(obs=np.flatnonzero(wanted.values))
+    # where as well, for the same dtypes as before
     obspack_obs = obspack_obs.where(obspack_obs["time"] >= pd.to_datetime(f"{first_year - 1}-12-31 23:55"), drop=True)
     obspack_obs = obspack_obs.where(obspack_obs["time"] < pd.to_datetime(f"{last_year}-12-31 23:55"), drop=True)
 
-    print("Reading in geos...")
-    # no point including obs before constant met period
-    if str(output_dir)[-12:] == CONSTANT_CASE:
-        obspack_obs = obspack_obs.where(obspack_obs["time"] > CONSTANT_END, drop=True)
-        obspack_geos = read_geos_constant(output_dir, obspack_obs, NO_REGIONS, first_year, last_year)
-    else:
-        obspack_geos = read_geos(output_dir, obspack_obs, NO_REGIONS, first_year, last_year)
+    return obspack_obs
 
-    # combine the two datasets
-    print("Combining datasets...")
-    combined = xr.merge([obspack_obs[["latitude", "longitude", "altitude",
-                                        "time", "obspack_id", "value", 
-                                        "value_unc", "network", "site", "baseline"]],
-                            obspack_geos])
+def read_agage_over_noaa_ratio(obspack_dir):
+    """
+    Read in the ratio used to put the AGAGE observations on the NOAA scale.
+    """
+    return pd.read_csv(obspack_dir / "agage_noaa_scaling/agage_over_noaa_ratio.csv", index_col=0).iloc[0].values[0]
+
+def agage_site_map(agage_sites):
+    """
+    Map the NOAA and AGAGE names of the sites where we have AGAGE data to a single combined site.
+    """
+    site_map = {}
+    for site in agage_sites:
+        site_map[f"{site.lower()}AGAGEsurf"] = f"{site.lower()}NOAGsurf"
+        site_map[f"{site.lower()}NOAAsurf"] = f"{site.lower()}NOAGsurf"
+    return site_map
+
+def combine_obs_geos(obspack_obs, obspack_geos, first_year, agage_over_noaa_ratio, site_map):
+    """
+    Combine the observations with the geoschem output, keeping baseline observations on
+    an obs_time dimension, with AGAGE rescaled to NOAA and AGAGE/NOAA sites merged. The
+    site of each observation is an integer site_code into the site_table coordinate.
+    """
+    # combine NOAA sites and AGAGE sites where we have AGAGE data, on the site codes
+    codes, table = remap_site_codes(*site_table_codes(obspack_obs["site"].values), site_map)
+    obs = obspack_obs[["latitude", "longitude", "altitude",
+                       "time", "obspack_id", "value",
+                       "value_unc", "network", "baseline"]].assign(site_code=(("obs"), codes))
+    combined = xr.merge([obs, obspack_geos])
     combined = combined.rename({"latitude":"obs_lat", "longitude":"obs_lon",
                                 "altitude":"obs_alt", "time":"obs_time", 
                                 "value":"obs_value", "value_unc":"obs_value_unc"})
@@ -203,43 +754,57 @@ if __name__ == "__main__":
 
     # rescale AGAGE to NOAA
     agage_mask = combined["network"] == "AGAGEsurf"
-    agage_over_noaa_ratio = pd.read_csv(OBSPACK_DIR / "agage_noaa_scaling/agage_over_noaa_ratio.csv", index_col=0).iloc[0].values[0]
     combined["obs_value"][agage_mask] = combined["obs_value"][agage_mask] / agage_over_noaa_ratio
 
-    # combine NOAA sites and AGAGE sites where we have AGAGE data
-    for site in AGAGE_SITES:
-        combined["site"].loc[combined["site"] == f"{site.lower()}AGAGEsurf"] = f"{site.lower()}NOAGsurf"
-        combined["site"].loc[combined["site"] == f"{site.lower()}NOAAsurf"] = f"{site.lower()}NOAGsurf"
-    unique_sites = np.unique(combined["site"]) # other function uses obspackid so wont work
+    # where makes the codes floats
+    combined["site_code"] = combined["site_code"].astype(codes.dtype)
+    return combined.assign_coords(site_table=table)
+
+def make_site_combined(output_dir, obspack_obs, no_regions, first_year, last_year,
+                       agage_over_noaa_ratio, site_map, case, constant_case, constant_end,
+                       n_workers=1, obs_index=None, incremental=False):
+    """
+    Make the monthly mean mole fraction at each site for one geoschem output directory.
+    obs_index is only used for non constant met runs, which use every observation. With
+    incremental, only geoschem files that are new since the last run are read.
+    """
+    print("Reading in geos...")
+    with instrument.stage("read_geos", output_dir=output_dir.name) as record:
+        # no point including obs before constant met period
+        if str(output_dir)[-12:] == constant_case:
+            obspack_obs = obspack_obs.where(obspack_obs["time"] > constant_end, drop=True)
+            obspack_geos = read_geos_constant(output_dir, obspack_obs, no_regions, first_year, last_year, n_workers,
+                                              incremental=incremental, record=record)
+        elif incremental:
+            obspack_geos = read_geos_incremental(output_dir, obspack_obs, no_regions, first_year, last_year,
+                                                 n_workers=n_workers, obs_index=obs_index, record=record)
+        else:
+            obspack_geos = read_geos(output_dir, obspack_obs, no_regions, first_year, last_year, n_workers,
+                                     obs_index=obs_index)
+        if incremental:
+            print(f"Read {record.get('files_read', 0)} new or changed geoschem files, "
+                  f"reused {record.get('files_reused', 0)} from the cache")
+        record["n_obs"] = len(obspack_geos["obs"])
+
+    # combine the two datasets
+    print("Combining datasets...")
+    with instrument.stage("combine_obs_geos", output_dir=output_dir.name):
+        combined = combine_obs_geos(obspack_obs, obspack_geos, first_year, agage_over_noaa_ratio, site_map)
 
     # create monthly mean for each site
     print("Making monthly mean...")
-    resampled_sites = []
-    for site in unique_sites:
-        onesite = combined.where(combined["site"] == site, drop=True)
-        onesite_resampled = onesite.resample(obs_time="M").mean()
-        # calculate measurement uncertainty
-        onesite_resampled["obs_value_unc"] = monthly_measurement_unc(onesite)
-        resampled_sites.append(onesite_resampled)
-
-    # recombine sites
-    print("Recombining sites...")
-    site_combined = xr.concat(resampled_sites, dim="site")
-    site_combined["site"] = (("site"), unique_sites)
+    with instrument.stage("site_monthly_mean", output_dir=output_dir.name):
+        site_combined = site_monthly_mean(combined)
 
     # generate new obspack_id
     print("Making new obspack_id...")
-    site_combined["obspack_id"] = xr.zeros_like(site_combined["obs_value"], dtype='<U200')
-    for i, site in enumerate(site_combined["site"].values):
-        for j, time in enumerate(site_combined["obs_time"].values):
-            site_combined["obspack_id"][i, j] = monthly_mean_obspack_id(site, time)
+    site_combined["obspack_id"] = (("site", "obs_time"), monthly_mean_obspack_ids(site_combined["site"].values,
+                                                                               site_combined["obs_time"].values))
 
     # sum different regions if base 
-    if (str(output_dir)[-4:] == CASE) or (str(output_dir)[-12:] == CONSTANT_CASE):
+    if (str(output_dir)[-4:] == case) or (str(output_dir)[-12:] == constant_case):
         # sum up different regions
-        site_combined["CH4_sum"] = xr.zeros_like(site_combined["CH4_R00"])
-        for i in range(0, NO_REGIONS+1):
-            site_combined["CH4_sum"] += site_combined[f"CH4_R{i:02d}"]
+        site_combined["CH4_sum"] = tracers.sum_tracers(site_combined, "CH4_R", no_regions+1)
     else:
         # in perturbed runs, all months before perturbation shouldn't exist
         # some do without this code because the obspack contains 23:55-23:59 of the 
@@ -252,5 +817,68 @@ if __name__ == "__main__":
     # drop baseline, no longer means anything
     site_combined = site_combined.drop_vars("baseline")
 
-    # save combined file
-    site_combined.to_netcdf(output_dir / output_file)
+    return site_combined
+
+def parse_iterators(iterator_arg):
+    """
+    Parse the output folder indices to process: a single index ("3"), an inclusive
+    range ("0-119"), or a comma separated list of either ("0-5,9").
+    """
+    iterators = []
+    for part in iterator_arg.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            iterators.extend(range(int(first), int(last) + 1))
+        else:
+            iterators.append(int(part))
+    return iterators
+
+
+if __name__ == "__main__":
+    # read in variables from the config file
+    config = configparser.ConfigParser()
+    config.read('../../config.ini')
+    NO_REGIONS = int(config["inversion_constants"]["no_regions"])
+    CASE = config["inversion_constants"]["case"]
+    CONSTANT_CASE = config["inversion_constants"]["constant_case"]
+    AGAGE_SITES = config["inversion_constants"]["agage_sites"].split(",")
+    OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
+    GEOSOUT_DIR = Path(config["paths"]["geos_out"])
+    SPINUP_START = pd.to_datetime(config["dates"]["spinup_start"])
+    FINAL_END = pd.to_datetime(config["dates"]["final_end"])
+    CONSTANT_END = pd.to_datetime(config["dates"]["constant_end"])
+
+    # commandline arguments
+    # --incremental only reads geoschem files that are new since the last run
+    incremental = "--incremental" in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    # index of output folder to process, or several as a range/list to share the obs, e.g. "0-119"
+    iterators = parse_iterators(args[0])
+    first_year = int(args[1]) # first year to process geoschem output for
+    last_year = int(args[2])  # last year to process geoschem output for
+    output_file = args[3]     # name of output mole fraction file to save
+    # number of geoschem files to read at once, optional
+    n_workers = int(args[4]) if len(args) > 4 else 1
+
+    # read in observations, once for all the output folders
+    print("Reading in obs...")
+    with instrument.stage("read_obs"):
+        obspack_obs = read_baseline_obs(OBSPACK_DIR / "baseline_obs.nc", first_year, last_year)
+        obs_index = make_obspack_index(obspack_obs)
+    agage_over_noaa_ratio = read_agage_over_noaa_ratio(OBSPACK_DIR)
+    site_map = agage_site_map(AGAGE_SITES)
+
+    # read in geoschem output in each directory
+    geoschem_out_dirs = list(sorted(GEOSOUT_DIR.iterdir()))
+    for iterator in iterators:
+        print(iterator)
+        output_dir = geoschem_out_dirs[iterator]
+        print(output_dir)
+
+        site_combined = make_site_combined(output_dir, obspack_obs, NO_REGIONS, first_year, last_year,
+                                           agage_over_noaa_ratio, site_map, CASE, CONSTANT_CASE, CONSTANT_END,
+                                           n_workers, obs_index, incremental)
+
+        # save combined file
+        with instrument.stage("write_output", output_dir=output_dir.name):
+            site_combined.to_netcdf(output_dir / output_file)
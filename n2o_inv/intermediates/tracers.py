@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This script holds the helpers for working with the tagged tracers (CH4_R00,
+CH4_R01, ... and emi_R00, emi_R01, ...) as a single array with a region dimension,
+rather than as one variable per TRANSCOM region.
+"""
+import numpy as np
+import xarray as xr
+
+
+def tracer_names(prefix, n_regions):
+    """ The flat variable names of the tagged tracers, e.g. CH4_R00 to CH4_R22.
+    """
+    return [f"{prefix}{region:02d}" for region in range(0, n_regions)]
+
+def stack_tracers(ds, prefix, n_regions, dim="region"):
+    """ Stack the tagged tracers of a dataset into one contiguous DataArray, with
+    the region as the first dimension.
+    """
+    names = tracer_names(prefix, n_regions)
+    first = ds[names[0]]
+    for name in names[1:]:
+        if ds[name].dims != first.dims:
+            raise ValueError(f"{name} has dims {ds[name].dims}, expected {first.dims}")
+
+    stacked = np.stack([ds[name].values for name in names])
+    return xr.DataArray(stacked,
+                        dims=(dim,) + first.dims,
+                        coords={**first.coords, dim: np.arange(0, n_regions)},
+                        attrs=first.attrs)
+
+def unstack_tracers(stacked, prefix, dim="region"):
+    """ Split a stacked tracer DataArray back into the flat variables that GEOSChem,
+    HEMCO and the R intermediates expect.
+    """
+    return xr.Dataset({f"{prefix}{int(region):02d}": stacked.sel({dim: region}, drop=True)
+                       for region in stacked[dim].values})
+
+def tracer_total(stacked, dim="region"):
+    """ Sum the stacked tracers over all regions. nans propagate, as they did when
+    the regions were added up one by one.
+    """
+    return stacked.sum(dim, skipna=False, keep_attrs=True)
+
+def sum_tracers(ds, prefix, n_regions):
+    """ Add up the flat tagged tracers of a dataset to make a single total variable. Each
+    region is added into one output array, so no stacked copy of the tracers is made.
+    Data read in stacked (e.g. read_geos with stacked=True) can use tracer_total instead.
+    """
+    names = tracer_names(prefix, n_regions)
+    first = ds[names[0]]
+    total = np.zeros(first.shape, dtype=np.result_type(*[ds[name].dtype for name in names]))
+    for name in names:
+        if ds[name].dims != first.dims:
+            raise ValueError(f"{name} has dims {ds[name].dims}, expected {first.dims}")
+        total += ds[name].values
+    return xr.DataArray(total, dims=first.dims, coords=first.coords, attrs=first.attrs)
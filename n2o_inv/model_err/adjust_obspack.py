@@ -3,95 +3,156 @@
 """
 This script reads in GEOSChem obspack files and adjusts them for the model_err run.
 """
+from concurrent.futures import ProcessPoolExecutor
 import configparser
+from itertools import repeat
+import sys
 
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import xarray as xr
 
-def reformat_obspack_id(old_obs, add_str):
-    """ Add on string to obspack id to identify that it's a box surrounding an observation.
+from n2o_inv.obs import format_obspack_geoschem
+
+# (longitude, latitude, altitude) offsets of the boxes around each observation that are
+# sampled, the observation itself first, in the order of the old .1 to .8 obspack ids
+SURROUNDING_BOXES = np.array([[0.0, 0.0, 0.0],
+                              [-5.0, 0.0, 0.0],
+                              [5.0, 0.0, 0.0],
+                              [0.0, -4.0, 0.0],
+                              [0.0, 4.0, 0.0],
+                              [-5.0, -4.0, 0.0],
+                              [5.0, -4.0, 0.0],
+                              [5.0, 4.0, 0.0],
+                              [-5.0, 4.0, 0.0]])
+
+def make_stencil(n_lon=3, n_lat=3, lon_step=5.0, lat_step=4.0, altitudes=(0.0,)):
+    """ (longitude, latitude, altitude) offsets of an n_lon by n_lat block of boxes
+    (odd sizes) around an observation at each of the altitude offsets (m), with the
+    observation itself first.
     """
-    new_obspack = []
-    for i in old_obs["obspack_id"].values:
-        new_id = i.strip() + add_str
-        new_obspack.append(new_id + b' ' * (200 - len(new_id)))
-
-    return new_obspack
+    if n_lon % 2 == 0 or n_lat % 2 == 0:
+        raise ValueError("The stencil must have an odd number of boxes in each direction")
+
+    lon_offsets = lon_step * (np.arange(n_lon) - n_lon // 2)
+    lat_offsets = lat_step * (np.arange(n_lat) - n_lat // 2)
+    alt, lat, lon = np.meshgrid(altitudes, lat_offsets, lon_offsets, indexing="ij")
+    stencil = np.column_stack([lon.ravel(), lat.ravel(), alt.ravel()]).astype(float)
+
+    # move the observation itself to the front
+    centre = np.flatnonzero((stencil == 0).all(axis=1))
+    if len(centre) == 0:
+        raise ValueError("The stencil altitudes must include 0")
+    return np.concatenate([stencil[centre], np.delete(stencil, centre, axis=0)])
+
+def stencil_obspack_ids(obspack_ids, stencil_index):
+    """ Obspack ids for the boxes of a stencil, with ".k" added for the kth box around an
+    observation. The observation itself (k = 0) keeps its id.
+    """
+    obspack_ids = np.asarray(obspack_ids).astype(bytes)
+    suffixes = np.char.add(b".", stencil_index.astype(bytes))
+    new_ids = format_obspack_geoschem.pad_obspack_id(np.char.add(np.char.strip(obspack_ids), suffixes))
+    return np.where(stencil_index == 0, obspack_ids, new_ids)
 
-def surround_obspack(obspack_nc):
-    """ Make it look like there are observations in the horizontal boxes surrounding real observations.
+def wrap_longitude(longitude):
+    """ Bring longitudes up to one lap outside [-180, 180) back into it.
     """
-    lon_25_lat000 = obspack_nc.copy()
-    lon025_lat000 = obspack_nc.copy()
-    lon000_lat020 = obspack_nc.copy()
-    lon000_lat_20 = obspack_nc.copy()
-
-    lon_25_lat_20 = obspack_nc.copy()
-    lon025_lat_20 = obspack_nc.copy()
-    lon025_lat020 = obspack_nc.copy()
-    lon_25_lat020 = obspack_nc.copy()
-
-    lon_25_lat000["longitude"] = obspack_nc["longitude"] - 5.0
-    lon025_lat000["longitude"] = obspack_nc["longitude"] + 5.0
-    lon000_lat020["latitude"] = obspack_nc["latitude"] - 4.0
-    lon000_lat_20["latitude"] = obspack_nc["latitude"] + 4.0
-
-    lon_25_lat_20["longitude"] = obspack_nc["longitude"] - 5.0
-    lon_25_lat_20["latitude"] = obspack_nc["latitude"] - 4.0
-
-    lon025_lat_20["longitude"] = obspack_nc["longitude"] + 5.0
-    lon025_lat_20["latitude"] = obspack_nc["latitude"] - 4.0
-
-    lon025_lat020["longitude"] = obspack_nc["longitude"] + 5.0
-    lon025_lat020["latitude"] = obspack_nc["latitude"] + 4.0
-
-    lon_25_lat020["longitude"] = obspack_nc["longitude"] - 5.0
-    lon_25_lat020["latitude"] = obspack_nc["latitude"] + 4.0
-
-    lon_25_lat000["obs"] = obspack_nc["obs"] + 1/9
-    lon025_lat000["obs"] = obspack_nc["obs"] + 2/9
-    lon000_lat020["obs"] = obspack_nc["obs"] + 3/9
-    lon000_lat_20["obs"] = obspack_nc["obs"] + 4/9
-    lon_25_lat_20["obs"] = obspack_nc["obs"] + 5/9
-    lon025_lat_20["obs"] = obspack_nc["obs"] + 6/9
-    lon025_lat020["obs"] = obspack_nc["obs"] + 7/9
-    lon_25_lat020["obs"] = obspack_nc["obs"] + 8/9
-
-    lon_25_lat000["obspack_id"].values = reformat_obspack_id(obspack_nc, b".1")
-    lon025_lat000["obspack_id"].values = reformat_obspack_id(obspack_nc, b".2")
-    lon000_lat020["obspack_id"].values = reformat_obspack_id(obspack_nc, b".3")
-    lon000_lat_20["obspack_id"].values = reformat_obspack_id(obspack_nc, b".4")
-    lon_25_lat_20["obspack_id"].values = reformat_obspack_id(obspack_nc, b".5")
-    lon025_lat_20["obspack_id"].values = reformat_obspack_id(obspack_nc, b".6")
-    lon025_lat020["obspack_id"].values = reformat_obspack_id(obspack_nc, b".7")
-    lon_25_lat020["obspack_id"].values = reformat_obspack_id(obspack_nc, b".8")
-
-    merged = xr.merge([obspack_nc, lon_25_lat000, lon025_lat000,
-                       lon000_lat020, lon000_lat_20, lon_25_lat_20,
-                       lon025_lat_20, lon025_lat020, lon_25_lat020])
+    longitude = np.where(longitude < -180, 180 + (longitude + 180), longitude)
+    return np.where(longitude >= 180, (longitude - 180) - 180, longitude)
 
-    # could be doubles at poles
+def clamp_latitude(latitude):
+    """ Move latitudes beyond the poles onto the poles.
+    """
     # this does mean anything at the poles repeats so will have an artificially low std...
     # but SPO is only site affected, and it's mostly 0 for std anyway
-    merged["latitude"] = xr.where(merged["latitude"] > 90, 
-                                  90.0,
-                                  merged["latitude"])
-
-    merged["latitude"] = xr.where(merged["latitude"] < -90, 
-                                  -90.0,
-                                  merged["latitude"])
+    return np.clip(latitude, -90.0, 90.0)
 
-    merged["longitude"] = xr.where(merged["longitude"] < -180, 
-                                  180 + (merged["longitude"] + 180),
-                                  merged["longitude"])
+def _offset(values, offsets):
+    """ Every value plus every offset, as an (n_values * n_offsets) array keeping the
+    float type of values.
+    """
+    dtype = values.dtype if values.dtype.kind == "f" else np.float64
+    return (values[:, None] + offsets.astype(dtype)).ravel()
 
-    merged["longitude"] = xr.where(merged["longitude"] >= 180, 
-                                  (merged["longitude"] - 180) - 180,
-                                  merged["longitude"])
+def stencil_positions(longitude, latitude, altitude, stencil=SURROUNDING_BOXES):
+    """ The longitude, latitude and altitude of every box of a stencil around each
+    position, as (n_positions * n_boxes) arrays with the boxes around a position together.
+    altitude can be None if only the horizontal positions are wanted.
+    """
+    stencil = np.asarray(stencil, dtype=float)
+    # could be doubles at poles
+    longitude = wrap_longitude(_offset(np.asarray(longitude), stencil[:, 0]))
+    latitude = clamp_latitude(_offset(np.asarray(latitude), stencil[:, 1]))
+    if altitude is not None:
+        altitude = _offset(np.asarray(altitude), stencil[:, 2])
+    return longitude, latitude, altitude
+
+def stencil_obspack(obspack_nc, stencil=SURROUNDING_BOXES):
+    """ Make it look like there are observations in the boxes of a stencil of
+    (longitude, latitude, altitude) offsets around each real observation (see make_stencil).
+
+    The new obs are numbered obs * len(stencil) + k for the kth box, so the boxes around an
+    observation stay together in obs order. obs_parent holds the original obs number and
+    stencil_index k.
+    """
+    stencil = np.asarray(stencil, dtype=float)
+    n_obs, n_boxes = len(obspack_nc["obs"]), len(stencil)
+    parent_index = np.repeat(np.arange(n_obs), n_boxes)
+    stencil_index = np.tile(np.arange(n_boxes), n_obs)
+
+    # copy every observation once for each box
+    surrounded = obspack_nc.isel(obs=parent_index)
+    obs = obspack_nc["obs"].values[parent_index]
+    surrounded = surrounded.assign_coords(obs=obs * n_boxes + stencil_index)
+    surrounded["obs_parent"] = (("obs"), obs)
+    surrounded["stencil_index"] = (("obs"), stencil_index)
+
+    # then move them
+    moves_altitude = (stencil[:, 2] != 0).any()
+    longitude, latitude, altitude = stencil_positions(obspack_nc["longitude"].values, obspack_nc["latitude"].values,
+                                                      obspack_nc["altitude"].values if moves_altitude else None,
+                                                      stencil)
+    surrounded["longitude"] = (("obs"), longitude, obspack_nc["longitude"].attrs)
+    surrounded["latitude"] = (("obs"), latitude, obspack_nc["latitude"].attrs)
+    if moves_altitude:
+        surrounded["altitude"] = (("obs"), altitude, obspack_nc["altitude"].attrs)
+
+    surrounded["obspack_id"] = (("obs"), stencil_obspack_ids(surrounded["obspack_id"].values, stencil_index),
+                                obspack_nc["obspack_id"].attrs)
+    return surrounded
 
-    return merged
+def surround_obspack(obspack_nc):
+    """ Make it look like there are observations in the horizontal boxes surrounding real observations.
+    """
+    return stencil_obspack(obspack_nc, SURROUNDING_BOXES)
 
+def adjust_daily_obspack(in_file, out_file, stencil=SURROUNDING_BOXES):
+    """ Write the stencil obspack for one day's obspack file, returning False if there
+    is no file for that day (no obs).
+    """
+    if not in_file.exists():
+        return False
+
+    # xarray messes up the times without turning off decode_times
+    with xr.open_dataset(in_file, decode_times=False) as load:
+        obspack_nc = load.load()
+    format_obspack_geoschem.to_netcdf_atomic(stencil_obspack(obspack_nc, stencil), out_file)
+    return True
+
+def adjust_daily_obspacks(obspack_dir, out_dir, dates, stencil=SURROUNDING_BOXES, n_workers=1):
+    """ Write the stencil obspack for each day in dates, with n_workers processes
+    working on different days. Returns the number of days written.
+    """
+    in_files = [format_obspack_geoschem.daily_obspack_filename(obspack_dir, date) for date in dates]
+    out_files = [format_obspack_geoschem.daily_obspack_filename(out_dir, date) for date in dates]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            written = list(executor.map(adjust_daily_obspack, in_files, out_files, repeat(stencil),
+                                        chunksize=8))
+    else:
+        written = [adjust_daily_obspack(in_file, out_file, stencil) for in_file, out_file in zip(in_files, out_files)]
+    return sum(written)
 
 
 if __name__ == "__main__":
@@ -107,17 +168,12 @@ if __name__ == "__main__":
     SPINUP_START = config["dates"]["spinup_start"]
     FINAL_END = config["dates"]["final_end"]
 
+    # number of processes to adjust the days with
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+    # make new surrounding obspack for each day
     daily_dates = pd.date_range(SPINUP_START, FINAL_END)[:-1]
-    for date in daily_dates:
-        formatted_date = date.strftime('%Y%m%d')
-        # read in original xarray file
-        # xarray messes up the times without turning off decode_times
-        with xr.open_dataset(OBSPACK_DIR / f"obspack_n2o.{formatted_date}.nc", decode_times=False) as load:
-            obspack_nc = load.load()
-
-        # make new surrounding obspack
-        new_obpack = surround_obspack(obspack_nc)
-
-        # save 
-        new_obpack.to_netcdf(OBSPACK_DIR / f"model_err/obspack_n2o.{formatted_date}.nc", 
-                             encoding={"obs":{"dtype":"float64"}})
+    (OBSPACK_DIR / "model_err").mkdir(parents=True, exist_ok=True)
+    no_written = adjust_daily_obspacks(OBSPACK_DIR, OBSPACK_DIR / "model_err", daily_dates,
+                                       SURROUNDING_BOXES, n_workers)
+    print(f"Written {no_written} of {len(daily_dates)} days")
@@ -4,6 +4,7 @@
 This script calculates the model error from the GEOSChem output.
 """
 import configparser
+import sys
 
 from pathlib import Path
 
@@ -11,9 +12,211 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
-from n2o_inv.intermediates import process_geos_output
+from n2o_inv.intermediates import process_geos_output, tracers
 from n2o_inv.obs import obs_baseline
-from n2o_inv.obs import plot_obs
+from n2o_inv.utils import checkpoint, instrument
+
+# the variables adjust_obspack.py adds to say which grid cell around which obs each row is
+STENCIL_VARS = ("obs_parent", "stencil_index")
+
+def check_stencil_obs(obspack_obs):
+    """ Check the obs have the grid cells around each obs, as made by adjust_obspack.py.
+    """
+    missing = [var for var in STENCIL_VARS if var not in obspack_obs.variables]
+    if missing:
+        raise ValueError(f"the model error obspack files have no {', '.join(missing)}, remake them "
+                         "with the current n2o_inv/model_err/adjust_obspack.py (then rerun the "
+                         "model error GEOSChem run) before running calc_model_err.py")
+
+def read_raw_obs(obspack_dir, spinup_start, final_end):
+    """ Read in the obs (with the extra eight grid cells) and find their sites.
+    """
+    obspack_raw = process_geos_output.read_obs(obspack_dir, spinup_start, final_end, final_end)
+    check_stencil_obs(obspack_raw)
+    print("Finding unique sites...")
+    list_of_sites, unique_sites = process_geos_output.find_unique_sites(obspack_raw)
+    obspack_raw["site"] = (("obs"), np.array(list_of_sites))
+    return obspack_raw
+
+def select_baseline(obspack_raw, agage_baseline_dict, perturb_start, final_end):
+    """ Flag the baseline obs and cut the obs to the years of the model_err run.
+    """
+    obspack_baseline = obs_baseline.raw_obs_to_baseline(obspack_raw, agage_baseline_dict)
+
+    # cut unwanted years
+    obspack_baseline = obspack_baseline.where(obspack_baseline["time"] >= pd.to_datetime(f"{perturb_start.year - 1}-12-31 23:55"), drop=True)
+    obspack_baseline = obspack_baseline.where(obspack_baseline["time"] < pd.to_datetime(f"{final_end.year}-12-31 23:55"), drop=True)
+    return obspack_baseline
+
+def read_model_err_geos(geos_dir, obspack_baseline, no_regions, perturb_start, perturb_end):
+    """ Read in the geoschem output (with the extra eight grid cells) and add up the regions.
+    """
+    stacked_geos = process_geos_output.read_geos(geos_dir, obspack_baseline,
+                                                 no_regions, perturb_start.year, (perturb_end.year-1),
+                                                 stacked=True)
+
+    # sum up different regions
+    obspack_geos = tracers.unstack_tracers(stacked_geos["CH4_R"], "CH4_R")
+    obspack_geos["CH4_sum"] = tracers.tracer_total(stacked_geos["CH4_R"])
+    return obspack_geos
+
+def perturbation_baseline(times, baseline, perturb_start):
+    """ Which obs are baseline obs in the perturbation years. The obs from select_baseline
+    also have the last few minutes of the year before, which aren't wanted.
+    """
+    return (baseline == 1) & (times >= np.datetime64(f"{perturb_start.year}-01-01"))
+
+def merge_agage_sites(codes, table, agage_sites):
+    """ Combine NOAA sites and AGAGE sites where we have AGAGE data on the site codes, as in
+    process_geos_output.py, returning the new codes and table.
+    """
+    return process_geos_output.remap_site_codes(codes, table, process_geos_output.agage_site_map(agage_sites))
+
+def merge_obs_geos(obspack_baseline, obspack_geos, perturb_start):
+    """ Combine the obs and geoschem output as in process_geos_output.py, keeping the
+    baseline obs in the perturbation years with obs_time as the dimension.
+    """
+    check_stencil_obs(obspack_baseline)
+    combined = xr.merge([obspack_baseline[["latitude", "longitude", "altitude",
+                                           "time", "obspack_id", "value",
+                                           "value_unc", "network", "site", "baseline",
+                                           *STENCIL_VARS]],
+                         obspack_geos])
+    combined = combined.rename({"latitude":"obs_lat", "longitude":"obs_lon",
+                                "altitude":"obs_alt", "time":"obs_time",
+                                "value":"obs_value", "value_unc":"obs_value_unc"})
+
+    # make dimensions site and time as in process_geos_output.py
+    print("Sorting out dims...")
+    combined = combined.assign_coords(obs_time=combined["obs_time"])
+    combined = combined.swap_dims({"obs":"obs_time"})
+
+    # drops air sites, non-baseline points and 23:55-23:59 from previous year as in process_geos_output.py
+    return combined.where(perturbation_baseline(combined["obs_time"], combined["baseline"], perturb_start), drop=True)
+
+def rescale_and_merge_sites(combined, agage_over_noaa_ratio, agage_sites):
+    """ Rescale AGAGE to NOAA and combine NOAA sites and AGAGE sites where we have AGAGE
+    data, as in process_geos_output.py. The site names are swapped for an integer
+    site_code into the site_table coordinate.
+    """
+    combined = combined.copy(deep=True)
+    agage_mask = combined["network"] == "AGAGEsurf"
+    combined["obs_value"][agage_mask] = combined["obs_value"][agage_mask] / agage_over_noaa_ratio
+
+    codes, table = merge_agage_sites(*process_geos_output.site_table_codes(combined["site"].values), agage_sites)
+    combined["site_code"] = (combined["site"].dims, codes)
+    return combined.drop_vars("site").assign_coords(site_table=table)
+
+def per_site_model_err(combined, unique_sites):
+    """ The median model std of each site in each month, working through the sites one
+    at a time. The boxes around each observation are grouped by obs_parent.
+    """
+    site_table = list(combined["site_table"].values)
+    resampled_sites = []
+    for site in unique_sites:
+        onesite = combined.where(combined["site_code"] == site_table.index(site), drop=True)
+        # remove the extra 8 values for each obs to get correct obs_time
+        onesite_ninth = onesite.where(onesite["stencil_index"] == 0, drop=True)
+        # work out model std for each obs, obs_parent is the same for each group of 9 gridcells
+        model_std = onesite[["CH4_sum", "obs_parent"]].groupby("obs_parent").std()
+        # recombine with correct obs_time
+        onesite_ninth["model_std"] = (("obs_time"), model_std["CH4_sum"].values)
+        # calculate median error
+        onesite_resampled = onesite_ninth["model_std"].resample(obs_time="M").median()
+        # save for later
+        resampled_sites.append(onesite_resampled)
+        # do the values make sense?
+        print(site)
+        print(onesite_resampled.median().values)
+
+    # recombine sites
+    print("Recombining sites...")
+    site_combined = xr.concat(resampled_sites, dim="site")
+    site_combined["site"] = (("site"), unique_sites)
+    return site_combined
+
+def stencil_model_std(obs_parent, stencil_index, ch4_sum):
+    """ The std (ddof 0, ignoring nans, as the groupby std) of ch4_sum over the boxes
+    around each observation. The boxes are sorted by obs_parent then stencil_index and
+    reshaped to (n_obs, n_boxes), so every observation needs all its boxes. Returns the
+    positions of the observations themselves (stencil_index 0) and their model std.
+    """
+    order = np.lexsort((stencil_index, obs_parent))
+    n_boxes = int(np.max(stencil_index)) + 1
+    if len(order) % n_boxes != 0:
+        raise ValueError(f"Some observations don't have all {n_boxes} boxes around them")
+    stencil_index = np.asarray(stencil_index)[order].reshape(-1, n_boxes)
+    obs_parent = np.asarray(obs_parent)[order].reshape(-1, n_boxes)
+    if (stencil_index != np.arange(n_boxes)).any() or (obs_parent != obs_parent[:, :1]).any():
+        raise ValueError(f"Some observations don't have all {n_boxes} boxes around them")
+
+    boxes = np.asarray(ch4_sum)[order].reshape(-1, n_boxes)
+    with np.errstate(invalid="ignore"):
+        model_std = np.nanstd(boxes, axis=1).astype(boxes.dtype)
+    return order[::n_boxes], model_std
+
+def month_end(times):
+    """ The last day of the month of each time, the label resample(obs_time="M") gives.
+    """
+    times = np.asarray(times).astype("datetime64[M]")
+    return ((times + 1).astype("datetime64[D]") - 1).astype("datetime64[ns]")
+
+def monthly_median_std(site_codes, site_table, times, model_std):
+    """ The median model std of each site in each month it has observations, as a
+    (site, obs_time) DataArray. The sites are grouped on their integer codes into site_table.
+    """
+    model_std = pd.DataFrame({"site": site_codes, "obs_time": month_end(times), "model_std": model_std})
+    monthly = model_std.groupby(["site", "obs_time"])["model_std"].median()
+    monthly = monthly.to_xarray().astype(model_std["model_std"].dtype)
+    return monthly.assign_coords(site=np.asarray(site_table)[monthly["site"].values])
+
+def fill_site_months(site_combined, unique_sites):
+    """ Put the sites in the order of unique_sites, with every month from each site's first
+    to last month with a model std (nan where there is none). This is what resampling each
+    site separately then concatenating them gives.
+    """
+    months = set()
+    for site_months in site_combined.notnull().transpose("site", "obs_time").values:
+        site_months = site_combined["obs_time"].values[site_months]
+        if len(site_months) > 0:
+            months.update(pd.date_range(site_months.min(), site_months.max(), freq="M"))
+    return site_combined.reindex(site=unique_sites, obs_time=np.array(sorted(months), dtype="datetime64[ns]"))
+
+def reshape_model_err(combined, unique_sites):
+    """ The median model std of each site in each month, as per_site_model_err gives, with
+    one reshaped numpy std over all the observations and one grouped median for all sites.
+    """
+    centre, model_std = stencil_model_std(combined["obs_parent"].values, combined["stencil_index"].values,
+                                          combined["CH4_sum"].values)
+    monthly = monthly_median_std(combined["site_code"].values[centre], combined["site_table"].values,
+                                 combined["obs_time"].values[centre], model_std)
+    site_combined = fill_site_months(monthly, unique_sites)
+    site_combined.name = "model_std"
+    return site_combined
+
+def stage_keys(obspack_files, baseline_files, geos_files, no_regions, agage_sites, agage_over_noaa_ratio,
+               spinup_start, perturb_start, final_end):
+    """ The checkpoint key of each stage of making combined.nc, from the stage's inputs and
+    the keys of the stages it uses. The baseline stage includes the dodgy sites and the
+    version of the baseline rules, so changing how obs_baseline picks the baseline obs
+    redoes the baseline and the stages after it.
+    """
+    keys = {}
+    keys["raw_obs"] = checkpoint.stage_key("raw_obs", {"files": checkpoint.files_fingerprint(obspack_files),
+                                                       "spinup_start": spinup_start, "final_end": final_end})
+    keys["baseline"] = checkpoint.stage_key("baseline", {"files": checkpoint.files_fingerprint(baseline_files),
+                                                         "dodgy_sites": list(obs_baseline.DODGY_SITES),
+                                                         "rules_version": obs_baseline.BASELINE_RULES_VERSION,
+                                                         "agage_sites": agage_sites, "perturb_start": perturb_start,
+                                                         "final_end": final_end},
+                                            [keys["raw_obs"]])
+    keys["geos"] = checkpoint.stage_key("geos", {"files": checkpoint.files_fingerprint(geos_files), "no_regions": no_regions},
+                                        [keys["baseline"]])
+    keys["merge"] = checkpoint.stage_key("merge", {"perturb_start": perturb_start}, [keys["baseline"], keys["geos"]])
+    keys["site_codes"] = checkpoint.stage_key("site_codes", {"agage_over_noaa_ratio": float(agage_over_noaa_ratio),
+                                                             "agage_sites": agage_sites},
+                                              [keys["merge"]])
+    return keys
 
 if __name__ == "__main__":
     """ 
@@ -26,6 +229,7 @@ if __name__ == "__main__":
     NO_REGIONS = int(config["inversion_constants"]["no_regions"])
     CASE = config["inversion_constants"]["model_err_case"]
     AGAGE_SITES = config["inversion_constants"]["agage_sites"].split(",")
+    DATA_DIR = Path(config["paths"]["data_dir"])
     GEOS_OUT = Path(config["paths"]["geos_out"])
     OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
     SPINUP_START = pd.to_datetime(config["dates"]["spinup_start"])
@@ -37,110 +241,66 @@ if __name__ == "__main__":
     Make combined.nc file
     """
 
-    print("Does combined.nc file already exist?")
-    combined_file = GEOS_OUT / CASE / "combined.nc"
-    if combined_file.is_file():
-        print("Reading in existing combined.nc file...")
-        with xr.open_dataset(combined_file) as load:
-            combined = load.load()
-            unique_sites = np.unique(combined["site"]) # other function uses obspackid so wont work
-    else:
-        print("Making combined.nc file, this takes a long time...")
-
-        # read in observations
-        # have to redo this (which was originally done in plot_obs.py and obs_baseline.py) because
-        # need to do it with the extra eight grid cells
-        print("Reading in obs...")
-        obspack_raw = process_geos_output.read_obs(OBSPACK_DIR / CASE, SPINUP_START, 
-                                                FINAL_END, FINAL_END)
-        print("Finding unique sites...")
-        list_of_sites, unique_sites = process_geos_output.find_unique_sites(obspack_raw)
-        obspack_raw["site"] = (("obs"), np.array(list_of_sites))
-
-        # read in AGAGE baselines
-        agage_baseline_dict = obs_baseline.make_agage_baseline_dict(config)
-        # filter to only baseline
-        obspack_baseline = obs_baseline.raw_obs_to_baseline(obspack_raw, agage_baseline_dict)
-
-        # cut unwanted years
-        obspack_baseline = obspack_baseline.where(obspack_baseline["time"] >= pd.to_datetime(f"{PERTURB_START.year - 1}-12-31 23:55"), drop=True)
-        obspack_baseline = obspack_baseline.where(obspack_baseline["time"] < pd.to_datetime(f"{FINAL_END.year}-12-31 23:55"), drop=True)
-
-        # read in geos output
-        # have to redo this (which was originally done in process_geos_output.py) because
-        # need to do it with the extra eight grid cells
-        print("Reading in geos...")
-        obspack_geos = process_geos_output.read_geos(GEOS_OUT / CASE, obspack_baseline,
-                                                     NO_REGIONS, PERTURB_START.year, (PERTURB_END.year-1))
-
-        # sum up different regions
-        obspack_geos = plot_obs.add_ch4(obspack_geos, NO_REGIONS+1)
-        # obs_floor will be the same for each group of 9 gridcells
-        obspack_geos["obs_floor"] = np.floor(obspack_geos["obs"])
-
-
-        # combine the two datasets as in process_geos_output.py
-        print("Combining datasets...")
-        combined = xr.merge([obspack_baseline[["latitude", "longitude", "altitude",
-                                            "time", "obspack_id", "value", 
-                                            "value_unc", "network", "site", "baseline"]],
-                                obspack_geos])
-        combined = combined.rename({"latitude":"obs_lat", "longitude":"obs_lon",
-                                    "altitude":"obs_alt", "time":"obs_time", 
-                                    "value":"obs_value", "value_unc":"obs_value_unc"})
-
-        # dont want 23:55-23:59 from previous year
-        combined = combined.where(combined["obs_time"] >= pd.to_datetime(f"{PERTURB_START.year}-01-01"), drop=True)
-
-        # make dimensions site and time as in process_geos_output.py
-        print("Sorting out dims...")
-        combined = combined.assign_coords(obs_time=combined["obs_time"])
-        combined = combined.swap_dims({"obs":"obs_time"})
-
-        # drops air sites and non-baseline points as in process_geos_output.py
-        combined = combined.where(combined["baseline"], drop=True)
-
-        # rescale AGAGE to NOAA as in process_geos_output.py
-        agage_mask = combined["network"] == "AGAGEsurf"
-        agage_over_noaa_ratio = pd.read_csv(OBSPACK_DIR / "agage_noaa_scaling/agage_over_noaa_ratio.csv", index_col=0).iloc[0].values[0]
-        combined["obs_value"][agage_mask] = combined["obs_value"][agage_mask] / agage_over_noaa_ratio
-
-        # combine NOAA sites and AGAGE sites where we have AGAGE data as in process_geos_output.py
-        for site in AGAGE_SITES:
-            combined["site"].loc[combined["site"] == f"{site.lower()}AGAGEsurf"] = f"{site.lower()}NOAGsurf"
-            combined["site"].loc[combined["site"] == f"{site.lower()}NOAAsurf"] = f"{site.lower()}NOAGsurf"
-        unique_sites = np.unique(combined["site"]) # other function uses obspackid so wont work
-
-        # save for later since its so slow
+    # each stage is saved in checkpoint_dir, keyed by its inputs and the stages before it,
+    # so a change to a late stage reuses the earlier ones (the first run takes a long time)
+    checkpoint_dir = GEOS_OUT / CASE / "checkpoints"
+    geos_files = process_geos_output.list_geos_files(GEOS_OUT / CASE, PERTURB_START.year, PERTURB_END.year-1)
+    agage_over_noaa_ratio = pd.read_csv(OBSPACK_DIR / "agage_noaa_scaling/agage_over_noaa_ratio.csv", index_col=0).iloc[0].values[0]
+    keys = stage_keys((OBSPACK_DIR / CASE).glob("obspack_n2o.*.nc"), (DATA_DIR / "agage_baseline").glob("NAME_baseline_*.nc"),
+                      geos_files, NO_REGIONS, AGAGE_SITES, agage_over_noaa_ratio, SPINUP_START, PERTURB_START, FINAL_END)
+
+    # read in observations
+    # have to redo this (which was originally done in plot_obs.py and obs_baseline.py) because
+    # need to do it with the extra eight grid cells
+    print("Reading in obs...")
+    with instrument.stage("read_obs"):
+        obspack_raw = checkpoint.cached_stage(checkpoint_dir, "raw_obs", keys["raw_obs"],
+                                              lambda: read_raw_obs(OBSPACK_DIR / CASE, SPINUP_START, FINAL_END))
+
+    # read in AGAGE baselines and filter to only baseline
+    with instrument.stage("baseline"):
+        obspack_baseline = checkpoint.cached_stage(checkpoint_dir, "baseline", keys["baseline"],
+                                                   lambda: select_baseline(obspack_raw, obs_baseline.make_agage_baseline_dict(config),
+                                                                           PERTURB_START, FINAL_END))
+
+    # read in geos output
+    # have to redo this (which was originally done in process_geos_output.py) because
+    # need to do it with the extra eight grid cells
+    print("Reading in geos...")
+    with instrument.stage("read_geos"):
+        obspack_geos = checkpoint.cached_stage(checkpoint_dir, "geos", keys["geos"],
+                                               lambda: read_model_err_geos(GEOS_OUT / CASE, obspack_baseline, NO_REGIONS,
+                                                                           PERTURB_START, PERTURB_END))
+
+    # combine the two datasets as in process_geos_output.py
+    print("Combining datasets...")
+    with instrument.stage("combine"):
+        combined = checkpoint.cached_stage(checkpoint_dir, "merge", keys["merge"],
+                                           lambda: merge_obs_geos(obspack_baseline, obspack_geos, PERTURB_START))
+
+        # rescale AGAGE to NOAA and combine NOAA sites and AGAGE sites where we have AGAGE data
+        combined = checkpoint.cached_stage(checkpoint_dir, "site_codes", keys["site_codes"],
+                                           lambda: rescale_and_merge_sites(combined, agage_over_noaa_ratio, AGAGE_SITES))
+        # every site in the table has obs, as it's made from the merged obs
+        unique_sites = combined["site_table"].values
+
+        # also save where it used to be
         combined.to_netcdf(GEOS_OUT / CASE / "combined.nc")
 
     """ 
     Create monthly mean
     """
 
-    # create monthly mean for each site
+    # create monthly mean for each site, with "per_site" working through the sites one by one
     print("Making monthly mean...")
-    resampled_sites = []
-    for site in unique_sites:
-        onesite = combined.where(combined["site"] == site, drop=True)
-        # remove the extra 8 values for each obs to get correct obs_time
-        onesite_ninth = onesite.where(onesite["obs"]  == onesite["obs_floor"], drop=True)
-        # work out model std for each obs
-        model_std = onesite[["CH4_sum", "obs_floor"]].groupby("obs_floor").std()
-        # recombine with correct obs_time
-        onesite_ninth["model_std"] = (("obs_time"), model_std["CH4_sum"].values)
-        # calculate median error
-        onesite_resampled = onesite_ninth["model_std"].resample(obs_time="M").median()
-        # save for later
-        resampled_sites.append(onesite_resampled)
-        # do the values make sense?
-        print(site)
-        print(onesite_resampled.median().values)
-
-    # recombine sites
-    print("Recombining sites...")
-    site_combined = xr.concat(resampled_sites, dim="site")
-    site_combined["site"] = (("site"), unique_sites)
+    with instrument.stage("monthly_model_err"):
+        if len(sys.argv) > 1 and sys.argv[1] == "per_site":
+            site_combined = per_site_model_err(combined, unique_sites)
+        else:
+            site_combined = reshape_model_err(combined, unique_sites)
+            # do the values make sense?
+            print(site_combined.median("obs_time").to_series())
 
     # save combined file
-    site_combined.to_netcdf(GEOS_OUT / CASE / "model_err.nc")
+    with instrument.stage("write_output"):
+        site_combined.to_netcdf(GEOS_OUT / CASE / "model_err.nc")
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This script calculates the model error by sampling the gridded GEOSChem output of the
+base run around each observation, rather than needing a separate model_err GEOSChem run.
+"""
+import configparser
+import sys
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from n2o_inv.intermediates import process_geos_output, tracers
+from n2o_inv.model_err import adjust_obspack, calc_model_err
+from n2o_inv.obs import obs_baseline
+
+def level_heights(hyam, hybm, P0):
+    """ Calculate the approximate height (m) of the geoschem levels, as in plot_output.calc_height.
+    """
+    Pm = hyam + hybm * P0
+    return np.log(Pm/1000) * -7640
+
+def nearest_index(centres, values):
+    """ The index of the nearest of the sorted centres to each value.
+    """
+    edges = (centres[1:] + centres[:-1]) / 2
+    return np.searchsorted(edges, values)
+
+def nearest_lon_index(lon, values):
+    """ The index of the nearest of the sorted, evenly spaced, longitude centres to each
+    value, going round the globe.
+    """
+    return nearest_index(np.append(lon, lon[0] + 360), values) % len(lon)
+
+def read_grid(species_conc_file):
+    """ The latitude, longitude and level heights of the geoschem grid in a SpeciesConc file.
+    """
+    with xr.open_dataset(species_conc_file) as load:
+        grid = {"lat": load["lat"].values,
+                "lon": load["lon"].values,
+                "height": np.asarray(level_heights(load["hyam"], load["hybm"], load["P0"]))}
+    if (np.diff(grid["height"]) <= 0).any():
+        raise ValueError(f"The levels in {species_conc_file} don't go up in height")
+    return grid
+
+def grid_index(grid, longitude, latitude, altitude):
+    """ The flat index into a (lev, lat, lon) field of the grid cell each position is in.
+    """
+    lev_index = nearest_index(grid["height"], altitude)
+    lat_index = nearest_index(grid["lat"], latitude)
+    lon_index = nearest_lon_index(grid["lon"], longitude)
+    return np.ravel_multi_index((lev_index, lat_index, lon_index),
+                                (len(grid["height"]), len(grid["lat"]), len(grid["lon"])))
+
+def stencil_grid_index(grid, obspack_obs, stencil=adjust_obspack.SURROUNDING_BOXES):
+    """ The flat index of the grid cell of each box of the stencil around each
+    observation, as an (n_obs, n_boxes) array. The boxes are placed as in
+    adjust_obspack.stencil_obspack, so they are the cells a model_err run would sample.
+    """
+    longitude, latitude, altitude = adjust_obspack.stencil_positions(obspack_obs["longitude"].values,
+                                                                     obspack_obs["latitude"].values,
+                                                                     obspack_obs["altitude"].values, stencil)
+    return grid_index(grid, longitude, latitude, altitude).reshape(len(obspack_obs["obs"]), len(stencil))
+
+def species_conc_files(output_dir):
+    """ The geoschem SpeciesConc files in a run's output directory, in date order.
+    """
+    return sorted(output_dir.glob("GEOSChem.SpeciesConc.*_0000z.nc4"))
+
+def species_conc_times(species_conc_files):
+    """ The output times in each SpeciesConc file, with the file and time step they are in.
+    """
+    times, file_numbers, steps = [], [], []
+    for file_number, species_conc_file in enumerate(species_conc_files):
+        with xr.open_dataset(species_conc_file) as load:
+            file_times = load["time"].values
+        times.append(file_times)
+        file_numbers.append(np.full(len(file_times), file_number))
+        steps.append(np.arange(len(file_times)))
+    return np.concatenate(times), np.concatenate(file_numbers), np.concatenate(steps)
+
+def read_species_conc(species_conc_file, no_regions):
+    """ The total of the tagged tracers in a SpeciesConc file, in ppb, as a
+    (time, lev, lat, lon) array.
+    """
+    with xr.open_dataset(species_conc_file) as load:
+        total = tracers.sum_tracers(load, "SpeciesConc_CH4_R", no_regions)
+        return total.transpose("time", "lev", "lat", "lon").values * 1e9
+
+def stencil_std(field, steps, flat_index):
+    """ The standard deviation (ddof 0, as xarray's groupby std) over the stencil boxes
+    around each observation, from a (time, lev, lat, lon) field, the time step of each
+    observation and their (n_obs, n_boxes) flat grid indices.
+    """
+    field = field.reshape(len(field), -1)
+    return field[steps[:, None], flat_index].std(axis=1)
+
+def sample_model_std(species_conc_files, obspack_obs, no_regions, stencil=adjust_obspack.SURROUNDING_BOXES):
+    """ Work out the model std around each observation, one SpeciesConc file at a time,
+    yielding the positions of the observations in that file and their model std. Each
+    observation uses the last output time at or before it (geoschem labels its averages
+    with the start time), observations before the first output are skipped.
+
+    The grid cells are looked up once for all the observations, so only one file of
+    output is read in at a time.
+    """
+    if len(species_conc_files) == 0:
+        raise IOError("No SpeciesConc files to sample")
+    grid = read_grid(species_conc_files[0])
+    flat_index = stencil_grid_index(grid, obspack_obs, stencil)
+
+    times, file_numbers, steps = species_conc_times(species_conc_files)
+    if (np.diff(times) <= np.timedelta64(0)).any():
+        raise ValueError("The SpeciesConc files don't go forward in time")
+    output_index = np.searchsorted(times, obspack_obs["time"].values, side="right") - 1
+    obs_file_numbers = np.where(output_index >= 0, file_numbers[output_index], -1)
+
+    for file_number, species_conc_file in enumerate(species_conc_files):
+        positions = np.flatnonzero(obs_file_numbers == file_number)
+        if len(positions) == 0:
+            continue
+        field = read_species_conc(species_conc_file, no_regions)
+        yield positions, stencil_std(field, steps[output_index[positions]], flat_index[positions])
+
+def stream_model_err(species_conc_files, obspack_obs, no_regions, stencil=adjust_obspack.SURROUNDING_BOXES):
+    """ Yield the monthly median model std of each site (see calc_model_err.monthly_median_std)
+    as each month of SpeciesConc files is sampled. obspack_obs needs a site_code variable
+    and site_table coordinate, as calc_model_err.rescale_and_merge_sites makes.
+    """
+    site_table = obspack_obs["site_table"].values
+    sites, months, model_stds = [], [], []
+    for positions, model_std in sample_model_std(species_conc_files, obspack_obs, no_regions, stencil):
+        sites.append(obspack_obs["site_code"].values[positions])
+        months.append(calc_model_err.month_end(obspack_obs["time"].values[positions]))
+        model_stds.append(model_std)
+
+        # later files can still have obs in the latest month
+        sites, months, model_stds = [np.concatenate(pending) for pending in (sites, months, model_stds)]
+        done = months < months.max()
+        if done.any():
+            yield calc_model_err.monthly_median_std(sites[done], site_table, months[done], model_stds[done])
+        sites, months, model_stds = [sites[~done]], [months[~done]], [model_stds[~done]]
+
+    if len(sites) > 0 and len(sites[0]) > 0:
+        yield calc_model_err.monthly_median_std(sites[0], site_table, months[0], model_stds[0])
+
+def combine_model_err(monthly_model_err, unique_sites):
+    """ Put the streamed monthly model std back together into one (site, obs_time)
+    DataArray, laid out like calc_model_err.py's output.
+    """
+    site_combined = xr.concat(list(monthly_model_err), dim="obs_time", join="outer")
+    site_combined = calc_model_err.fill_site_months(site_combined, unique_sites)
+    site_combined.name = "model_std"
+    return site_combined
+
+if __name__ == "__main__":
+    """
+    Read in config global variables
+    """
+
+    # read in variables from the config file
+    config = configparser.ConfigParser()
+    config.read("../../config.ini")
+    NO_REGIONS = int(config["inversion_constants"]["no_regions"])
+    BASE_CASE = config["inversion_constants"]["case"]
+    CASE = config["inversion_constants"]["model_err_case"]
+    AGAGE_SITES = config["inversion_constants"]["agage_sites"].split(",")
+    GEOS_OUT = Path(config["paths"]["geos_out"])
+    OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
+    SPINUP_START = pd.to_datetime(config["dates"]["spinup_start"])
+    PERTURB_START = pd.to_datetime(config["dates"]["perturb_start"])
+    FINAL_END = pd.to_datetime(config["dates"]["final_end"])
+
+    # the surrounding boxes, can also be "levels" to add the levels above and below
+    stencil = adjust_obspack.SURROUNDING_BOXES
+    if len(sys.argv) > 1 and sys.argv[1] == "levels":
+        stencil = adjust_obspack.make_stencil(altitudes=(0.0, -500.0, 500.0))
+
+    # read in the (not adjusted) observations
+    print("Reading in obs...")
+    obspack_obs = process_geos_output.read_obs(OBSPACK_DIR, SPINUP_START, FINAL_END, FINAL_END)
+    list_of_sites, unique_sites = process_geos_output.find_unique_sites(obspack_obs)
+    obspack_obs["site"] = (("obs"), np.array(list_of_sites))
+
+    # only baseline obs (so no aircraft) in the perturbation period, as in calc_model_err.py
+    agage_baseline_dict = obs_baseline.make_agage_baseline_dict(config)
+    obspack_obs = calc_model_err.select_baseline(obspack_obs, agage_baseline_dict, PERTURB_START, FINAL_END)
+    wanted = calc_model_err.perturbation_baseline(obspack_obs["time"].values, obspack_obs["baseline"].values,
+                                                  PERTURB_START)
+    obspack_obs = obspack_obs.isel(obs=np.flatnonzero(wanted))
+
+    # combine NOAA sites and AGAGE sites where we have AGAGE data, on the site codes
+    codes, unique_sites = calc_model_err.merge_agage_sites(*process_geos_output.site_table_codes(obspack_obs["site"].values),
+                                                           AGAGE_SITES)
+    obspack_obs["site_code"] = (("obs"), codes)
+    obspack_obs = obspack_obs.assign_coords(site_table=unique_sites)
+
+    # sample the base run output month by month
+    print("Sampling base run...")
+    monthly_model_err = []
+    for month_model_err in stream_model_err(species_conc_files(GEOS_OUT / BASE_CASE), obspack_obs, NO_REGIONS + 1,
+                                            stencil):
+        print(month_model_err["obs_time"].values)
+        monthly_model_err.append(month_model_err)
+    site_combined = combine_model_err(monthly_model_err, unique_sites)
+
+    # save in the same place as calc_model_err.py
+    (GEOS_OUT / CASE).mkdir(parents=True, exist_ok=True)
+    site_combined.to_netcdf(GEOS_OUT / CASE / "model_err.nc")
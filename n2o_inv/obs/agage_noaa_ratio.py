@@ -3,8 +3,11 @@
 """
 This script works out how to rescale the AGAGE observations to be on the same scale as the NOAA observations.
 """
+from concurrent.futures import ProcessPoolExecutor
 import configparser
+import multiprocessing
 from pathlib import Path
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -12,7 +15,85 @@ import pandas as pd
 import xarray as xr
 
 from n2o_inv.intermediates import process_geos_output
-    
+
+# NOAA obs within this time of an AGAGE obs are compared to it
+MATCH_WINDOW = np.timedelta64(15, "m")
+
+def window_bounds(sorted_times, times, half_width):
+    """ For each time, the start and stop indices of the sorted_times strictly within
+    half_width of it.
+    """
+    starts = np.searchsorted(sorted_times, times - half_width, side="right")
+    stops = np.searchsorted(sorted_times, times + half_width, side="left")
+    return starts, np.maximum(starts, stops)
+
+def window_nanmean(sorted_times, values, times, half_width):
+    """ For each time, the mean of the values (ignoring nans) whose sorted_times are
+    strictly within half_width of it. nan where there are none.
+    """
+    starts, stops = window_bounds(sorted_times, times, half_width)
+
+    # running sums, so each window is the difference of two of them
+    not_nan = ~np.isnan(values)
+    cum_values = np.concatenate([[0.], np.cumsum(np.where(not_nan, values, 0.))])
+    cum_counts = np.concatenate([[0], np.cumsum(not_nan)])
+
+    counts = cum_counts[stops] - cum_counts[starts]
+    sums = cum_values[stops] - cum_values[starts]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def match_noaa(agage_site, noaa_site, half_width=MATCH_WINDOW):
+    """ Add the mean of the NOAA obs within half_width of each AGAGE obs, and the ratio
+    of the AGAGE to the NOAA value.
+
+    This doesn't account for the fact a lot of AGAGE observations are not baseline,
+    though if there is a NOAA measurement within 15mins this implies the measurement is of
+    baseline air. Keeping the non-baseline measurements also doesn't matter as they should
+    both be measuring the same concentration anyway (ideally, assuming it doesn't change
+    much in 15mins).
+    """
+    noaa_order = np.argsort(noaa_site["time"].values, kind="stable")
+    noaa_value = window_nanmean(noaa_site["time"].values[noaa_order],
+                                noaa_site["value"].values[noaa_order].astype(np.double),
+                                agage_site["time"].values, half_width)
+
+    agage_site = agage_site.copy()
+    agage_site["noaa_value"] = (agage_site["value"].dims, noaa_value)
+    # store ratio of values
+    agage_site["agage-noaa_ratio"] = agage_site["value"] / agage_site["noaa_value"]
+    return agage_site
+
+def site_obs(obspack_obs, site_names, site):
+    """ The AGAGE and NOAA surface obs at a site.
+    """
+    agage_site = obspack_obs.isel(obs=np.flatnonzero(site_names == site.lower() + "AGAGEsurf"))
+    noaa_site = obspack_obs.isel(obs=np.flatnonzero(site_names == site.lower() + "NOAAsurf"))
+    return agage_site, noaa_site
+
+# set in each worker process, so the obs aren't pickled for every site
+_match_site_state = {}
+
+def _init_match_site_worker(obspack_obs, site_names):
+    _match_site_state["obspack_obs"] = obspack_obs
+    _match_site_state["site_names"] = site_names
+
+def _match_site_worker(site):
+    return match_noaa(*site_obs(_match_site_state["obspack_obs"], _match_site_state["site_names"], site))
+
+def match_sites(obspack_obs, site_names, sites, n_workers=1):
+    """ Match the NOAA obs to the AGAGE obs at each site, returning a list of datasets
+    in the order of sites. With n_workers > 1 the sites are matched by a pool of worker
+    processes.
+    """
+    if n_workers > 1:
+        # forked workers share the obs rather than each getting a pickled copy
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_match_site_worker,
+                                 initargs=(obspack_obs, site_names)) as executor:
+            return list(executor.map(_match_site_worker, sites))
+    return [match_noaa(*site_obs(obspack_obs, site_names, site)) for site in sites]
+
 
 if __name__ == "__main__":
     # read in variables from the config file
@@ -22,62 +103,26 @@ if __name__ == "__main__":
     OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
     SPINUP_START = pd.to_datetime(config["dates"]["spinup_start"])
     FINAL_END = pd.to_datetime(config["dates"]["final_end"])
-    
-    agage_site_store = []
+
+    # number of processes to match the sites with
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+    # read in observations
+    print("Reading in obs...")
+    obspack_obs = process_geos_output.read_obs(OBSPACK_DIR, SPINUP_START,
+                                               FINAL_END, FINAL_END)
+
+    print("Finding unique sites...")
+    list_of_sites, unique_sites = process_geos_output.find_unique_sites(obspack_obs)
+    site_names = np.array(list_of_sites)
 
     # look at rescaling AGAGE
-    for site in AGAGE_SITES:
-        # this is very slow so use previous run if available
-        site_filename = OBSPACK_DIR / f"agage_noaa_scaling/{site}.nc"
-        if site_filename.is_file():
-            with xr.open_dataset(site_filename) as load:
-                agage_site = load.load()
-        else:
-            # read in observations
-            print("Reading in obs...")
-            obspack_obs = process_geos_output.read_obs(OBSPACK_DIR, SPINUP_START, 
-                                                       FINAL_END, FINAL_END)
-
-            print("Finding unique sites...")
-            list_of_sites, unique_sites = process_geos_output.find_unique_sites(obspack_obs)
-            obspack_obs["site"] = (("obs"), np.array(list_of_sites))
-
-            # select desired site in AGAGE and NOAA network
-            print(f"Extracting {site} obs...")
-            agage_site = obspack_obs.where(obspack_obs["site"] == site.lower() + "AGAGEsurf", drop=True)
-            noaa_site = obspack_obs.where(obspack_obs["site"] == site.lower() + "NOAAsurf", drop=True)
-
-            # create storage for match data values
-            agage_site["noaa_value"] = xr.full_like(agage_site["value"], np.nan, dtype=np.double)
-
-            # iterate through each observation at the site
-            # select NOAA obs within 15mins of AGAGE obs
-            # this doesn't account for the fact a lot of AGAGE observations are not baseline,
-            # though if there is a NOAA measurement within 15mins this implies the measurement is of 
-            # baseline air. Keeping the non-baseline measurements also doesn't matter as they should
-            # both be measuring the same concentration anyway (ideally, assuming it doesn't change 
-            # much in 15mins). 
-            for obs in range(len(agage_site["obs"])):
-                # select NOAA obs within 15mins of AGAGE obs
-                time_diff = abs((agage_site["time"][obs] - noaa_site["time"]) / 1E9).astype(int)
-                close_times = time_diff < (15 * 60)
-
-                if any(close_times):
-                    # take mean if multiple values
-                    agage_site["noaa_value"][obs] = noaa_site.where(close_times, drop=True)["value"].mean()
-
-            # store ratio of values
-            agage_site["agage-noaa_ratio"] = agage_site["value"] / agage_site["noaa_value"]
-
-            # save for later
-            agage_site.to_netcdf(site_filename)
-
-
-        # plot
-        agage_site.plot.scatter("time", "agage-noaa_ratio")
+    print("Matching AGAGE and NOAA obs...")
+    agage_site_store = match_sites(obspack_obs, site_names, AGAGE_SITES, n_workers)
 
-        # store
-        agage_site_store.append(agage_site)
+    # plot
+    for agage_site in agage_site_store:
+        agage_site.plot.scatter("time", "agage-noaa_ratio")
 
     # combine all sites together
     agage_network = xr.merge(agage_site_store)
@@ -91,8 +136,9 @@ if __name__ == "__main__":
     plt.show()
     plt.close()
 
-# work out mean ratio over time for each site
-ratio = agage_network["agage-noaa_ratio"].to_dataframe().mean()
-print(ratio)
-# save
-ratio.to_csv(OBSPACK_DIR / f"agage_noaa_scaling/agage_over_noaa_ratio.csv")
+    # work out mean ratio over time for each site
+    ratio = agage_network["agage-noaa_ratio"].to_dataframe().mean()
+    print(ratio)
+    # save
+    (OBSPACK_DIR / "agage_noaa_scaling").mkdir(parents=True, exist_ok=True)
+    ratio.to_csv(OBSPACK_DIR / f"agage_noaa_scaling/agage_over_noaa_ratio.csv")
@@ -11,12 +11,14 @@ import numpy as np
 
 from acrg.obs import read
 
+from n2o_inv.obs import obs_registry
+
 """ 
 Define useful functions
 """
 
-def dt2cal(dt):
-    """ Convert array of datetime64 to a calendar list of year, month, day, hour,
+def dt2cal_array(dt):
+    """ Convert array of datetime64 to a calendar array of year, month, day, hour,
     minute, seconds with these quantites indexed on the last axis.
 
     Parameters
@@ -26,8 +28,8 @@ def dt2cal(dt):
 
     Returns
     -------
-    cal : float list (..., 6)
-        calendar list with last axis representing year, month, day, hour,
+    cal : float array (..., 6)
+        calendar array with last axis representing year, month, day, hour,
         minute, second
     """
 
@@ -42,10 +44,14 @@ def dt2cal(dt):
     out[..., 4] = (dt - h).astype("m8[m]") # minute
     out[..., 5] = (dt - m).astype("m8[s]") # second
 
-    out = out.tolist()
-
     return out
 
+def dt2cal(dt):
+    """ Convert array of datetime64 to a calendar list of year, month, day, hour,
+    minute, seconds with these quantites indexed on the last axis (see dt2cal_array).
+    """
+    return dt2cal_array(dt).tolist()
+
 def create_obspack_id(site, year, month, day, identifier):
     """ Make an obspack id for each observation, following the pattern in the NOAA data.
     """
@@ -53,6 +59,21 @@ def create_obspack_id(site, year, month, day, identifier):
     whole_string = f"obspack_multi-species_1_AGAGEInSitu_v1.0_{date}~n2o_{site.lower()}_surface-insitu_1_agage_Event~{identifier}"
     return whole_string.encode()
 
+def create_obspack_ids(site, year, month, day, identifier):
+    """ Make the obspack ids for whole arrays of observations at one site, following
+    the pattern in the NOAA data (see create_obspack_id).
+    """
+    year = np.asarray(year).astype(int).astype(str)
+    month = np.char.zfill(np.asarray(month).astype(int).astype(str), 2)
+    day = np.char.zfill(np.asarray(day).astype(int).astype(str), 2)
+    identifier = np.asarray(identifier).astype(str)
+
+    date = np.char.add(np.char.add(np.char.add(np.char.add(year, "-"), month), "-"), day)
+    whole_string = np.char.add(np.char.add("obspack_multi-species_1_AGAGEInSitu_v1.0_", date),
+                               f"~n2o_{site.lower()}_surface-insitu_1_agage_Event~")
+    # encoding sizes the byte strings to the longest id, as np.array of the ids would
+    return np.char.encode(np.char.add(whole_string, identifier))
+
 def create_noaa_style_flag(status_flag):
     """ Make a NOAA style flag (a 3-character string).
 
@@ -65,6 +86,12 @@ def create_noaa_style_flag(status_flag):
         first_char = "a"
 
     return f"{first_char}..".encode()
+
+def create_noaa_style_flags(status_flag):
+    """ Make NOAA style flags for a whole array of AGAGE status flags (see
+    create_noaa_style_flag).
+    """
+    return np.where(np.asarray(status_flag) == 0, b"...", b"a..")
     
 def datetime_to_unix(array):
     """ Convert datetime to unix time.
@@ -81,6 +108,7 @@ if __name__ == "__main__":
     config.read(Path(__file__).parent.parent.parent / 'config.ini')
     AGAGE_SITES = config["inversion_constants"]["agage_sites"].split(",")
     OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
+    RAW_OBSPACK_DIR = Path(config["paths"]["raw_obspack_dir"])
     SPINUP_START = config["dates"]["spinup_start"]
     FINAL_END = config["dates"]["final_end"]
 
@@ -93,12 +121,15 @@ if __name__ == "__main__":
     Format AGAGE data so it looks more like NOAA obspack
     """
 
-    # keep track of number of observations so that each obs gets a unique identifier
-    total_obs = 0
+    # each year of each site gets its own obs numbers from the registry, and obs that are
+    # new (including reprocessed ones) get new numbers, so extending the run to a longer
+    # time period doesn't change the obspack numbers of the obs that were already there
+    # the NOAA obspack numbers are reserved first so they aren't given out
+    registry_file = obs_registry.obs_registry_file(OBSPACK_DIR)
+    obs_registry.reserve_noaa_obspacks(registry_file, RAW_OBSPACK_DIR, OBSPACK_DIR / "raw_obspack_cache")
 
     # iterate through each site, format, and save
-    # use j so can extend runs to longer time period without ruining obspack numbers
-    for j, site in enumerate(AGAGE_SITES):
+    for site in AGAGE_SITES:
         print(site)
 
         # rename to match NOAA
@@ -109,7 +140,14 @@ if __name__ == "__main__":
         no_obs = len(agage_obs[site][0]["time"])
 
         # sort out coords
-        agage_obs[site][0] = agage_obs[site][0].assign_coords({"obs": (("time"), np.arange(total_obs, total_obs + no_obs))})
+        obs_times = datetime_to_unix(agage_obs[site][0]["time"].values)
+        obs_years = agage_obs[site][0]["time"].dt.year.values
+        obs_numbers = np.empty(no_obs, dtype=np.int64)
+        for year in np.unique(obs_years):
+            in_year = np.flatnonzero(obs_years == year)
+            obs_numbers[in_year] = obs_registry.allocate_growing(registry_file, f"AGAGE_{site}", str(year),
+                                                                 obs_times[in_year])
+        agage_obs[site][0] = agage_obs[site][0].assign_coords({"obs": (("time"), obs_numbers)})
         agage_obs[site][0] = agage_obs[site][0].swap_dims({"time":"obs"})
         agage_obs[site][0] = agage_obs[site][0].reset_coords()
 
@@ -117,35 +155,30 @@ if __name__ == "__main__":
         # not really the same though, so be careful
         # integration flag doesn't indicate data quality
         # all status flags are 0?
-        qcflag = [create_noaa_style_flag(agage_obs[site][0]["status_flag"][i].values) for i in range(no_obs)]
-        agage_obs[site][0]["qcflag"] = (("obs"), np.array(qcflag))
+        qcflag = create_noaa_style_flags(agage_obs[site][0]["status_flag"].values)
+        agage_obs[site][0]["qcflag"] = (("obs"), qcflag)
         agage_obs[site][0] = agage_obs[site][0].drop_vars(["status_flag", "integration_flag"])
 
         # calculate measurement height
         station_alt = agage_obs[site][0].station_height_masl + float(agage_obs[site][0].inlet_magl[:-1])
         
         # measurement location
-        agage_obs[site][0]["altitude"] = (("obs"), np.array([station_alt] * no_obs))
-        agage_obs[site][0]["latitude"] = (("obs"), np.array([agage_obs[site][0].station_latitude] * no_obs))
-        agage_obs[site][0]["longitude"] = (("obs"), np.array([agage_obs[site][0].station_longitude] * no_obs))
+        agage_obs[site][0]["altitude"] = (("obs"), np.full(no_obs, station_alt))
+        agage_obs[site][0]["latitude"] = (("obs"), np.full(no_obs, agage_obs[site][0].station_latitude))
+        agage_obs[site][0]["longitude"] = (("obs"), np.full(no_obs, agage_obs[site][0].station_longitude))
 
 
         # time components
-        agage_obs[site][0]["time_components"] = (("obs", "calendar_components"), dt2cal(agage_obs[site][0]["time"].values))
+        time_components = dt2cal_array(agage_obs[site][0]["time"].values)
+        agage_obs[site][0]["time_components"] = (("obs", "calendar_components"), time_components)
 
         # make time into unix time
         agage_obs[site][0]["time"] = (("obs"), datetime_to_unix(agage_obs[site][0]["time"].values))
 
         # obspack_id
-        obspack_id = [create_obspack_id(site, 
-                                        agage_obs[site][0]["time_components"][i][0].values,
-                                        agage_obs[site][0]["time_components"][i][1].values,
-                                        agage_obs[site][0]["time_components"][i][2].values,
-                                        (111111111 * (j + 1)) + i) for i in range(no_obs)]  # hacky way to create unique identifier
-        agage_obs[site][0]["obspack_id"] = (("obs"), np.array(obspack_id))
-
-        # keep track of number of observations so that each obs gets a unique identifier
-        total_obs += no_obs
+        obspack_id = create_obspack_ids(site, time_components[:, 0], time_components[:, 1], time_components[:, 2],
+                                        obs_numbers)
+        agage_obs[site][0]["obspack_id"] = (("obs"), obspack_id)
 
         # save
         agage_obs[site][0].to_netcdf(OBSPACK_DIR / f"AGAGE_raw/n2o_{site.lower()}_surface-insitu_1_agage_Event.nc") # still depends on BP1 file structure
@@ -3,28 +3,34 @@
 """
 This script formats all the obspack style observations into a format that GEOSChem can use.
 """
+from concurrent.futures import ProcessPoolExecutor
 import configparser
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
 
 import numpy as np
 import pandas as pd
 from pathlib import Path
 import xarray as xr
 
+from n2o_inv.obs import obs_cache
+from n2o_inv.utils import instrument
+
+# the NOAA obspack releases that are used
+NOAA_SURFACE_RELEASE = "obspack_multi-species_1_CCGGSurfaceFlask_v2.0_2021-02-09"
+NOAA_AIRCRAFT_RELEASE = "obspack_multi-species_1_CCGGAircraftFlask_v2.0_2021-02-09"
+NOAA_OBSPACK_RELEASES = (NOAA_SURFACE_RELEASE, NOAA_AIRCRAFT_RELEASE)
+
+# the global attribute the fingerprint of the obs in each obspack file is saved in
+FINGERPRINT_ATTR = "obs_fingerprint"
+
 """ 
 Define useful functions
 """
 
-def date_mask(df, date):
-    """ Create a mask that only includes a specific date.
-    """
-    year_mask = (df["time_components"][:, 0] == date.year)
-    month_mask = (df["time_components"][:, 1] == date.month)
-    day_mask = (df["time_components"][:, 2] == date.day)
-
-    year_and_month_mask = np.logical_and(year_mask, month_mask)
-    date_mask = np.logical_and(year_and_month_mask, day_mask)
-    return date_mask
-
 def preprocess(xr_df):
     """ Process the NOAA obspack before it can be read into xarray. 
     This includes a monotonically increasing coordinate, and only
@@ -47,13 +53,19 @@ def preprocess(xr_df):
     xr_df = xr_df[wanted_var]
     return xr_df
 
-def read_noaa_obspack(obspack_folder):
-    """ Create a list of the N2O files, preprocess, and combine into a single xarray object.
+def noaa_obspack_files(obspack_folder):
+    """ List the N2O files in a NOAA obspack release.
     """
-    # Make a list of the N2O files
     obspack_dir = obspack_folder / "data/nc" 
     n2o_files = list(obspack_dir.glob("n2o_*"))
     n2o_files.sort()
+    return n2o_files
+
+def read_noaa_obspack(obspack_folder):
+    """ Create a list of the N2O files, preprocess, and combine into a single xarray object.
+    """
+    # Make a list of the N2O files
+    n2o_files = noaa_obspack_files(obspack_folder)
 
     # Read into xarray
     with xr.open_mfdataset(n2o_files, preprocess=preprocess, decode_times=False) as load:
@@ -61,27 +73,225 @@ def read_noaa_obspack(obspack_folder):
     
     return noaa_obspack_data
 
-def geoschem_date_mask(obspack_data, date):
-    """ Create a mask that runs from 23.55 for 24h, because geoschem timestep is 10min.
+def obspack_release_fingerprint(obspack_folder):
+    """ Identify a NOAA obspack release by its name and the size and modification time of
+    each of its N2O files.
+    """
+    files = {}
+    for n2o_file in noaa_obspack_files(obspack_folder):
+        stat = n2o_file.stat()
+        files[n2o_file.name] = [stat.st_size, stat.st_mtime_ns]
+    return {"release": obspack_folder.name, "files": files}
+
+def read_noaa_obspack_cached(obspack_folder, cache_root, variables=None):
+    """ Read a NOAA obspack release through a columnar cache in cache_root, making (or
+    remaking) the cache with read_noaa_obspack if the release has changed. The columns
+    are memory mapped, and only those in variables (default all) are loaded.
+    """
+    cache_dir = cache_root / obspack_folder.name
+    source = obspack_release_fingerprint(obspack_folder)
+    if not obs_cache.cache_is_current(cache_dir, source):
+        print(f"Caching {obspack_folder.name}...")
+        cache_root.mkdir(parents=True, exist_ok=True)
+        obs_cache.write_obs_cache(read_noaa_obspack(obspack_folder), cache_dir, source)
+    return obs_cache.load_obs_cache(cache_dir, variables=variables)
+
+def time_in_seconds(times):
+    """ Obspack times as seconds since 1970, whether or not they have been decoded.
+    """
+    times = np.asarray(times)
+    if times.dtype.kind == "M":
+        return times.astype("datetime64[s]").astype(np.int64)
+    return times
+
+def geoschem_day_bounds(times, dates):
+    """ Find the start and stop index of each geoschem day (23.55 the day before up to 23.55)
+    in a sorted array of times, with one searchsorted over the times.
+    """
+    times = time_in_seconds(times)
+    if (np.diff(times) < 0).any():
+        raise ValueError("obspack times must be sorted")
+
+    day_starts = pd.DatetimeIndex(dates) - pd.Timedelta(5, "min")
+    edges = ((day_starts - pd.Timestamp("1970-01-01")) // pd.Timedelta(1, "s")).to_numpy()
+    starts = np.searchsorted(times, edges, side="left")
+    stops = np.searchsorted(times, edges + 24 * 60 * 60, side="left")
+    return starts, stops
+
+def pad_obspack_id(obspack_ids, width=200):
+    """ Pad all the obspack ids with spaces to a fixed width, as geoschem can't read the
+    file otherwise. Ids that are already longer are left alone.
+    """
+    obspack_ids = np.asarray(obspack_ids).astype(bytes)
+    if obspack_ids.dtype.itemsize <= width:
+        return np.char.ljust(obspack_ids, width)
+
+    padded = obspack_ids.copy()
+    short = np.char.str_len(obspack_ids) < width
+    padded[short] = np.char.ljust(obspack_ids[short], width)
+    return padded
+
+def to_netcdf_atomic(ds, filename, **kwargs):
+    """ Save a dataset to netcdf via a temporary file, so an interrupted run never leaves
+    half a file behind.
     """
-    late_mask = np.logical_and(obspack_data["time_components"][:,3] >= 23,
-                            obspack_data["time_components"][:,4] >= 55)
+    tmp_filename = filename.with_name(f".{filename.name}.tmp{os.getpid()}")
+    try:
+        ds.to_netcdf(tmp_filename, **kwargs)
+        os.replace(tmp_filename, filename)
+    finally:
+        if tmp_filename.exists():
+            tmp_filename.unlink()
+
+def daily_obspack_filename(out_dir, date):
+    """ The name of the geoschem obspack file for a day.
+    """
+    return out_dir / f"obspack_n2o.{date.strftime('%Y%m%d')}.nc"
 
-    # select obs from day before
-    day_before_mask = date_mask(obspack_data, date - pd.Timedelta(1, "D"))
-    late_day_before = np.logical_and(day_before_mask, late_mask)
-    
-    # select obs from that day
-    that_day_mask = date_mask(obspack_data, date)
-    
-    # remove obs that sample from next day
-    late_that_day = np.logical_and(that_day_mask, late_mask)
-    
-    # combine masks
-    combined_2masks = np.logical_or(late_day_before, that_day_mask)
-    combined_3masks = np.logical_and(combined_2masks, ~late_that_day)
+def obspack_fingerprint(obspack_date):
+    """ A sha256 hash of the variables, values and attributes of some obs, saved in each
+    obspack file so a rerun can tell whether the file already has those obs.
+    """
+    sha256 = hashlib.sha256()
+    for name in sorted(obspack_date.variables):
+        variable = obspack_date.variables[name]
+        values = np.ascontiguousarray(variable.values)
+        if values.dtype.kind == "O":
+            values = values.astype(str)
+        sha256.update(json.dumps([name, variable.dims, values.dtype.str, values.shape, variable.attrs],
+                                 sort_keys=True, default=str).encode())
+        sha256.update(values.tobytes())
+    sha256.update(json.dumps(obspack_date.attrs, sort_keys=True, default=str).encode())
+    return sha256.hexdigest()
+
+def saved_fingerprint(filename):
+    """ The fingerprint saved in an obspack file, or None if it doesn't have one (e.g. it
+    was made before fingerprints were saved).
+    """
+    with xr.open_dataset(filename, decode_cf=False) as load:
+        return load.attrs.get(FINGERPRINT_ATTR)
 
-    return combined_3masks
+def write_obspack_file(obspack_date, filename, overwrite=False):
+    """ Save some obs with their fingerprint, returning "written", or "skipped" if the file
+    already has the same obs (unless overwrite).
+    """
+    fingerprint = obspack_fingerprint(obspack_date)
+    if not overwrite and filename.exists() and saved_fingerprint(filename) == fingerprint:
+        return "skipped"
+    to_netcdf_atomic(obspack_date.assign_attrs({FINGERPRINT_ATTR: fingerprint}), filename)
+    return "written"
+
+def write_daily_obspack(obspack_date, filename, overwrite=False):
+    """ Save one day of obs, returning "written", "skipped" if the file already has
+    these obs, or "empty" if there are no obs that day.
+    """
+    if len(obspack_date["obs"]) == 0:
+        return "empty"
+    return write_obspack_file(obspack_date, filename, overwrite)
+
+# obs shared with the write_daily_obspacks worker processes
+_write_daily_state = {}
+
+def _init_write_daily_worker(obspack_data, out_dir, overwrite):
+    _write_daily_state.update(obspack_data=obspack_data, out_dir=out_dir, overwrite=overwrite)
+
+def _write_daily_worker(day):
+    date, start, stop = day
+    obspack_date = _write_daily_state["obspack_data"].isel(obs=slice(start, stop))
+    return write_daily_obspack(obspack_date, daily_obspack_filename(_write_daily_state["out_dir"], date),
+                               _write_daily_state["overwrite"])
+
+def write_daily_obspacks(obspack_data, dates, out_dir, n_workers=1, overwrite=False):
+    """ Write a geoschem obspack file for each day with obs, returning the number of files
+    written and the number skipped because they already have that day's obs (unless
+    overwrite). The obspack ids should already be padded. With n_workers > 1 the files are written by a
+    pool of worker processes.
+    """
+    starts, stops = geoschem_day_bounds(obspack_data["time"].values, dates)
+    days = list(zip(dates, starts, stops))
+
+    if n_workers > 1:
+        # forked workers share the obs rather than each getting a pickled copy
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_write_daily_worker,
+                                 initargs=(obspack_data, out_dir, overwrite)) as executor:
+            results = list(executor.map(_write_daily_worker, days, chunksize=16))
+    else:
+        results = [write_daily_obspack(obspack_data.isel(obs=slice(start, stop)),
+                                       daily_obspack_filename(out_dir, date), overwrite)
+                   for date, start, stop in days]
+
+    return results.count("written"), results.count("skipped")
+
+def constant_met_obspacks(obspack_data, dates, constant_met_year):
+    """ Make the obspacks for the constant met runs, which repeat constant_met_year's met,
+    yielding (no_years_constant, filename, obs) for each file. obspack_data must be sorted
+    by time and dates must be consecutive days.
+
+    The year of every obs is set to constant_met_year in one go. Each day's times move
+    back by its number of years since constant_met_year. 29th February is folded into
+    the 28th: a day whose last obs is on the 29th is merged with the last day that ended
+    on the 28th and saved as the 28th.
+    """
+    starts, stops = geoschem_day_bounds(obspack_data["time"].values, dates)
+    if len(dates) == 0 or stops[-1] == starts[0]:
+        return
+    first, last = starts[0], stops[-1]
+
+    # change the year (and 29th Feb) of all the obs at once
+    constant_met = obspack_data.isel(obs=slice(first, last)).copy(deep=True)
+    time_components = constant_met["time_components"].values
+    last_day_feb28 = (time_components[:, 1] == 2) & (time_components[:, 2] == 28)
+    feb29 = (time_components[:, 1] == 2) & (time_components[:, 2] == 29)
+    time_components[:, 0] = np.float64(constant_met_year)
+    time_components[feb29, 2] = 28
+
+    # move the times back, one DateOffset for each year
+    no_years_constant = np.asarray(pd.DatetimeIndex(dates).year) - constant_met_year
+    obs_years_constant = np.repeat(no_years_constant, stops - starts)
+    times = constant_met["time"].values
+    new_times = np.empty(len(times), dtype=np.float64)
+    for years in np.unique(obs_years_constant):
+        year_mask = obs_years_constant == years
+        time_minus_year = pd.to_datetime(times[year_mask], unit="s") - pd.offsets.DateOffset(years=years)
+        new_times[year_mask] = (time_minus_year - pd.to_datetime("1970-01-01")).total_seconds()
+    constant_met["time"] = constant_met["time"].copy(data=new_times)
+
+    # split into days, folding 29th Feb into the 28th
+    constant_met_files = {}
+    obspack_date_0228 = None
+    for date, years, start, stop in zip(dates, no_years_constant, starts - first, stops - first):
+        if stop == start:
+            continue
+        obspack_date = constant_met.isel(obs=slice(start, stop))
+        leap_year = feb29[stop - 1]
+
+        if last_day_feb28[stop - 1]:
+            obspack_date_0228 = obspack_date
+        if leap_year:
+            if obspack_date_0228 is None:
+                raise ValueError(f"no 28th February obs to fold {date.strftime('%Y-%m-%d')} into")
+            obspack_date = obspack_date.merge(obspack_date_0228)
+            filename = f"obspack_n2o.{constant_met_year}{date.strftime('%m')}28.nc"
+        else:
+            filename = f"obspack_n2o.{constant_met_year}{date.strftime('%m%d')}.nc"
+        # a merged 29th Feb replaces the 28th
+        constant_met_files[(years, filename)] = obspack_date
+
+    for (years, filename), obspack_date in constant_met_files.items():
+        yield years, filename, obspack_date
+
+def write_constant_met_obspacks(obspack_data, dates, constant_met_year, out_dir, overwrite=False):
+    """ Write the constant met obspacks into out_dir/su_XX, where XX is the number of years
+    since constant_met_year, returning the number of files written and the number skipped
+    because they already have those obs (unless overwrite), as write_daily_obspacks.
+    """
+    results = []
+    for years, filename, obspack_date in constant_met_obspacks(obspack_data, dates, constant_met_year):
+        constant_met_path = out_dir / f"su_{years:02d}"
+        constant_met_path.mkdir(parents=True, exist_ok=True)
+        results.append(write_obspack_file(obspack_date, constant_met_path / filename, overwrite))
+    return results.count("written"), results.count("skipped")
 
 
 if __name__ == "__main__":
@@ -89,6 +299,13 @@ if __name__ == "__main__":
     Read in config global variables
     """
 
+    # commandline arguments
+    # --overwrite remakes files even if they already have the same obs
+    overwrite = "--overwrite" in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    # number of daily files to write at once, optional
+    n_workers = int(args[0]) if len(args) > 0 else 1
+
     # read in variables from the config file
     config = configparser.ConfigParser()
     config.read("../../config.ini")
@@ -105,59 +322,63 @@ if __name__ == "__main__":
     """
 
     # Read in NOAA obs
-    noaa_surface_obspack_data = read_noaa_obspack(RAW_OBSPACK_DIR / "obspack_multi-species_1_CCGGSurfaceFlask_v2.0_2021-02-09")
-    noaa_aircraft_obspack_data = read_noaa_obspack(RAW_OBSPACK_DIR / "obspack_multi-species_1_CCGGAircraftFlask_v2.0_2021-02-09")
-
-    # add in 2020 NOAA data
-    with xr.open_dataset(OBSPACK_DIR / f"noaa_2020_obs.nc") as load:
-        noaa_2020_data = load.load() 
-    noaa_surface_obspack_data = xr.merge([noaa_surface_obspack_data, noaa_2020_data])
-
-    # Read in AGAGE obs
-    agage_obs_dir = OBSPACK_DIR / "AGAGE_raw"
-    agage_n2o_files = list(agage_obs_dir.glob("n2o_*"))
-    agage_n2o_files.sort()
-
-    with xr.open_mfdataset(agage_n2o_files, decode_times=False) as load:
-        agage_obspack_data = load.load() 
-
-    # add in network variable
-    noaa_surface_obspack_data["network"] = (("obs"), np.array(["NOAAsurf"] * len(noaa_surface_obspack_data["obs"])))
-    noaa_aircraft_obspack_data["network"] = (("obs"), np.array(["NOAAair"] * len(noaa_aircraft_obspack_data["obs"])))
-    agage_obspack_data["network"] = (("obs"), np.array(["AGAGEsurf"] * len(agage_obspack_data["obs"])))
-
-    # combine the datasets
-    obspack_data = xr.merge([noaa_surface_obspack_data, noaa_aircraft_obspack_data, agage_obspack_data])
+    with instrument.stage("read_obspacks"):
+        noaa_surface_obspack_data = read_noaa_obspack_cached(RAW_OBSPACK_DIR / NOAA_SURFACE_RELEASE,
+                                                             OBSPACK_DIR / "raw_obspack_cache")
+        noaa_aircraft_obspack_data = read_noaa_obspack_cached(RAW_OBSPACK_DIR / NOAA_AIRCRAFT_RELEASE,
+                                                              OBSPACK_DIR / "raw_obspack_cache")
+
+        # add in 2020 NOAA data
+        with xr.open_dataset(OBSPACK_DIR / f"noaa_2020_obs.nc") as load:
+            noaa_2020_data = load.load() 
+        noaa_surface_obspack_data = xr.merge([noaa_surface_obspack_data, noaa_2020_data])
+
+        # Read in AGAGE obs
+        agage_obs_dir = OBSPACK_DIR / "AGAGE_raw"
+        agage_n2o_files = list(agage_obs_dir.glob("n2o_*"))
+        agage_n2o_files.sort()
+
+        with xr.open_mfdataset(agage_n2o_files, decode_times=False) as load:
+            agage_obspack_data = load.load() 
+
+        # add in network variable
+        noaa_surface_obspack_data["network"] = (("obs"), np.array(["NOAAsurf"] * len(noaa_surface_obspack_data["obs"])))
+        noaa_aircraft_obspack_data["network"] = (("obs"), np.array(["NOAAair"] * len(noaa_aircraft_obspack_data["obs"])))
+        agage_obspack_data["network"] = (("obs"), np.array(["AGAGEsurf"] * len(agage_obspack_data["obs"])))
+
+        # combine the datasets
+        obspack_data = xr.merge([noaa_surface_obspack_data, noaa_aircraft_obspack_data, agage_obspack_data])
         
     """ 
     Adjust obspack to required GEOSChem format
     """
 
-    # How to sample model, 4 is instantaneous
-    obspack_data["CT_sampling_strategy"] = (("obs"), 
-                                            np.ones(len(obspack_data["obs"]), dtype=int) * 4)
-    obspack_data["CT_sampling_strategy"].attrs = {"_FillValue":-9,
-                                                "long_name":"model sampling strategy",
-                                                "values":"How to sample model. 1=4-hour avg; 2=1-hour avg; 3=90-min avg; 4=instantaneous"}
-
-    # Remove missing data
-    missing_data_mask = obspack_data.value == -999.99
-    obspack_data = obspack_data.where(~missing_data_mask)
-    # some aircraft have missing uncertainty - replace with median value
-    obspack_data["value_unc"] = obspack_data.value_unc.fillna(obspack_data.value_unc.median())
-    # large number of missing lat/lon/alt because it looks like there are calibration sites? BLD and TST
-    obspack_data = obspack_data.dropna("obs") 
-    # drop rejection flag samples, keep the rest
-    # the second column of NOAA data is a selection flag which seems to be applied differently at different sites...
-    # we can inspect this in the observation plots and we remove sites with several pollution events anyway
-    # also its better to keep observations we maybe want so we don't have to rerun GEOSChem
-    # therefore, ignore selection flag
-    bad_data_mask = [flag.decode('utf-8')[0] == "." for flag in obspack_data.qcflag.values]
-    bad_data_mask = xr.DataArray(data=bad_data_mask, dims=["obs"], coords={"obs":obspack_data.obs})
-    obspack_data = obspack_data.where(bad_data_mask, drop=True)
-
-    # reindex so monotoically increasing
-    obspack_data = obspack_data.sortby("time").assign_coords(obs=range(0, len(obspack_data.obs)))
+    with instrument.stage("format"):
+        # How to sample model, 4 is instantaneous
+        obspack_data["CT_sampling_strategy"] = (("obs"), 
+                                                np.ones(len(obspack_data["obs"]), dtype=int) * 4)
+        obspack_data["CT_sampling_strategy"].attrs = {"_FillValue":-9,
+                                                    "long_name":"model sampling strategy",
+                                                    "values":"How to sample model. 1=4-hour avg; 2=1-hour avg; 3=90-min avg; 4=instantaneous"}
+
+        # Remove missing data
+        missing_data_mask = obspack_data.value == -999.99
+        obspack_data = obspack_data.where(~missing_data_mask)
+        # some aircraft have missing uncertainty - replace with median value
+        obspack_data["value_unc"] = obspack_data.value_unc.fillna(obspack_data.value_unc.median())
+        # large number of missing lat/lon/alt because it looks like there are calibration sites? BLD and TST
+        obspack_data = obspack_data.dropna("obs") 
+        # drop rejection flag samples, keep the rest
+        # the second column of NOAA data is a selection flag which seems to be applied differently at different sites...
+        # we can inspect this in the observation plots and we remove sites with several pollution events anyway
+        # also its better to keep observations we maybe want so we don't have to rerun GEOSChem
+        # therefore, ignore selection flag
+        bad_data_mask = [flag.decode('utf-8')[0] == "." for flag in obspack_data.qcflag.values]
+        bad_data_mask = xr.DataArray(data=bad_data_mask, dims=["obs"], coords={"obs":obspack_data.obs})
+        obspack_data = obspack_data.where(bad_data_mask, drop=True)
+
+        # reindex so monotoically increasing
+        obspack_data = obspack_data.sortby("time").assign_coords(obs=range(0, len(obspack_data.obs)))
 
     """ 
     Save GEOSChem formatted files
@@ -167,59 +388,21 @@ if __name__ == "__main__":
     # Desired times
     daily_dates = pd.date_range(SPINUP_START, FINAL_END)[:-1]
     constant_met_dates = pd.date_range(CONSTANT_END, FINAL_END)[:-1]
-    for date in daily_dates:
-        # create mask - geoschem reads 23.55 form the day before, through to 23.55 that day
-        geoschem_mask = geoschem_date_mask(obspack_data, date)
-        # Do filtering
-        obspack_date = obspack_data.where(geoschem_mask, drop=True)
-        
-        # Geoschem can't read file without this
-        for i in range(len(obspack_date["obspack_id"])):
-            obspack_date["obspack_id"][i] = obspack_date["obspack_id"][i] + b' ' * (200 - len(obspack_date["obspack_id"].values[i]))
-
-        # save file
-        if len(obspack_date["obs"]) > 0: 
-            # file for main runs
-            obspack_date.to_netcdf(OBSPACK_DIR /f"obspack_n2o.{date.strftime('%Y%m%d')}.nc")
-
-            # file for constant met runs
-            if date in constant_met_dates:
-                constant_met_year = pd.to_datetime(CONSTANT_START).year
-                no_years_constant = date.year - constant_met_year
-
-                obspack_date_copy = obspack_date.copy(deep=True)
-
-                # because we repeat 2015 met, if the year is leap year, then the emissions from Feb 29th would be lost
-                # and the emissions slightly different to the main runs. Therefore, for leap years move the emissions
-                # from 29th to 28th
-                # edit time components of emissions to correct year
-                for i in range(len(obspack_date_copy["time_components"])):
-                    # set year to 2015
-                    obspack_date_copy["time_components"][i][0] = np.float64(constant_met_year)
-                    # if Feb 29, make Feb 28 so can be combined and used for 2015
-                    if obspack_date_copy["time_components"][i][1] == 2 and obspack_date_copy["time_components"][i][2] == 29:
-                        leap_year = True
-                        obspack_date_copy["time_components"][i][2] = 28
-                    else:
-                        leap_year = False
-                # edit time of emissions to correct year (2015)
-                time_minus_year = pd.to_datetime(obspack_date_copy["time"].values, unit="s")  - pd.offsets.DateOffset(years=no_years_constant)
-                # put back into seconds since 1970
-                obspack_date_copy["time"].values = (time_minus_year - pd.to_datetime("1970-01-01")).total_seconds()
-
-                # save 28th feb for leap year combinations
-                if obspack_date["time_components"][i][1] == 2 and obspack_date["time_components"][i][2] == 28:
-                    obspack_date_0228 = obspack_date_copy.copy(deep=True)
-                # if 29th feb, combine with 28th feb
-                if leap_year:
-                    obspack_date_copy = obspack_date_copy.merge(obspack_date_0228)
-
-                # create directory if doesnt exist
-                constant_met_path = OBSPACK_DIR / f"{CONSTANT_CASE}/su_{no_years_constant:02d}"
-                constant_met_path.mkdir(parents=True, exist_ok=True)
-
-                # save final
-                if leap_year:
-                    obspack_date_copy.to_netcdf(constant_met_path / f"obspack_n2o.{constant_met_year}{date.strftime('%m')}28.nc")
-                else:
-                    obspack_date_copy.to_netcdf(constant_met_path / f"obspack_n2o.{constant_met_year}{date.strftime('%m%d')}.nc")
+
+    # Geoschem can't read file without this
+    obspack_data["obspack_id"] = (("obs"), pad_obspack_id(obspack_data["obspack_id"].values))
+
+    # geoschem reads 23.55 form the day before, through to 23.55 that day
+    # obspack_data is sorted by time, so each day is a slice
+    with instrument.stage("write_daily_files") as record:
+        written, skipped = write_daily_obspacks(obspack_data, daily_dates, OBSPACK_DIR, n_workers, overwrite)
+        print(f"Wrote {written} daily obspack files, skipped {skipped} that haven't changed")
+        record.update(written=written, skipped=skipped)
+
+    # files for constant met runs
+    with instrument.stage("write_constant_met_files") as record:
+        constant_met_year = pd.to_datetime(CONSTANT_START).year
+        written, skipped = write_constant_met_obspacks(obspack_data, constant_met_dates, constant_met_year,
+                                                       OBSPACK_DIR / CONSTANT_CASE, overwrite)
+        print(f"Wrote {written} constant met obspack files, skipped {skipped} that haven't changed")
+        record.update(written=written, skipped=skipped)
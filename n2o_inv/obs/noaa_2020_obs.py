@@ -3,17 +3,25 @@
 """
 This script formats all NOAA 2020 obs into an obspack style.
 """
+from concurrent.futures import ProcessPoolExecutor
 import configparser
+from itertools import repeat
+import re
+import sys
 
 import numpy as np
 import pandas as pd
 from pathlib import Path
-import re
 import xarray as xr
-    
-import agage_obs
-import format_obspack_geoschem
-    
+
+from n2o_inv.obs import format_obspack_geoschem, obs_registry
+
+# the columns read from the NOAA event files
+EVENT_COLUMNS = [1, 2, 3, 4, 5, 6, 11, 12, 13, 21, 22, 23]
+EVENT_NAMES = ["year", "month", "day", "hour", "minute", "second",
+               "value", "value_unc", "qcflag", "latitude", "longitude", "altitude"]
+TIME_NAMES = ["year", "month", "day", "hour", "minute", "second"]
+
 def create_obspack_id(site, year, month, day, identifier):
     """ Make an obspack id for each observation, following the pattern in the NOAA data.
     """
@@ -21,99 +29,117 @@ def create_obspack_id(site, year, month, day, identifier):
     whole_string = f"obspack_multi-species_1_CCGGSurfaceFlask_v1.0_{date}~n2o_{site.lower()}_surface-flask_1_ccgg_Event~{identifier}"
     return (whole_string).encode()
 
+def event_file_site(event_file):
+    """ The site code in the name of a NOAA event file.
+    """
+    return re.search("/n2o_(.*)_surface", str(event_file)).group(1)
+
+def read_noaa_event_file(event_file, final_time=None):
+    """ Read a NOAA event file, keeping the obs after final_time (unix time, default all).
+    The header length is read from the first line and the data from the rest, in one pass
+    through the file.
+    """
+    with open(event_file) as f:
+        # find number of header lines
+        firstline = f.readline().rstrip()
+        no_head_lines = int(re.search("# number_of_header_lines: (.*)", firstline).group(1))
+
+        # the line after the header was read in as the column names and replaced
+        # (header=no_head_lines+1), one line of which has already been read
+        site_file = pd.read_csv(f, engine="c",
+                                sep=' ', skipinitialspace=True,
+                                usecols=EVENT_COLUMNS, names=EVENT_NAMES,
+                                header=None, skiprows=no_head_lines + 1)
+
+    # time
+    time_var = pd.to_datetime(site_file[TIME_NAMES]).to_numpy()
+    site_file["time"] = format_obspack_geoschem.time_in_seconds(time_var)
+
+    # only keep data which isnt in the obspack
+    if final_time is not None:
+        site_file = site_file.loc[site_file["time"].to_numpy() > final_time].reset_index(drop=True)
+
+    site_file.insert(0, "site", event_file_site(event_file))
+    return site_file
+
+def read_noaa_event_files(event_files, final_time=None, n_workers=1):
+    """ Read the NOAA event files into one table, keeping the obs after final_time. The
+    sites stay in the order of event_files. With n_workers > 1 the files are read by a pool
+    of worker processes.
+    """
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            site_files = list(executor.map(read_noaa_event_file, event_files, repeat(final_time)))
+    else:
+        site_files = [read_noaa_event_file(event_file, final_time) for event_file in event_files]
+
+    # some sites have no data after final_time, skip these
+    site_files = [site_file for site_file in site_files if len(site_file) > 0]
+    if len(site_files) == 0:
+        return pd.DataFrame(columns=["site"] + EVENT_NAMES + ["time"])
+    return pd.concat(site_files, ignore_index=True)
+
+def allocate_event_obs_numbers(registry_file, event_table):
+    """ Obs numbers for a table of NOAA event obs, from each site's ranges in the registry.
+    Obs added to the event files since the last run (e.g. flasks analysed late) get new
+    numbers, and the obs that were already there keep theirs.
+    """
+    obs_numbers = np.empty(len(event_table), dtype=np.int64)
+    for site, rows in event_table.groupby("site", sort=False).indices.items():
+        site_times = event_table["time"].to_numpy()[rows]
+        order = np.argsort(site_times, kind="stable")
+        obs_numbers[rows[order]] = obs_registry.allocate_growing(registry_file, f"NOAA_2020_{site}",
+                                                                 format_obspack_geoschem.NOAA_SURFACE_RELEASE,
+                                                                 site_times[order])
+    return obs_numbers
+
+def noaa_event_obspack(event_table, obs_numbers):
+    """ Turn a table of NOAA event obs into an obspack style dataset, numbered by obs_numbers.
+    """
+    # obspack_id
+    obspack_id = [create_obspack_id(site, year, month, day, identifier)
+                  for site, year, month, day, identifier
+                  in zip(event_table["site"], event_table["year"], event_table["month"], event_table["day"], obs_numbers)]
+
+    site_xr = xr.Dataset({name: (("obs"), event_table[name].to_numpy())
+                          for name in ["value", "value_unc", "latitude", "longitude", "altitude", "time"]},
+                         coords={"obs": obs_numbers})
+    site_xr["qcflag"] = (("obs"), np.char.encode(event_table["qcflag"].to_numpy().astype(str)))
+    site_xr["time_components"] = (("obs", "calendar_components"), event_table[TIME_NAMES].to_numpy(dtype=float))
+    site_xr["obspack_id"] = (("obs"), np.array(obspack_id))
+    return site_xr.sortby("obs")
+
+
 if __name__ == "__main__":
-    """ 
+    """
     Read in config global variables
     """
 
     # read in variables from the config file
     config = configparser.ConfigParser()
     config.read("../../config.ini")
-    AGAGE_SITES = config["inversion_constants"]["agage_sites"].split(",")
     RAW_OBSPACK_DIR = Path(config["paths"]["raw_obspack_dir"])
     OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
 
-    # keep track of number of observations so that each obs gets a unique identifier
-    noaa_surface_obspack_data = format_obspack_geoschem.read_noaa_obspack(RAW_OBSPACK_DIR / "obspack_multi-species_1_CCGGSurfaceFlask_v2.0_2021-02-09")
-    noaa_aircraft_obspack_data = format_obspack_geoschem.read_noaa_obspack(RAW_OBSPACK_DIR / "obspack_multi-species_1_CCGGAircraftFlask_v2.0_2021-02-09")
-    max_used_obs = np.max([noaa_surface_obspack_data["obs"].max(), noaa_aircraft_obspack_data["obs"].max()])
-    total_obs = max_used_obs + 1
+    # number of processes to read the site files with
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+    # each site gets its own range of obs numbers from the registry, which also holds the
+    # obs numbers and final time of the obspacks (only read the first time they're used)
+    registry_file = obs_registry.obs_registry_file(OBSPACK_DIR)
+    noaa_obspacks = obs_registry.reserve_noaa_obspacks(registry_file, RAW_OBSPACK_DIR, OBSPACK_DIR / "raw_obspack_cache")
+    final_date = noaa_obspacks[format_obspack_geoschem.NOAA_SURFACE_RELEASE]["final_time"]
 
     # get all the NOAA surface data files
     files_dir = RAW_OBSPACK_DIR / "CCGG/surface/N2O/surface"
-    files = list(files_dir.glob('*_event.txt'))
+    files = sorted(files_dir.glob('*_event.txt'))
 
-    # store site xarray format for merging later
-    site_xr_list = []
+    # only read in data which isnt in the obspack
+    event_table = read_noaa_event_files(files, final_date, n_workers)
 
-    # iterate through each site file
-    for file in files:
-        # extract site name
-        site = re.search("/n2o_(.*)_surface", str(file)).group(1)
-
-        # find number of header lines
-        with open(file) as f:
-            firstline = f.readline().rstrip()
-        no_head_lines = int(re.search("# number_of_header_lines: (.*)", firstline).group(1))
+    # obs numbers for the data after the surface obspack release
+    obs_numbers = allocate_event_obs_numbers(registry_file, event_table)
 
-        # read in file
-        site_file = pd.read_csv(file,
-                                sep=' ', skipinitialspace=True, 
-                                usecols=[1,2,3,4,5,6,11,12,13,21,22,23], 
-                                names=["year", "month", "day", "hour", "minute", "second", 
-                                       "value", "value_unc", "qcflag", "latitude", "longitude", "altitude"],
-                                header=(no_head_lines+1))
-
-        # time
-        time_var = pd.to_datetime(site_file[["year", "month", "day", "hour", "minute", "second"]]).to_numpy()
-        unix_time_var = agage_obs.datetime_to_unix(time_var)
-        site_file["time"] = unix_time_var
-
-        # only read in data which isnt in the obspack
-        final_date = noaa_surface_obspack_data["time"][-1].values
-        site_file_2020 = site_file.loc[site_file["time"] > final_date]
-
-        # some sites have no data for 2020, skip these
-        if len(site_file_2020) == 0:
-            pass
-        else:
-            # get number of observations for the site
-            no_obs = len(site_file_2020)
-
-            # convert pandas to xarray
-            site_xr = site_file_2020.to_xarray()
-
-            # time components
-            time_var = pd.to_datetime(site_file_2020[["year", "month", "day", "hour", "minute", "second"]]).to_numpy()
-            site_xr["time_components"] = (("index", "calendar_components"), agage_obs.dt2cal(time_var))
-
-            # obspack_id
-            obspack_id = [create_obspack_id(site, 
-                                            site_file_2020["year"].values[i],
-                                            site_file_2020["month"].values[i],
-                                            site_file_2020["day"].values[i],
-                                            (111111111 * (len(AGAGE_SITES) + 2)) + i) for i in range(no_obs)]
-            site_xr["obspack_id"] = (("index"), obspack_id)
-
-            # encode qcflag
-            qcflag = [i.encode() for i in site_xr["qcflag"].values]
-            site_xr["qcflag"] = (("index"), qcflag)
-
-            # drop unneeded time data
-            site_xr = site_xr.drop(["year", "month", "day", "hour", "minute", "second"])
-
-            # sort out obs index
-            site_xr = site_xr.assign_coords({"obs": (("index"), np.arange(total_obs, total_obs + no_obs))})
-            site_xr = site_xr.swap_dims({"index":"obs"})
-            site_xr = site_xr.reset_coords()
-            site_xr = site_xr.drop("index")
-
-            # store site xarray object
-            site_xr_list.append(site_xr)
-
-            # keep track of number of observations so that each obs gets a unique identifier
-            total_obs += no_obs
-
-    # merge all the sites and save
-    all_sites = xr.merge(site_xr_list)
+    # save all the sites
+    all_sites = noaa_event_obspack(event_table, obs_numbers)
     all_sites.to_netcdf(OBSPACK_DIR / f"noaa_2020_obs.nc")
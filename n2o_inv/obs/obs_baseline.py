@@ -5,76 +5,156 @@ This script establishes which observations we want to keep.
 """
 import configparser
 from pathlib import Path
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
 import xarray as xr
 
+from n2o_inv.obs import obs_cache
+
+# sites that look visibly dodgy when plotted
+DODGY_SITES = ('abpNOAAsurf', 'balNOAAsurf', 'bmeNOAAsurf', 'bscNOAAsurf',  # too few obs
+               'bwdNOAAsurf', 'crsNOAAsurf', 'hfmNOAAsurf', 'hsuNOAAsurf', 
+               'lacNOAAsurf', 'llbNOAAsurf', 'mknNOAAsurf', 'mrcNOAAsurf', 
+               'mshNOAAsurf', 'mvyNOAAsurf', 'nebNOAAsurf', 'nwbNOAAsurf',
+               'pcoNOAAsurf', 'pocNOAAsurf', 'ptaNOAAsurf', 'tacNOAAsurf',
+               'tmdNOAAsurf', 'tpiNOAAsurf',
+               'amyNOAAsurf', 'cibNOAAsurf', 'hpbNOAAsurf', 'hunNOAAsurf',  # polluted
+               'inxNOAAsurf', 'lefNOAAsurf', 'lewNOAAsurf', 'oxkNOAAsurf',
+               'sctNOAAsurf', 'sdzNOAAsurf', 'sgpNOAAsurf', 'strNOAAsurf',
+               'tapNOAAsurf', 'utaNOAAsurf', 'wbiNOAAsurf', 'wgcNOAAsurf',
+               'wisNOAAsurf', 'wktNOAAsurf',
+               'grfNOAAsurf', 'mlsNOAAsurf', 'mscNOAAsurf', 'spfNOAAsurf', # look weird
+               'tnkNOAAsurf', 'wpcNOAAsurf',
+               'dsiNOAAsurf', 'wlgNOAAsurf', 'palNOAAsurf', 'bktNOAAsurf', # too sensitive to local emissions
+               'shmNOAAsurf', 'amtNOAAsurf')
+
+# change this when the rules in site_rule or classify_baseline change, so that saved
+# baselines (e.g. the calc_model_err.py checkpoints) are worked out again
+BASELINE_RULES_VERSION = 1
+
 def agage_baseline(df, time_vec):
     """ Interpolate baseline df to measurement times.
 
     Take only points between two baseline points in Alistair's baseline.
     """
-
-    return (df.interp(time = time_vec)["baseline_NAME"] == True).astype(int).values
-
-def raw_obs_to_baseline(obspack_obs, baseline_dict):
-    """ Create baseline variable, which is 1 for baseline, 0 for not baseline.
+    return interp_baselines(np.zeros(len(df["time"]), dtype=int), df["time"].values, df["baseline_NAME"].values,
+                            np.zeros(len(time_vec), dtype=int), np.asarray(time_vec)).astype(int)
+
+def interp_baselines(baseline_sites, baseline_times, baseline_flags, sites, times):
+    """ Interpolate the baselines of several sites to the measurement times at those sites
+    in one pass, sites being integer site codes. A measurement is baseline if it is at a
+    baseline time, or between two baseline times. Measurements outside a site's baseline
+    times, or at sites without a baseline, aren't baseline.
+    """
+    baseline_times = np.asarray(baseline_times).astype("datetime64[ns]").view(np.int64)
+    times = np.asarray(times).astype("datetime64[ns]").view(np.int64)
+
+    # sort the baselines by site and time
+    baseline_order = np.lexsort((baseline_times, baseline_sites))
+    baseline_sites = np.asarray(baseline_sites)[baseline_order]
+    baseline_times = baseline_times[baseline_order]
+    baseline_flags = (np.asarray(baseline_flags) == True)[baseline_order]
+    n_baseline = len(baseline_times)
+
+    # sort the measurements in with the baselines, with baselines first at the same time,
+    # then the number of baselines before each measurement gives the baseline at or before it
+    all_sites = np.concatenate([baseline_sites, sites])
+    all_times = np.concatenate([baseline_times, times])
+    is_measurement = np.concatenate([np.zeros(n_baseline, dtype=bool), np.ones(len(times), dtype=bool)])
+    order = np.lexsort((is_measurement, all_times, all_sites))
+    n_before = np.cumsum(~is_measurement[order])
+    before = np.empty(len(all_times), dtype=np.int64)
+    before[order] = n_before - 1
+    before = before[n_baseline:]
+    after = before + 1
+
+    # the baselines have to be at the same site
+    has_before = before >= 0
+    has_before[has_before] = baseline_sites[before[has_before]] == sites[has_before]
+    has_after = after < n_baseline
+    has_after[has_after] = baseline_sites[after[has_after]] == sites[has_after]
+
+    flags = np.zeros(len(times), dtype=bool)
+    at_baseline = has_before.copy()
+    at_baseline[has_before] = baseline_times[before[has_before]] == times[has_before]
+    flags[at_baseline] = baseline_flags[before[at_baseline]]
+    between = has_before & has_after & ~at_baseline
+    flags[between] = baseline_flags[before[between]] & baseline_flags[after[between]]
+    return flags
+
+def site_rule(site):
+    """ Which rule decides whether a site's observations are baseline.
+    """
+    if site in DODGY_SITES:
+        return "dodgy"
+    # ignore aircraft obs
+    elif "NOAAair" in site:
+        return "aircraft"
+    elif "AGAGEsurf" in site:
+        return "agage"
+    else:
+        return "default"
+
+def classify_baseline(site_codes, site_table, times, baseline_dict):
+    """ The baseline flag (True for baseline) of each observation, whose sites are integer
+    codes into site_table. Dodgy sites and aircraft aren't baseline, AGAGE sites are
+    baseline where the AGAGE baseline says so, and everything else is baseline.
     """
-    # create place to store baseline
-    obspack_obs["baseline"] = xr.zeros_like(obspack_obs["value"])
-
-    # pick a site
-    unique_sites = np.unique(obspack_obs["site"])
-
-    # sites that look visibly dodgy when plotted
-    dodgy_sites = ['abpNOAAsurf', 'balNOAAsurf', 'bmeNOAAsurf', 'bscNOAAsurf',  # too few obs
-                   'bwdNOAAsurf', 'crsNOAAsurf', 'hfmNOAAsurf', 'hsuNOAAsurf', 
-                   'lacNOAAsurf', 'llbNOAAsurf', 'mknNOAAsurf', 'mrcNOAAsurf', 
-                   'mshNOAAsurf', 'mvyNOAAsurf', 'nebNOAAsurf', 'nwbNOAAsurf',
-                   'pcoNOAAsurf', 'pocNOAAsurf', 'ptaNOAAsurf', 'tacNOAAsurf',
-                   'tmdNOAAsurf', 'tpiNOAAsurf',
-                   'amyNOAAsurf', 'cibNOAAsurf', 'hpbNOAAsurf', 'hunNOAAsurf',  # polluted
-                   'inxNOAAsurf', 'lefNOAAsurf', 'lewNOAAsurf', 'oxkNOAAsurf',
-                   'sctNOAAsurf', 'sdzNOAAsurf', 'sgpNOAAsurf', 'strNOAAsurf',
-                   'tapNOAAsurf', 'utaNOAAsurf', 'wbiNOAAsurf', 'wgcNOAAsurf',
-                   'wisNOAAsurf', 'wktNOAAsurf',
-                   'grfNOAAsurf', 'mlsNOAAsurf', 'mscNOAAsurf', 'spfNOAAsurf', # look weird
-                   'tnkNOAAsurf', 'wpcNOAAsurf',
-                   'dsiNOAAsurf', 'wlgNOAAsurf', 'palNOAAsurf', 'bktNOAAsurf', # too sensitive to local emissions
-                   'shmNOAAsurf', 'amtNOAAsurf'] 
-
-    for site in unique_sites:
-        print(site)
-
-        if site in dodgy_sites:
-            pass
-        # ignore aircraft obs
-        elif "NOAAair" in site:
-            pass
-        else:
-            site_mask = obspack_obs["site"] == site
-            if "AGAGEsurf" in site:
-                obspack_obs["baseline"][site_mask] = agage_baseline(baseline_dict[site[0:3].upper()], obspack_obs["time"][site_mask])
+    rules = np.array([site_rule(site) for site in site_table])
+    obs_rules = rules[site_codes]
+
+    flags = obs_rules == "default"
+
+    agage_codes = np.flatnonzero(rules == "agage")
+    if len(agage_codes) > 0:
+        baselines = [baseline_dict[site_table[code][0:3].upper()] for code in agage_codes]
+        baseline_sites = np.concatenate([np.full(len(df["time"]), code) for code, df in zip(agage_codes, baselines)])
+        baseline_times = np.concatenate([df["time"].values for df in baselines])
+        baseline_flags = np.concatenate([df["baseline_NAME"].values for df in baselines])
+        agage_obs = obs_rules == "agage"
+        flags[agage_obs] = interp_baselines(baseline_sites, baseline_times, baseline_flags,
+                                            site_codes[agage_obs], np.asarray(times)[agage_obs])
+
+    return flags
+
+def raw_obs_to_baseline(obspack_obs, baseline_dict, plot_dir=None):
+    """ Create baseline variable, which is 1 for baseline, 0 for not baseline. If plot_dir
+    is given, a plot of each AGAGE site coloured by baseline is saved there.
+    """
+    # work on integer site codes from here
+    site_table, site_codes = np.unique(np.asarray(obspack_obs["site"].values).astype(str), return_inverse=True)
+    flags = classify_baseline(site_codes, site_table, obspack_obs["time"].values, baseline_dict)
+    obspack_obs["baseline"] = xr.Variable(obspack_obs["value"].dims,
+                                          flags.astype(obspack_obs["value"].dtype),
+                                          obspack_obs["value"].attrs)
+
+    if plot_dir is not None:
+        plot_dir.mkdir(parents=True, exist_ok=True)
+        for code, site in enumerate(site_table):
+            if site_rule(site) == "agage":
                 # plot to check it makes sense
-                plot_baseline(obspack_obs.where(site_mask, drop=True))
-                # how much of difference?
-                print(obspack_obs["value"][site_mask].mean())
-                print(obspack_obs["value"][site_mask][obspack_obs["baseline"][site_mask] == 1].mean())
-            else:
-                # store baseline
-                obspack_obs["baseline"][site_mask] = 1
-    
+                plot_baseline(obspack_obs.isel(obs=np.flatnonzero(site_codes == code)), plot_dir / f"{site}_baseline.png")
+
     return obspack_obs
 
-def plot_baseline(site_obs):
+def plot_baseline(site_obs, plot_file=None):
     """ Plot a scatter plot of the observations, coloured by whether it is "baseline".
+    The plot is saved to plot_file if given, otherwise shown.
     """
-    _, ax = plt.subplots()
+    fig, ax = plt.subplots()
     scatter = ax.scatter(x=site_obs["time"].values, y=site_obs["value"], c=site_obs["baseline"])
     clegend = plt.legend(*scatter.legend_elements())
     ax.add_artist(clegend)
-    plt.show()
+    # how much of difference?
+    ax.set_title(f"mean {float(site_obs['value'].mean()):.2f}, "
+                 f"baseline mean {float(site_obs['value'].where(site_obs['baseline'] == 1).mean()):.2f}")
+    if plot_file is None:
+        plt.show()
+    else:
+        fig.savefig(plot_file)
+        plt.close(fig)
 
 def make_agage_baseline_dict(config):
     agage_sites = config["inversion_constants"]["agage_sites"].split(",")
@@ -95,17 +175,19 @@ if __name__ == "__main__":
     config.read("../../config.ini")
     OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
     AGAGE_SITES = config["inversion_constants"]["agage_sites"].split(",")
+
+    # only make the plots of the AGAGE baselines if asked to
+    plot_dir = OBSPACK_DIR / "baseline_plots" if "--plots" in sys.argv else None
     
     # read in raw observations
     print("Reading in obs...")
-    with xr.open_dataset(OBSPACK_DIR / "raw_obs.nc") as load:
-        obspack_raw = load.load()
+    obspack_raw = obs_cache.open_obs(OBSPACK_DIR / "raw_obs.nc")
 
     # read in AGAGE baselines
     agage_baseline_dict = make_agage_baseline_dict(config)
 
     # filter to only baseline
-    obspack_baseline = raw_obs_to_baseline(obspack_raw, agage_baseline_dict)
+    obspack_baseline = raw_obs_to_baseline(obspack_raw, agage_baseline_dict, plot_dir)
 
     # Save for later use
     obspack_baseline.to_netcdf(OBSPACK_DIR / "baseline_obs.nc")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This script converts the observation files (baseline_obs.nc, raw_obs.nc) into a
+read-only columnar cache: one .npy file per variable plus a json description.
+Loading the cache memory maps the columns, so many jobs on the same node share one
+copy of the observations in the page cache rather than each loading their own.
+"""
+import configparser
+import json
+import os
+from pathlib import Path
+import shutil
+
+import numpy as np
+import xarray as xr
+
+# string variables stored as integer codes into a table of unique values
+CODED_VARS = ("site", "network")
+# encoding kept with the cache, so files written from cached obs are the same
+ENCODING_KEYS = ("dtype", "_FillValue", "missing_value", "units", "calendar", "scale_factor", "add_offset")
+
+def obs_cache_dir(obs_file):
+    """ The cache directory that goes with an observation file, e.g. baseline_obs.nc
+    is cached in baseline_obs_cache.
+    """
+    return obs_file.parent / f"{obs_file.stem}_cache"
+
+def source_fingerprint(obs_file):
+    """ The size and modification time of the file the cache was made from.
+    """
+    stat = obs_file.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def to_fixed_width(values):
+    """ Turn a string array into a fixed width one that can be memory mapped.
+    """
+    if values.dtype.kind != "O":
+        return values
+    if all(isinstance(value, bytes) for value in values.ravel()):
+        return np.array(values.tolist(), dtype="S")
+    return np.array(values.tolist(), dtype="U")
+
+def jsonable_attrs(attrs):
+    """ Make variable attributes saveable as json.
+    """
+    return {key: value.tolist() if isinstance(value, (np.ndarray, np.generic)) else value
+            for key, value in attrs.items()}
+
+def jsonable_encoding(encoding):
+    """ Keep the parts of a variable's encoding that can be saved as json.
+    """
+    kept = {}
+    for key in ENCODING_KEYS:
+        if key in encoding:
+            value = str(np.dtype(encoding[key])) if key == "dtype" else encoding[key]
+            value = jsonable_attrs({key: value})[key]
+            try:
+                json.dumps(value)
+            except TypeError:
+                continue
+            kept[key] = value
+    return kept
+
+def restore_encoding(encoding):
+    """ Turn saved encoding back into what xarray expects.
+    """
+    if "dtype" in encoding:
+        encoding = dict(encoding, dtype=np.dtype(encoding["dtype"]))
+    return encoding
+
+def write_obs_cache(obspack_obs, cache_dir, source=None):
+    """ Write the observations to a columnar cache. The cache is made in a temporary
+    directory and then moved into place, so a job never sees half a cache.
+    """
+    tmp_dir = cache_dir.parent / f"{cache_dir.name}.tmp{os.getpid()}"
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    description = {"source": source, "attrs": jsonable_attrs(obspack_obs.attrs), "variables": {}}
+    for name, var in obspack_obs.variables.items():
+        values = var.values
+        column = {"dims": list(var.dims), "coord": name in obspack_obs.coords,
+                  "attrs": jsonable_attrs(var.attrs), "encoding": jsonable_encoding(var.encoding)}
+        if name in CODED_VARS:
+            table, values = np.unique(to_fixed_width(values), return_inverse=True)
+            values = values.reshape(var.shape).astype(np.int32)
+            column["table"] = [value.decode() if isinstance(value, bytes) else str(value) for value in table]
+            column["table_dtype"] = table.dtype.str
+        elif values.dtype.kind in "mM":
+            # times are saved as int64 and viewed as times again when loaded
+            column["view"] = values.dtype.str
+            values = values.view(np.int64)
+        else:
+            values = to_fixed_width(values)
+        np.save(tmp_dir / f"{name}.npy", values)
+        description["variables"][name] = column
+
+    with open(tmp_dir / "obs_cache.json", "w") as f:
+        json.dump(description, f, indent=1)
+
+    # swap in the new cache
+    if cache_dir.exists():
+        old_dir = cache_dir.parent / f"{cache_dir.name}.old{os.getpid()}"
+        cache_dir.rename(old_dir)
+        tmp_dir.rename(cache_dir)
+        shutil.rmtree(old_dir)
+    else:
+        tmp_dir.rename(cache_dir)
+
+def convert_obs_file(obs_file):
+    """ Make (or remake) the cache for an observation netcdf file.
+    """
+    with xr.open_dataset(obs_file) as load:
+        obspack_obs = load.load()
+    write_obs_cache(obspack_obs, obs_cache_dir(obs_file), source_fingerprint(obs_file))
+
+def read_cache_description(cache_dir):
+    """ Read the json description of a cache, or None if there isn't a cache.
+    """
+    if not (cache_dir / "obs_cache.json").is_file():
+        return None
+    with open(cache_dir / "obs_cache.json") as f:
+        return json.load(f)
+
+def cache_is_current(cache_dir, source):
+    """ Check there is a cache made from source.
+    """
+    description = read_cache_description(cache_dir)
+    # compare as json, as that's how the source was saved
+    return description is not None and description["source"] == json.loads(json.dumps(source))
+
+def load_obs_cache(cache_dir, decode_codes=True, variables=None):
+    """ Load a columnar cache as an xarray dataset of read-only memory mapped columns.
+
+    Coded variables (site, network) are looked up in their tables, which makes a private
+    copy of just those variables. With decode_codes=False they are returned as integer
+    codes, with the table in the "table" attribute. variables picks which data variables
+    to load (default all), the coordinates are always loaded.
+    """
+    description = read_cache_description(cache_dir)
+
+    data_vars = {}
+    coords = {}
+    for name, column in description["variables"].items():
+        if variables is not None and not column["coord"] and name not in variables:
+            continue
+        values = np.load(cache_dir / f"{name}.npy", mmap_mode="r")
+        attrs = dict(column["attrs"])
+        if "view" in column:
+            values = values.view(column["view"])
+        elif "table" in column:
+            table = np.array(column["table"], dtype=column["table_dtype"])
+            if decode_codes:
+                values = table[values]
+            else:
+                attrs["table"] = column["table"]
+        target = coords if column["coord"] else data_vars
+        target[name] = xr.Variable(column["dims"], values, attrs,
+                                   encoding=restore_encoding(column.get("encoding", {})))
+
+    return xr.Dataset(data_vars, coords=coords, attrs=description.get("attrs", {}))
+
+def open_obs(obs_file, decode_codes=True):
+    """ Read in an observation file, using its memory mapped cache if there is one made
+    from the current version of the file, otherwise loading the netcdf.
+    """
+    cache_dir = obs_cache_dir(obs_file)
+    if cache_is_current(cache_dir, source_fingerprint(obs_file)):
+        return load_obs_cache(cache_dir, decode_codes)
+    if read_cache_description(cache_dir) is not None:
+        print(f"{cache_dir} is out of date, reading {obs_file}")
+
+    with xr.open_dataset(obs_file) as load:
+        obspack_obs = load.load()
+    return obspack_obs
+
+
+if __name__ == "__main__":
+    # read in variables from the config file
+    config = configparser.ConfigParser()
+    config.read("../../config.ini")
+    OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
+
+    for obs_file in [OBSPACK_DIR / "raw_obs.nc", OBSPACK_DIR / "baseline_obs.nc"]:
+        if obs_file.is_file():
+            print(f"Caching {obs_file}...")
+            convert_obs_file(obs_file)
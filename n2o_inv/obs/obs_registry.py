@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This script keeps track of which obs numbers have been given to which observations.
+
+Each source (e.g. an AGAGE site) and release (e.g. a year) gets a contiguous range of
+obs numbers, stored in a small json index in the obspack directory. Asking for the same
+source and release again gives back the same range, and new ranges never overlap old
+ones, so adding a site or a year doesn't mean rereading everything to find unused
+numbers. Sources whose obs change over time (e.g. the current year of a site, or flasks
+that are analysed late) keep the numbers they've already been given, matched on the
+time of each obs, and new obs get an extra range after everything else. The obs times
+of these ranges are kept in .npy files next to the registry. Releases that come with
+their own numbering (the NOAA obspacks) are reserved so nothing else is given their
+numbers. Reserve them before allocating
+anything, otherwise an allocated range could already be using their numbers.
+"""
+import configparser
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from n2o_inv.obs import format_obspack_geoschem
+
+REGISTRY_NAME = "obs_registry.json"
+
+def obs_registry_file(obspack_dir):
+    """ The registry that goes with an obspack directory.
+    """
+    return obspack_dir / REGISTRY_NAME
+
+def range_key(source, release, part=0):
+    """ The key a range is stored under in the registry. Later parts are the ranges added
+    when a release grows.
+    """
+    if part == 0:
+        return f"{source}/{release}"
+    return f"{source}/{release}/{part}"
+
+def read_registry(registry_file):
+    """ Read the registry, or an empty one if it hasn't been made yet. Writes replace the
+    whole file, so this never sees half a registry.
+    """
+    if not registry_file.is_file():
+        return {"ranges": {}}
+    with open(registry_file) as f:
+        return json.load(f)
+
+def write_registry(registry, registry_file):
+    """ Write the registry to a temporary file and move it into place.
+    """
+    tmp_file = registry_file.parent / f"{registry_file.name}.tmp{os.getpid()}"
+    with open(tmp_file, "w") as f:
+        json.dump(registry, f, indent=1)
+    os.replace(tmp_file, registry_file)
+
+@contextmanager
+def locked_registry(registry_file):
+    """ Hold the registry lock, yielding the registry to be changed. The changes are
+    written when the block finishes, unless it raises.
+    """
+    registry_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(registry_file.parent / f"{registry_file.name}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            registry = read_registry(registry_file)
+            yield registry
+            write_registry(registry, registry_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def lookup(registry_file, source, release):
+    """ The range registered for a source and release, or None if there isn't one.
+    """
+    return read_registry(registry_file)["ranges"].get(range_key(source, release))
+
+def obs_numbers(entry):
+    """ The obs numbers in a registered range.
+    """
+    return np.arange(entry["start"], entry["stop"])
+
+def next_free_obs(registry):
+    """ The first obs number after all the registered ranges.
+    """
+    return max([entry["stop"] for entry in registry["ranges"].values()], default=0)
+
+def check_no_overlap(registry, key, start, stop):
+    """ Raise an error if start to stop overlaps a range allocated to another key.
+    Reserved ranges can overlap each other, as e.g. the NOAA surface and aircraft obs
+    numbers are interleaved.
+    """
+    for other_key, entry in registry["ranges"].items():
+        if entry["kind"] != "allocated":
+            continue
+        if other_key != key and start < entry["stop"] and entry["start"] < stop:
+            raise ValueError(f"obs {start} to {stop} for {key} overlap {other_key} "
+                             f"({entry['start']} to {entry['stop']})")
+
+def reserve(registry_file, source, release, start, stop, info=None):
+    """ Register a range of obs numbers that a release already uses (start to stop,
+    stop not included), so they aren't given to anything else. info is extra json-able
+    detail to store with the range.
+    """
+    key = range_key(source, release)
+    with locked_registry(registry_file) as registry:
+        entry = registry["ranges"].get(key)
+        if entry is not None:
+            if (entry["start"], entry["stop"]) != (start, stop):
+                raise ValueError(f"{key} is already registered as obs {entry['start']} to {entry['stop']}, "
+                                 f"not {start} to {stop}")
+            return entry
+        check_no_overlap(registry, key, start, stop)
+        entry = {"source": source, "release": release, "kind": "reserved",
+                 "start": int(start), "stop": int(stop), **(info or {})}
+        registry["ranges"][key] = entry
+    return entry
+
+def allocate(registry_file, source, release, n_obs, info=None):
+    """ Give a source and release a contiguous range of n_obs new obs numbers. Asking
+    again gives back the same range. A different number of obs for a registered release
+    is an error, as the extra obs would need numbers that might belong to something else;
+    use allocate_growing for releases that have obs added to them.
+    """
+    key = range_key(source, release)
+    with locked_registry(registry_file) as registry:
+        entry = registry["ranges"].get(key)
+        if entry is not None:
+            if entry["stop"] - entry["start"] != n_obs:
+                raise ValueError(f"{key} is already registered with {entry['stop'] - entry['start']} obs, "
+                                 f"not {n_obs}")
+            return entry
+        start = next_free_obs(registry)
+        entry = {"source": source, "release": release, "kind": "allocated",
+                 "start": start, "stop": start + int(n_obs), **(info or {})}
+        registry["ranges"][key] = entry
+    return entry
+
+def release_ranges(registry, source, release):
+    """ The ranges registered for a source and release, in the order they were given out.
+    """
+    return sorted([entry for entry in registry["ranges"].values()
+                   if entry["source"] == source and entry["release"] == release],
+                  key=lambda entry: entry.get("part", 0))
+
+def times_file(registry_file, key):
+    """ The file the obs of a range given out by allocate_growing are kept in.
+    """
+    return registry_file.parent / f"{registry_file.stem}_times" / f"{key.replace('/', '__')}.npy"
+
+def write_times(obs_ids, filename):
+    """ Save the obs of a range via a temporary file, as with the registry.
+    """
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = filename.parent / f"{filename.stem}.tmp{os.getpid()}.npy"
+    np.save(tmp_file, obs_ids)
+    os.replace(tmp_file, filename)
+
+def time_obs_ids(times):
+    """ An id for each obs from its time and how many obs have already been at that time,
+    so obs at the same time (e.g. a pair of flasks) can be told apart. times must be sorted.
+    """
+    first = np.r_[True, times[1:] != times[:-1]]
+    repeat = np.arange(len(times)) - np.maximum.accumulate(np.where(first, np.arange(len(times)), 0))
+    return np.stack([times, repeat], axis=1)
+
+def allocate_growing(registry_file, source, release, times, info=None):
+    """ The obs numbers of a source and release whose obs can change, with times (unix time,
+    sorted) the times of all its obs now. Each obs is known by its time, so the obs already
+    registered keep their numbers, and any new obs, including ones in between the
+    registered obs, get a new contiguous range after everything else. The numbers of obs
+    that have gone aren't given out again.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    if (np.diff(times) < 0).any():
+        raise ValueError("obs times must be sorted")
+    obs_ids = time_obs_ids(times)
+
+    with locked_registry(registry_file) as registry:
+        entries = release_ranges(registry, source, release)
+        if any("times_file" not in entry for entry in entries):
+            raise ValueError(f"{range_key(source, release)} was registered with allocate, not allocate_growing")
+        registered_ids = [np.load(registry_file.parent / entry["times_file"]).reshape(-1, 2) for entry in entries]
+        registered = pd.MultiIndex.from_arrays(np.concatenate([np.empty((0, 2), dtype=np.int64)] + registered_ids).T)
+        registered_numbers = np.concatenate([np.array([], dtype=np.int64)] +
+                                            [obs_numbers(entry) for entry in entries])
+
+        rows = registered.get_indexer(pd.MultiIndex.from_arrays(obs_ids.T))
+        new = rows < 0
+        numbers = np.empty(len(times), dtype=np.int64)
+        numbers[~new] = registered_numbers[rows[~new]]
+        if new.any():
+            key = range_key(source, release, len(entries))
+            start = next_free_obs(registry)
+            write_times(obs_ids[new], times_file(registry_file, key))
+            entry = {"source": source, "release": release, "kind": "allocated", "part": len(entries),
+                     "start": start, "stop": start + int(new.sum()),
+                     "times_file": str(times_file(registry_file, key).relative_to(registry_file.parent)),
+                     **(info or {})}
+            registry["ranges"][key] = entry
+            numbers[new] = obs_numbers(entry)
+    return numbers
+
+def reserve_noaa_obspack(registry_file, obspack_folder, cache_root):
+    """ Reserve the obs numbers used by a NOAA obspack release, along with the time of its
+    last obs. The release is only read (through its cache) the first time.
+    """
+    entry = lookup(registry_file, "noaa_obspack", obspack_folder.name)
+    if entry is not None:
+        return entry
+
+    obspack_data = format_obspack_geoschem.read_noaa_obspack_cached(obspack_folder, cache_root, variables=["time"])
+    obs = obspack_data["obs"].values
+    final_time = format_obspack_geoschem.time_in_seconds(obspack_data["time"].values[-1:])[0]
+    return reserve(registry_file, "noaa_obspack", obspack_folder.name, int(obs.min()), int(obs.max()) + 1,
+                   {"final_time": int(final_time)})
+
+def reserve_noaa_obspacks(registry_file, raw_obspack_dir, cache_root):
+    """ Reserve the obs numbers of all the NOAA obspack releases that are used.
+    """
+    return {release: reserve_noaa_obspack(registry_file, raw_obspack_dir / release, cache_root)
+            for release in format_obspack_geoschem.NOAA_OBSPACK_RELEASES}
+
+
+if __name__ == "__main__":
+    # read in variables from the config file
+    config = configparser.ConfigParser()
+    config.read("../../config.ini")
+    OBSPACK_DIR = Path(config["paths"]["obspack_dir"])
+
+    # print what has been registered
+    for key, entry in read_registry(obs_registry_file(OBSPACK_DIR))["ranges"].items():
+        print(f"{key}: {entry['start']} to {entry['stop']}")
@@ -12,14 +12,13 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
-from n2o_inv.intermediates import process_geos_output
+from n2o_inv.intermediates import process_geos_output, tracers
+from n2o_inv.obs import obs_cache
 
 def add_ch4(combined, no_regions):
     """ Add all the emissions from the regions to make a single total variable.
     """
-    combined["CH4_sum"] = xr.zeros_like(combined["CH4_R00"])
-    for i in range(0, no_regions):
-        combined["CH4_sum"] += combined[f"CH4_R{i:02d}"]
+    combined["CH4_sum"] = tracers.sum_tracers(combined, "CH4_R", no_regions)
     return combined
 
 
@@ -41,15 +40,13 @@ if __name__ == "__main__":
     print("Reading in obs...")
     obs_file = OBSPACK_DIR / "raw_obs.nc"
     if obs_file.is_file():
-        with xr.open_dataset(obs_file) as load:
-            obspack_obs = load.load()
-        _, unique_sites = process_geos_output.find_unique_sites(obspack_obs)
+        obspack_obs = obs_cache.open_obs(obs_file)
     else:
         obspack_obs = process_geos_output.read_obs(OBSPACK_DIR, SPINUP_START, 
                                                    FINAL_END, FINAL_END)
 
         print("Finding unique sites...")
-        list_of_sites, unique_sites = process_geos_output.find_unique_sites(obspack_obs)
+        list_of_sites, _ = process_geos_output.find_unique_sites(obspack_obs)
         obspack_obs["site"] = (("obs"), np.array(list_of_sites))
 
         # save for looking at baselines
@@ -76,13 +73,15 @@ if __name__ == "__main__":
     # save plots as a pdf for each site
     pp = PdfPages(OBSPACK_DIR / 'obs_plots.pdf')
     print("Plotting desired sites...")
-    for site in unique_sites:
+    # find each site's obs through integer codes rather than comparing strings
+    unique_sites, site_index = np.unique(combined["site"].values, return_inverse=True)
+    for i, site in enumerate(unique_sites):
         # don't plot aircraft data
         if "NOAAair" in site:
             pass
         # plot rest
         else:
-            onesite = combined.where(combined["site"] == site, drop=True)
+            onesite = combined.isel(obs_time=np.flatnonzero(site_index == i))
               
             # masks based on is it flagged or strangely low?
             any_flag = (onesite["qcflag"] == b'...')
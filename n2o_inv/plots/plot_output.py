@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import xarray as xr
 
+from n2o_inv.intermediates import tracers
 from n2o_inv.plots import map_plot
 
 # =============================================================================
@@ -73,11 +74,9 @@ def plot_zonal_mean(geos_out):
 def sum_tracers(geos_out, no_regions):
     """ Sum up the geoschem tracers to give a total tracer.
     """ 
-    total = xr.zeros_like(geos_out["SpeciesConc_CH4"])
-    transcom = [f"SpeciesConc_CH4_R{index:02d}" for index in range(0, no_regions)]
-    for region in transcom:
-        total += geos_out[region]
-    return total
+    total = tracers.sum_tracers(geos_out, "SpeciesConc_CH4_R", no_regions)
+    # keep the metadata of the total tracer
+    return geos_out["SpeciesConc_CH4"].copy(data=total.values)
 
 def global_total_ems(ems, varname):
     """ Calculate the global total ems in kgs-1.
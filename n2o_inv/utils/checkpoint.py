@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checkpoints for the stages of the processing scripts.
+
+Each stage's output is saved as netcdf under a key hashed from the stage name, its
+parameters (including fingerprints of the files it reads) and the keys of the stages
+it uses. A change to one stage changes its key and the keys of the stages after it,
+so those are redone, while the stages before it are read back from their checkpoints.
+"""
+import hashlib
+import json
+import os
+
+import xarray as xr
+
+def hash_inputs(inputs):
+    """ sha256 hash of anything that can be saved as json (other values are turned into
+    strings, e.g. dates and paths).
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+def files_fingerprint(files):
+    """ The name, size and modification time of each file, in name order. Hashing the
+    contents of all the obs and geoschem files would take about as long as reading them.
+    """
+    fingerprint = []
+    for input_file in sorted(files):
+        stat = input_file.stat()
+        fingerprint.append({"name": str(input_file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+    return fingerprint
+
+def stage_key(stage, params, parents=()):
+    """ The key of a stage, from its parameters and the keys of the stages it uses.
+    """
+    return hash_inputs({"stage": stage, "params": params, "parents": list(parents)})
+
+def checkpoint_file(checkpoint_dir, stage, key):
+    """ The file a stage's output is saved in.
+    """
+    return checkpoint_dir / f"{stage}.{key[:16]}.nc"
+
+def save_checkpoint(ds, filename):
+    """ Save a stage's output via a temporary file, so an interrupted run never leaves
+    half a checkpoint behind.
+    """
+    tmp_filename = filename.with_name(f".{filename.name}.tmp{os.getpid()}")
+    try:
+        ds.to_netcdf(tmp_filename)
+        os.replace(tmp_filename, filename)
+    finally:
+        if tmp_filename.exists():
+            tmp_filename.unlink()
+
+def load_checkpoint(filename):
+    """ Read a stage's output back in.
+    """
+    with xr.open_dataset(filename) as load:
+        return load.load()
+
+def cached_stage(checkpoint_dir, stage, key, compute):
+    """ The output of a stage, read from its checkpoint if there is one for this key,
+    otherwise made by calling compute() and saved. The output is always as read back from
+    the checkpoint, so it is the same whether or not the stage was redone.
+    """
+    filename = checkpoint_file(checkpoint_dir, stage, key)
+    if filename.is_file():
+        print(f"Reusing {stage} checkpoint {filename.name}")
+    else:
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        save_checkpoint(compute(), filename)
+    return load_checkpoint(filename)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing and memory instrumentation for the stages of the processing scripts.
+
+Set the environment variable N2O_INV_INSTRUMENT to a file name and each stage
+wrapped in instrument.stage appends one json line to that file, recording wall time,
+cpu time, peak memory, files opened and bytes read. If the variable isn't set the
+stages do nothing extra.
+"""
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import time
+
+ENV_VAR = "N2O_INV_INSTRUMENT"
+
+# identifies the records from one run of a script, can be set to e.g. the array job id
+RUN_ID = os.environ.get("N2O_INV_RUN_ID", f"{os.getpid()}-{int(time.time())}")
+
+# where the bytes read by this process are, on linux
+PROC_IO = "/proc/self/io"
+
+# number of files opened by python in this process, counted by an audit hook
+_files_opened = 0
+_audit_hook_added = False
+
+def _count_opens(event, args):
+    global _files_opened
+    # the stages' own reads of PROC_IO aren't counted
+    if event == "open" and args[0] != PROC_IO:
+        _files_opened += 1
+
+def _add_audit_hook():
+    """ Start counting the files opened, only once as audit hooks can't be removed.
+    """
+    global _audit_hook_added
+    if not _audit_hook_added and hasattr(sys, "addaudithook"):
+        sys.addaudithook(_count_opens)
+        _audit_hook_added = True
+
+def read_proc_io():
+    """ The bytes read by this process, from /proc/self/io. None where this isn't available.
+    """
+    try:
+        with open(PROC_IO) as f:
+            io = dict(line.split(":") for line in f)
+    except OSError:
+        return None
+    return {"rchar": int(io["rchar"]), "read_bytes": int(io["read_bytes"])}
+
+def snapshot():
+    """ The current counters that a stage records the change in.
+    """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"wall": time.perf_counter(),
+            "cpu": time.process_time(),
+            "child_cpu": child_usage.ru_utime + child_usage.ru_stime,
+            "files_opened": _files_opened,
+            "io": read_proc_io(),
+            "max_rss_kb": self_usage.ru_maxrss,
+            "child_max_rss_kb": child_usage.ru_maxrss}
+
+def stage_record(name, start, end):
+    """ Make the record of a stage from the counters at its start and end.
+    """
+    record = {"run_id": RUN_ID,
+              "script": os.path.basename(sys.argv[0]),
+              "stage": name,
+              "wall_s": end["wall"] - start["wall"],
+              "cpu_s": end["cpu"] - start["cpu"],
+              "child_cpu_s": end["child_cpu"] - start["child_cpu"],
+              # ru_maxrss is the peak over the whole process so far, in kB on linux
+              "peak_rss_kb": end["max_rss_kb"],
+              "child_peak_rss_kb": end["child_max_rss_kb"],
+              "files_opened": end["files_opened"] - start["files_opened"]}
+    if start["io"] is not None and end["io"] is not None:
+        record["bytes_read"] = end["io"]["rchar"] - start["io"]["rchar"]
+        record["storage_bytes_read"] = end["io"]["read_bytes"] - start["io"]["read_bytes"]
+    return record
+
+@contextmanager
+def stage(name, **fields):
+    """ Record a named stage of a script, if instrumentation is turned on. Yields a dict
+    that extra fields (e.g. number of files read) can be added to for the record. Files
+    opened only counts opens by python itself (not e.g. netCDF-C), and bytes read only
+    covers this process, not worker processes.
+    """
+    record_file = os.environ.get(ENV_VAR)
+    extra = dict(fields)
+    if not record_file:
+        yield extra
+        return
+
+    _add_audit_hook()
+    start = snapshot()
+    error = None
+    try:
+        yield extra
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        end = snapshot()
+        record = stage_record(name, start, end)
+        record.update(extra)
+        if error is not None:
+            record["error"] = error
+        # one write per line so records from concurrent jobs don't interleave
+        with open(record_file, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
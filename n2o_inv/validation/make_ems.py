@@ -2,16 +2,21 @@
 # -*- coding: utf-8 -*-
 """
 This script makes a set of emissions for GEOSChem by rescaling the prior
-emissions using the posterior flux scaling factors.
+emissions using the posterior flux scaling factors. It can also make an ensemble of
+emissions from samples of the posterior flux scaling factors, or summary statistics of
+that ensemble.
 """
 import configparser
 from pathlib import Path
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import xarray as xr
 
+from n2o_inv.intermediates import tracers
+
 # read in variables from the config file
 config = configparser.ConfigParser()
 config.read(Path(__file__).parent.parent.parent / 'config.ini')
@@ -36,15 +41,134 @@ def rescale_ems(ems, alphas_reshaped, n_regions):
     # create new post_ems
     post_ems = ems.copy()
 
-    # rescale emissions
-    post_ems["emi_n2o"] = 0
-    for i in range(n_regions):
-        mask_i = xr.DataArray(alphas_reshaped[:, i], dims="time") 
-        post_ems[f"emi_R{i:02d}"] = ems[f"emi_R{i:02d}"] * (1 + mask_i)
-        post_ems["emi_n2o"] = post_ems["emi_n2o"] + post_ems[f"emi_R{i:02d}"]
+    # rescale all the regions at once
+    stacked = tracers.stack_tracers(ems, "emi_R", n_regions)
+    alphas_da = xr.DataArray(np.transpose(alphas_reshaped), dims=("region", "time"))
+    post_stacked = stacked * (1 + alphas_da)
+
+    post_ems["emi_n2o"] = tracers.tracer_total(post_stacked)
+    post_ems.update(tracers.unstack_tracers(post_stacked, "emi_R"))
 
     return post_ems
 
+def count_samples(samples_file):
+    """ The number of samples (rows) in an alpha samples file (made by extract_alphas.R).
+    """
+    with open(samples_file) as f:
+        return sum(1 for _ in f) - 1
+
+def choose_samples(n_total, n_samples=None):
+    """ Evenly spaced sample numbers through the chain, all of them if n_samples is None
+    or there aren't that many.
+    """
+    if n_samples is None or n_samples >= n_total:
+        return np.arange(n_total)
+    return np.linspace(0, n_total - 1, n_samples).round().astype(int)
+
+def read_alpha_samples(samples_file, n_months, n_regions, sample_numbers, chunk_size=4, read_rows=1000):
+    """ Read the chosen samples of the flux scaling factors, yielding chunk_size of them
+    at a time as (sample numbers, (chunk_size, n_months, n_regions) alphas). The file is
+    read read_rows lines at a time, so however many samples there are they are never all
+    in memory at once.
+    """
+    sample_numbers = np.asarray(sample_numbers)
+    chunk_numbers, chunk_alphas = [], []
+    start = 0
+    for block in pd.read_csv(samples_file, index_col=0, chunksize=read_rows):
+        if block.shape[1] != n_months * n_regions:
+            raise ValueError(f"{samples_file} has {block.shape[1]} alphas, expected {n_months * n_regions}")
+        rows = np.arange(start, start + len(block))
+        start += len(block)
+        keep = np.isin(rows, sample_numbers)
+        chunk_numbers.extend(rows[keep])
+        chunk_alphas.extend(block.to_numpy()[keep].reshape(-1, n_months, n_regions))
+
+        while len(chunk_numbers) >= chunk_size:
+            yield np.array(chunk_numbers[:chunk_size]), np.stack(chunk_alphas[:chunk_size])
+            chunk_numbers, chunk_alphas = chunk_numbers[chunk_size:], chunk_alphas[chunk_size:]
+
+    if len(chunk_numbers) > 0:
+        yield np.array(chunk_numbers), np.stack(chunk_alphas)
+
+def ensemble_total_ems(stacked, alphas):
+    """ The total emissions, as a (sample, time, lat, lon) array, for each sample of
+    (time, region) flux scaling factors. stacked is the (region, time, lat, lon) prior
+    (see tracers.stack_tracers). The rescaled regions are summed by einsum as they are
+    made, so there is no (sample, region, time, lat, lon) temporary.
+    """
+    # alphas are (sample, time, region)
+    return np.einsum("str,rtyx->styx", 1 + alphas, stacked)
+
+def stream_ensemble_ems(ems, samples_file, n_months, n_regions, sample_numbers, chunk_size=4):
+    """ Yield the total posterior emissions for the chosen samples of the flux scaling
+    factors, chunk_size samples at a time, as (sample numbers, (sample, time, lat, lon) emissions).
+    """
+    stacked = tracers.stack_tracers(ems, "emi_R", n_regions).transpose("region", "time", "lat", "lon").values
+    for numbers, alphas in read_alpha_samples(samples_file, n_months, n_regions, sample_numbers, chunk_size):
+        yield numbers, ensemble_total_ems(stacked, alphas).astype(ems["emi_n2o"].dtype, copy=False)
+
+def ensemble_dataset(ems, numbers, total_ems):
+    """ A chunk of the emissions ensemble as a dataset.
+    """
+    return xr.Dataset({"emi_n2o": (("sample", "time", "lat", "lon"), total_ems, {"units": "kg/m2/s"})},
+                      coords={"sample": numbers, "time": ems["time"], "lat": ems["lat"], "lon": ems["lon"]})
+
+def write_ensemble_ems(ems, samples_file, out_dir, n_months, n_regions, sample_numbers, chunk_size=4):
+    """ Write the total posterior emissions for the chosen samples of the flux scaling
+    factors, chunk_size samples to each file (ems_posterior_ensemble_0000.nc, ...).
+    Returns the files written.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    ensemble_files = []
+    for chunk_number, (numbers, total_ems) in enumerate(stream_ensemble_ems(ems, samples_file, n_months, n_regions,
+                                                                             sample_numbers, chunk_size)):
+        ensemble_file = out_dir / f"ems_posterior_ensemble_{chunk_number:04d}.nc"
+        ensemble_dataset(ems, numbers, total_ems).to_netcdf(ensemble_file)
+        ensemble_files.append(ensemble_file)
+    return ensemble_files
+
+def update_ensemble_stats(stats, chunk):
+    """ Add a chunk of samples (along the first axis) to the running count, mean, sum of
+    squared differences from the mean, min and max. The mean and squared differences are
+    combined as in Chan et al.'s parallel form of Welford's algorithm.
+    """
+    chunk = np.asarray(chunk, dtype=np.float64)
+    n_chunk = len(chunk)
+    mean_chunk = chunk.mean(axis=0)
+    m2_chunk = ((chunk - mean_chunk) ** 2).sum(axis=0)
+    if stats is None:
+        return {"n": n_chunk, "mean": mean_chunk, "m2": m2_chunk, "min": chunk.min(axis=0), "max": chunk.max(axis=0)}
+
+    n = stats["n"] + n_chunk
+    delta = mean_chunk - stats["mean"]
+    return {"n": n,
+            "mean": stats["mean"] + delta * n_chunk / n,
+            "m2": stats["m2"] + m2_chunk + delta ** 2 * stats["n"] * n_chunk / n,
+            "min": np.minimum(stats["min"], chunk.min(axis=0)),
+            "max": np.maximum(stats["max"], chunk.max(axis=0))}
+
+def ensemble_stats_ems(ems, samples_file, n_months, n_regions, sample_numbers, chunk_size=4):
+    """ The mean, standard deviation, min and max of the total posterior emissions in each
+    month and grid cell over the chosen samples of the flux scaling factors, without ever
+    holding more than chunk_size samples of emissions.
+    """
+    stats = None
+    for _, total_ems in stream_ensemble_ems(ems, samples_file, n_months, n_regions, sample_numbers, chunk_size):
+        stats = update_ensemble_stats(stats, total_ems)
+    if stats is None:
+        raise ValueError(f"No samples chosen from {samples_file}")
+
+    dims = ("time", "lat", "lon")
+    attrs = {"units": "kg/m2/s"}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std = np.sqrt(stats["m2"] / (stats["n"] - 1))
+    return xr.Dataset({"emi_n2o_mean": (dims, stats["mean"], attrs),
+                       "emi_n2o_std": (dims, std, attrs),
+                       "emi_n2o_min": (dims, stats["min"], attrs),
+                       "emi_n2o_max": (dims, stats["max"], attrs)},
+                      coords={"time": ems["time"], "lat": ems["lat"], "lon": ems["lon"]},
+                      attrs={"n_samples": stats["n"]})
+
 # =============================================================================
 # Execute
 # ============================================================================= 
@@ -61,25 +185,43 @@ if __name__ == "__main__":
     # read in scaling factors (generated by extract_alphas.R)
     method = "mcmc"
     case = "IS-RHO0-FIXEDA-VARYW-NOBIAS-model-err-n2o_std"
-    alphas = pd.read_csv(GEOS_INT / f"alphas-{method}-{case}.csv", index_col=0)
-    # reshape so that each region's scaling factor is clear
     n_months = month_diff(pd.to_datetime(PERTURB_END), pd.to_datetime(PERTURB_START))
-    alphas_reshaped = np.reshape(alphas["value"].to_numpy(), (n_months, N_REGIONS))
 
-    # rescale emissions
-    post_ems = rescale_ems(ems, alphas_reshaped, N_REGIONS)
+    # "mean" (default) rescales by the mean scaling factors, "ensemble" and "stats" use
+    # n_samples (default all) samples of them, chunk_size samples at a time
+    mode = sys.argv[1] if len(sys.argv) > 1 else "mean"
+    if mode in ("ensemble", "stats"):
+        n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        chunk_size = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+        samples_file = GEOS_INT / f"alpha-samples-{method}-{case}.csv"
+        sample_numbers = choose_samples(count_samples(samples_file), n_samples)
+        print(f"Using {len(sample_numbers)} samples...")
+
+        if mode == "ensemble":
+            ensemble_files = write_ensemble_ems(ems, samples_file, GEOS_EMS / "ems_posterior_ensemble",
+                                                n_months, N_REGIONS, sample_numbers, chunk_size)
+            print(f"Written {len(ensemble_files)} files")
+        else:
+            ensemble_stats = ensemble_stats_ems(ems, samples_file, n_months, N_REGIONS, sample_numbers, chunk_size)
+            ensemble_stats.to_netcdf(GEOS_EMS / "ems_posterior_ensemble_stats.nc")
+    else:
+        alphas = pd.read_csv(GEOS_INT / f"alphas-{method}-{case}.csv", index_col=0)
+        # reshape so that each region's scaling factor is clear
+        alphas_reshaped = np.reshape(alphas["value"].to_numpy(), (n_months, N_REGIONS))
+
+        # rescale emissions
+        post_ems = rescale_ems(ems, alphas_reshaped, N_REGIONS)
 
-    # Multiplication ruins units
-    post_ems["emi_n2o"].attrs["units"] = "kg/m2/s"
-    for region in range(0, len(ems.keys())-1):
-        post_ems[f"emi_R{region:02d}"].attrs["units"] = "kg/m2/s"
+        # Multiplication ruins units
+        post_ems["emi_n2o"].attrs["units"] = "kg/m2/s"
+        for region in range(0, len(ems.keys())-1):
+            post_ems[f"emi_R{region:02d}"].attrs["units"] = "kg/m2/s"
 
-    # plot to check it makes sense
-    plt.plot(ems["emi_n2o"].sum(["lat", "lon"]), label="prior")
-    plt.plot(post_ems["emi_n2o"].sum(["lat", "lon"]), label="post")
-    plt.legend()
-    plt.show()
+        # plot to check it makes sense
+        plt.plot(ems["emi_n2o"].sum(["lat", "lon"]), label="prior")
+        plt.plot(post_ems["emi_n2o"].sum(["lat", "lon"]), label="post")
+        plt.legend()
+        plt.show()
 
-    # save
-    post_ems.to_netcdf(GEOS_EMS / f"ems_posterior.nc")
-    
\ No newline at end of file
+        # save
+        post_ems.to_netcdf(GEOS_EMS / f"ems_posterior.nc")
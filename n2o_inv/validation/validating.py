@@ -11,19 +11,19 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
-from n2o_inv.intermediates import process_geos_output
+from n2o_inv.intermediates import process_geos_output, tracers
+from n2o_inv.obs import obs_cache
 
 def read_geos(hippo_obs, geos_dir, n_regions):
     """ This function reads in the GEOSChem N2O concentrations for 2011.
     """
-    # read in GEOSChem data
-    hippo_geos = process_geos_output.read_geos(geos_dir,
-                                               hippo_obs, n_regions, 2011, 2011)
+    # read in GEOSChem data, with the tagged species in one (region, obs) array
+    stacked_geos = process_geos_output.read_geos(geos_dir,
+                                                 hippo_obs, n_regions, 2011, 2011, stacked=True)
 
     # sum up the tagged species to a total N2O concentration
-    hippo_geos["CH4_sum"] = xr.zeros_like(hippo_geos["CH4_R00"])
-    for i in range(0, n_regions+1):
-        hippo_geos["CH4_sum"] += hippo_geos[f"CH4_R{i:02d}"]
+    hippo_geos = tracers.unstack_tracers(stacked_geos["CH4_R"], "CH4_R")
+    hippo_geos["CH4_sum"] = tracers.tracer_total(stacked_geos["CH4_R"])
     
     return hippo_geos
 
@@ -88,8 +88,7 @@ if __name__ == "__main__":
     
     # read in observations
     print("Reading in obs...")
-    with xr.open_dataset(OBSPACK_DIR / "baseline_obs.nc") as load:
-        obspack_raw = load.load()
+    obspack_raw = obs_cache.open_obs(OBSPACK_DIR / "baseline_obs.nc")
 
     # select observations
     #.where(obspack_raw["network"] == "NOAAair", drop=True)
@@ -3,12 +3,16 @@ Tests process_geos_output.py
 
 @author: Angharad Stell
 """
+from concurrent.futures import ThreadPoolExecutor
+import re
+
 import numpy as np
 import pandas as pd
 import pytest
 import xarray as xr
 
-from n2o_inv.intermediates import process_geos_output
+from n2o_inv.intermediates import process_geos_output, tracers
+from n2o_inv.obs import obs_cache
 
 
 def test_monthly_mean_obspack_id():
@@ -17,6 +21,17 @@ def test_monthly_mean_obspack_id():
     expected_result = "obspack_multi-species_1_CCGGSurfaceFlask_v2.0_2021-02-09~n2o_TST_surface-flask_1_ccgg_Event~TST202107"
     assert expected_result == process_geos_output.monthly_mean_obspack_id(test_site, test_date)
 
+def test_monthly_mean_obspack_ids_matches_single():
+    sites = np.array(["aaaNOAAsurf", "cgoNOAGsurf"])
+    dates = pd.date_range("2010-01-01", "2010-12-31", freq="M").values
+    func_out = process_geos_output.monthly_mean_obspack_ids(sites, dates)
+
+    assert func_out.shape == (2, 12)
+    assert func_out.dtype == np.dtype("<U200")
+    for i, site in enumerate(sites):
+        for j, date in enumerate(dates):
+            assert func_out[i, j] == process_geos_output.monthly_mean_obspack_id(site, date)
+
 def test_obspack_geos_preprocess_correct_values():
     ds = xr.Dataset({"obspack_id": (("obs"), ["sitea_1", "siteb_2"]),
                      "CH4_R00": (("obs"), np.array([0, 0])),
@@ -56,6 +71,103 @@ def test_obspack_geos_preprocess_diff_dims():
     
     assert (process_geos_output.obspack_geos_preprocess(ds, obspack_obs, 1)["obs"] == np.array([1, 2])).all()
 
+def test_make_obspack_index():
+    obspack_obs = xr.Dataset({"obspack_id": (("obs"), ["sitea_1", "siteb_2", "sitea_1", "sitec_3"])},
+                             coords={"obs": np.array([5, 6, 7, 8])})
+    obs_index = process_geos_output.make_obspack_index(obspack_obs)
+
+    # repeated ids map to their first row
+    assert list(obs_index.index) == ["sitea_1", "siteb_2", "sitec_3"]
+    assert (obs_index.values == np.array([0, 1, 3])).all()
+
+def test_obspack_geos_preprocess_prebuilt_index():
+    ds = xr.Dataset({"obspack_id": (("obs"), ["sitea_1", "sitec_0", "siteb_2"]),
+                     "CH4_R00": (("obs"), np.array([0, 0, 0])),
+                     "CH4_R01": (("obs"), np.array([1, 2, 3]))},
+                     coords={"obs": np.array([1, 2, 3])})
+    obspack_obs = xr.Dataset({"obspack_id": (("obs"), ["sitea_1", "siteb_2", "sited_4"])},
+                             coords={"obs": np.array([6, 7, 8])})
+    obs_index = process_geos_output.make_obspack_index(obspack_obs)
+
+    with_index = process_geos_output.obspack_geos_preprocess(ds, obspack_obs, 1, obs_index)
+    without_index = process_geos_output.obspack_geos_preprocess(ds, obspack_obs, 1)
+
+    xr.testing.assert_identical(with_index, without_index)
+    assert (with_index["obs"] == np.array([6, 7])).all()
+    assert (with_index["CH4_R01"] == np.array([1E9, 3E9])).all()
+
+def test_obspack_geos_preprocess_no_match():
+    ds = xr.Dataset({"obspack_id": (("obs"), ["sitec_0"]),
+                     "CH4_R00": (("obs"), np.array([0])),
+                     "CH4_R01": (("obs"), np.array([1]))},
+                     coords={"obs": np.array([1])})
+    obspack_obs = xr.Dataset({"obspack_id": (("obs"), ["sitea_1", "siteb_2"])},
+                             coords={"obs": np.array([6, 7])})
+    assert process_geos_output.obspack_geos_preprocess(ds, obspack_obs, 1) is None
+
+@pytest.mark.parametrize("obspack_id_dtype", [str, "S200"])
+def test_read_geos_file_low_level_matches_xarray(tmp_path, obspack_id_dtype):
+    ch4_r01 = np.array([1, 2, np.nan, 4], dtype="float32")
+    ds = xr.Dataset({"obspack_id": (("obs"), np.array(["sitea_1", "sitea_2", "siteb_2", "sitec_0"],
+                                                      dtype=obspack_id_dtype)),
+                     "CH4_R00": (("obs"), np.array([0, 0, 0, 0])),
+                     "CH4_R01": (("obs"), ch4_r01, {"units": "mol mol-1"}),
+                     "pressure": (("obs"), np.array([1000., 900., 800., 700.]))},
+                    coords={"obs": np.array([1, 2, 3, 4])})
+    geos_file = tmp_path / "GEOSChem.ObsPack.20100101_0000z.nc4"
+    ds.to_netcdf(geos_file)
+    obspack_obs = xr.Dataset({"obspack_id": (("obs"), np.array(["sitea_1", "siteb_2", "sitec_9"],
+                                                               dtype=obspack_id_dtype))},
+                             coords={"obs": np.array([7, 8, 9])})
+
+    expected = process_geos_output.read_geos_file(geos_file, obspack_obs, 1, low_level=False)
+    func_out = process_geos_output.read_geos_file(geos_file, obspack_obs, 1, low_level=True)
+
+    xr.testing.assert_identical(func_out, expected)
+    assert (func_out["obs"] == np.array([7, 8])).all()
+    assert np.isnan(func_out["CH4_R01"].values[1])
+
+@pytest.mark.parametrize("low_level", [False, True])
+def test_read_geos_file_stacked(tmp_path, low_level):
+    ds = xr.Dataset({"obspack_id": (("obs"), ["sitea_1", "sitea_2", "siteb_2"]),
+                     "CH4_R00": (("obs"), np.array([1, 2, 3], dtype="float32")),
+                     "CH4_R01": (("obs"), np.array([4, np.nan, 6], dtype="float32"))},
+                    coords={"obs": np.array([1, 2, 3])})
+    geos_file = tmp_path / "GEOSChem.ObsPack.20100101_0000z.nc4"
+    ds.to_netcdf(geos_file)
+    obspack_obs = xr.Dataset({"obspack_id": (("obs"), ["sitea_1", "siteb_2"])},
+                             coords={"obs": np.array([7, 8])})
+
+    flat = process_geos_output.read_geos_file(geos_file, obspack_obs, 1, low_level=low_level)
+    func_out = process_geos_output.read_geos_file(geos_file, obspack_obs, 1, low_level=low_level, stacked=True)
+
+    assert func_out["CH4_R"].dims == ("region", "obs")
+    assert func_out["CH4_R"].dtype == np.float32
+    xr.testing.assert_identical(tracers.unstack_tracers(func_out["CH4_R"], "CH4_R"), flat)
+
+def test_read_netcdf4_tracer_span(tmp_path):
+    netCDF4 = pytest.importorskip("netCDF4")
+    values = np.array([0, 1, np.nan, 3, 4, 5], dtype="float32")
+    xr.Dataset({"CH4_R00": (("obs"), values)}).to_netcdf(tmp_path / "tracer.nc")
+    out = np.empty(3, dtype="float32")
+
+    with netCDF4.Dataset(tmp_path / "tracer.nc") as nc:
+        process_geos_output.read_netcdf4_tracer(nc["CH4_R00"], np.array([1, 2, 4]), out)
+
+    np.testing.assert_array_equal(out, values[[1, 2, 4]])
+
+def test_read_geos_file_low_level_no_match(tmp_path):
+    ds = xr.Dataset({"obspack_id": (("obs"), ["sitea_0"]),
+                     "CH4_R00": (("obs"), np.array([0])),
+                     "CH4_R01": (("obs"), np.array([1]))},
+                    coords={"obs": np.array([1])})
+    geos_file = tmp_path / "GEOSChem.ObsPack.20100101_0000z.nc4"
+    ds.to_netcdf(geos_file)
+    obspack_obs = xr.Dataset({"obspack_id": (("obs"), ["sitea_1"])},
+                             coords={"obs": np.array([6])})
+
+    assert process_geos_output.read_geos_file(geos_file, obspack_obs, 1, low_level=True) is None
+
 def test_read_obs_selects_right_files(tmp_path):
     # create fake files
     obs1 = xr.Dataset({"obspack_id": (("obs"), ["sitea_1", "siteb_2"])},
@@ -162,6 +274,49 @@ def test_read_geos_removed_obs(tmp_path):
     assert (func_out["CH4_R00"] == np.array([0, 0, 0, 0])).all()
     assert (func_out["CH4_R01"] == np.array([1E9, 3E9, 5E9, 6E9])).all()
 
+def test_read_geos_parallel_matches_serial(tmp_path):
+    obspack_ids = []
+    for day in range(1, 11):
+        ds = xr.Dataset({"obspack_id": (("obs"), [f"sitea_{day}", f"siteb_{day}"]),
+                         "CH4_R00": (("obs"), np.array([day, day])),
+                         "CH4_R01": (("obs"), np.array([2 * day, 3 * day]))},
+                         coords={"obs": np.array([1, 2])})
+        ds.to_netcdf(tmp_path / f"GEOSChem.ObsPack.201001{day:02d}_0000z.nc4")
+        obspack_ids.extend([f"sitea_{day}", f"siteb_{day}"])
+
+    obspack_obs = xr.Dataset({"obspack_id": (("obs"), obspack_ids)},
+                             coords={"obs": np.arange(100, 100 + len(obspack_ids))})
+
+    serial = process_geos_output.read_geos(tmp_path, obspack_obs, 1, 2010, 2010)
+    parallel = process_geos_output.read_geos(tmp_path, obspack_obs, 1, 2010, 2010,
+                                             n_workers=3, max_in_flight=4)
+
+    xr.testing.assert_identical(serial, parallel)
+    assert (parallel["obs"] == np.arange(100, 120)).all()
+
+def test_ordered_bounded_map_order_and_limit():
+    in_flight = []
+    peak = []
+
+    def func(item):
+        in_flight.append(item)
+        peak.append(len(in_flight))
+        return item * 2
+
+    results = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for result in process_geos_output.ordered_bounded_map(executor, func, range(20), 3):
+            in_flight.pop()
+            results.append(result)
+
+    assert results == [item * 2 for item in range(20)]
+    assert max(peak) <= 3
+
+def test_ordered_bounded_map_bad_limit():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(ValueError, match="max_in_flight must be at least 1"):
+            list(process_geos_output.ordered_bounded_map(executor, abs, range(3), 0))
+
 def test_read_geos_constant_runs(tmp_path):
     ds1 = xr.Dataset({"obspack_id": (("obs"), ["sitea_1", "siteb_2"]),
                       "CH4_R00": (("obs"), np.array([0, 0])),
@@ -193,6 +348,46 @@ def test_find_unique_sites():
     assert ["TSTA", "TSTB", "TSTA", "TSDA"] == list_of_sites
     assert (np.array(["TSDA", "TSTA", "TSTB"]) == unique_sites).all() # output in alphabetical order
 
+def test_find_unique_sites_matches_regex():
+    rng = np.random.default_rng(0)
+    sites = rng.choice(["mhd", "cgo", "smo", "hip"], 50)
+    networks = rng.choice(["NOAAsurf", "AGAGEsurf", "NOAAair"], 50)
+    obspack_ids = [f"obspack_multi-species_1_CCGGSurfaceFlask_v2.0_2021-02-09~n2o_{site}_surface-flask_1_ccgg_Event~{i}".encode()
+                   for i, site in enumerate(sites)]
+    # a padded id, and one with a "~" before the site
+    obspack_ids[3] = obspack_ids[3].ljust(200)
+    obspack_ids[4] = f"obspack~other~n2o_{sites[4]}_surface".encode()
+    test_combined = xr.Dataset({"obspack_id": (("obs"), np.array(obspack_ids)),
+                                "network": (("obs"), networks)})
+    expected = [re.search("~n2o_(.{3})_", elem.decode("utf-8")).group(1) + network
+                for elem, network in zip(obspack_ids, networks)]
+
+    list_of_sites, unique_sites = process_geos_output.find_unique_sites(test_combined)
+
+    assert list_of_sites == expected
+    assert (unique_sites == np.unique(expected)).all()
+
+def test_parse_obspack_sites_no_site():
+    with pytest.raises(ValueError):
+        process_geos_output.parse_obspack_sites(np.array([b"~n2o_mhd_surface", b"obspack_no_site"]))
+
+def test_remap_site_codes():
+    codes = np.array([0, 1, 2, 1])
+    table = np.array(["cgoAGAGEsurf", "cgoNOAAsurf", "smoNOAAsurf"])
+
+    new_codes, new_table = process_geos_output.remap_site_codes(codes, table, process_geos_output.agage_site_map(["CGO"]))
+
+    assert (new_table[new_codes] == ["cgoNOAGsurf", "cgoNOAGsurf", "smoNOAAsurf", "cgoNOAGsurf"]).all()
+    assert (new_table == ["cgoNOAGsurf", "smoNOAAsurf"]).all()
+
+def test_site_table_codes():
+    sites = np.array(["mhdAGAGEsurf", "mhdNOAAsurf", "smoNOAAsurf", "mhdAGAGEsurf"], dtype=object)
+
+    codes, table = process_geos_output.site_table_codes(sites)
+
+    assert (table == ["mhdAGAGEsurf", "mhdNOAAsurf", "smoNOAAsurf"]).all()
+    assert (table[codes] == sites).all()
+
 def test_monthly_measurement_unc_zeros():
     dates = pd.date_range("2010-01-01", "2010-12-31", freq="D")
     onesite = xr.Dataset({"obs_value": (("obs_time"), np.array([0] * len(dates))),
@@ -232,3 +427,215 @@ def test_monthly_measurement_unc_nan():
 
     onesite_resampled_unc_comb = process_geos_output.monthly_measurement_unc(onesite)
     assert (onesite_resampled_unc_comb == 0).all()
+
+@pytest.fixture
+def fake_combined():
+    rng = np.random.default_rng(2021)
+    n_obs = 300
+    sites = rng.choice(np.array(["aaaNOAAsurf", "bbbNOAAsurf", "cccNOAGsurf"]), size=n_obs)
+    times = np.sort(np.datetime64("2010-01-01") + rng.integers(0, 2 * 365 * 24 * 3600, size=n_obs).astype("timedelta64[s]"))
+    # one site only measures for a few months
+    keep = (sites != "cccNOAGsurf") | ((times > np.datetime64("2010-05-01")) & (times < np.datetime64("2010-09-01")))
+    combined = xr.Dataset({"obs_lat": (("obs_time"), rng.random(n_obs)[keep]),
+                           "obspack_id": (("obs_time"), np.array([f"id{i}".encode() for i in range(n_obs)])[keep]),
+                           "obs_value": (("obs_time"), 330 + rng.random(n_obs)[keep]),
+                           "obs_value_unc": (("obs_time"), 0.5 * rng.random(n_obs)[keep]),
+                           "CH4_R00": (("obs_time"), rng.random(n_obs)[keep].astype(np.float32))},
+                          coords={"obs_time": times[keep].astype("datetime64[ns]")})
+    codes, table = process_geos_output.site_table_codes(sites[keep])
+    combined["site_code"] = (("obs_time"), codes)
+    combined = combined.assign_coords(site_table=table)
+    combined["obs_value"][3] = np.nan
+    return combined
+
+def test_site_monthly_mean_matches_site_loop(fake_combined):
+    unique_sites = fake_combined["site_table"].values
+    obs = fake_combined.drop_vars(["site_code", "site_table"])
+    resampled_sites = []
+    for code in range(len(unique_sites)):
+        onesite = obs.where(fake_combined["site_code"] == code, drop=True)
+        onesite_resampled = onesite.resample(obs_time="M").mean()
+        onesite_resampled["obs_value_unc"] = process_geos_output.monthly_measurement_unc(onesite)
+        resampled_sites.append(onesite_resampled)
+    expected = xr.concat(resampled_sites, dim="site")
+    expected["site"] = (("site"), unique_sites)
+
+    func_out = process_geos_output.site_monthly_mean(fake_combined)
+
+    xr.testing.assert_allclose(expected, func_out)
+    assert list(expected.data_vars) == list(func_out.data_vars)
+    assert func_out["CH4_R00"].dtype == np.float32
+
+def test_site_monthly_measurement_unc_matches_one_site(fake_combined):
+    func_out = process_geos_output.site_monthly_measurement_unc(fake_combined)
+    onesite = fake_combined.where(fake_combined["site_code"] == 2, drop=True)
+    expected = process_geos_output.monthly_measurement_unc(onesite)
+
+    one_site_out = func_out.sel(site="cccNOAGsurf", obs_time=expected["obs_time"]).drop_vars("site")
+    xr.testing.assert_allclose(one_site_out, expected)
+
+def test_grouped_nanmedian():
+    values = np.array([3, np.nan, 1, 2, 10, 4, np.nan])
+    order = np.arange(len(values))
+    starts = np.array([0, 4, 6])
+
+    func_out = process_geos_output.grouped_nanmedian(values, order, starts)
+
+    assert func_out[0] == 2
+    assert func_out[1] == 7
+    assert np.isnan(func_out[2])
+
+def test_parse_iterators_single():
+    assert process_geos_output.parse_iterators("3") == [3]
+
+def test_parse_iterators_range_and_list():
+    assert process_geos_output.parse_iterators("0-3,7,9-10") == [0, 1, 2, 3, 7, 9, 10]
+
+def test_agage_site_map():
+    site_map = process_geos_output.agage_site_map(["CGO", "MHD"])
+    assert site_map == {"cgoAGAGEsurf": "cgoNOAGsurf", "cgoNOAAsurf": "cgoNOAGsurf",
+                        "mhdAGAGEsurf": "mhdNOAGsurf", "mhdNOAAsurf": "mhdNOAGsurf"}
+
+@pytest.fixture
+def fake_base_run(tmp_path):
+    output_dir = tmp_path / "base"
+    output_dir.mkdir()
+    times = pd.to_datetime(["2009-12-31 23:57", "2010-01-01 12:00", "2010-01-02 12:00", "2010-01-02 13:00"]).values
+    obspack_obs = xr.Dataset({"latitude": (("obs"), np.zeros(4)),
+                              "longitude": (("obs"), np.zeros(4)),
+                              "altitude": (("obs"), np.zeros(4)),
+                              "time": (("obs"), times),
+                              "obspack_id": (("obs"), np.array([b"id_1", b"id_2", b"id_3", b"id_4"])),
+                              "value": (("obs"), np.array([330.0, 330.0, 331.0, 660.0])),
+                              "value_unc": (("obs"), np.array([0.1, 0.1, 0.1, 0.1])),
+                              "network": (("obs"), np.array(["NOAAsurf", "NOAAsurf", "NOAAsurf", "AGAGEsurf"])),
+                              "site": (("obs"), np.array(["aaaNOAAsurf", "cgoNOAAsurf", "cgoNOAAsurf", "cgoAGAGEsurf"])),
+                              "baseline": (("obs"), np.array([1.0, 1.0, 1.0, 1.0]))},
+                             coords={"obs": np.array([1, 2, 3, 4])})
+    ds1 = xr.Dataset({"obspack_id": (("obs"), np.array([b"id_1", b"id_2"])),
+                      "CH4_R00": (("obs"), np.array([1e-7, 1e-7])),
+                      "CH4_R01": (("obs"), np.array([2e-7, 2e-7]))},
+                      coords={"obs": np.array([1, 2])})
+    ds2 = xr.Dataset({"obspack_id": (("obs"), np.array([b"id_3", b"id_4"])),
+                      "CH4_R00": (("obs"), np.array([1e-7, 3e-7])),
+                      "CH4_R01": (("obs"), np.array([2e-7, 2e-7]))},
+                      coords={"obs": np.array([1, 2])})
+    ds1.to_netcdf(output_dir / "GEOSChem.ObsPack.20100101_0000z.nc4")
+    ds2.to_netcdf(output_dir / "GEOSChem.ObsPack.20100102_0000z.nc4")
+    return output_dir, obspack_obs
+
+def test_combine_obs_geos_rescale_and_merge_sites(fake_base_run):
+    output_dir, obspack_obs = fake_base_run
+    obspack_geos = process_geos_output.read_geos(output_dir, obspack_obs, 1, 2010, 2010)
+    site_map = process_geos_output.agage_site_map(["CGO"])
+
+    combined = process_geos_output.combine_obs_geos(obspack_obs, obspack_geos, 2010, 2.0, site_map)
+
+    # 23:57 on the last day of 2009 is dropped
+    assert len(combined["obs_time"]) == 3
+    assert (combined["site_table"].values[combined["site_code"].values] == ["cgoNOAGsurf", "cgoNOAGsurf", "cgoNOAGsurf"]).all()
+    assert combined["site_code"].dtype.kind == "i"
+    assert (combined["obs_value"].values == [330.0, 331.0, 330.0]).all()
+
+def test_make_site_combined_base(fake_base_run):
+    output_dir, obspack_obs = fake_base_run
+    site_map = process_geos_output.agage_site_map(["CGO"])
+
+    site_combined = process_geos_output.make_site_combined(output_dir, obspack_obs, 1, 2010, 2010, 2.0, site_map,
+                                                           "base", "constant_met", pd.to_datetime("2016-01-01"))
+
+    assert (site_combined["site"].values == ["cgoNOAGsurf"]).all()
+    assert "baseline" not in site_combined
+    assert np.isclose(site_combined["obs_value"].item(), 991 / 3)
+    assert np.isclose(site_combined["CH4_sum"].item(), 1100 / 3)
+    assert site_combined["obspack_id"].item() == process_geos_output.monthly_mean_obspack_id("cgoNOAGsurf", "2010-01-31")
+
+def write_fake_geos_day(output_dir, day, scale=1):
+    ds = xr.Dataset({"obspack_id": (("obs"), [f"sitea_{day}", f"siteb_{day}"]),
+                     "CH4_R00": (("obs"), np.array([day, day]) * scale),
+                     "CH4_R01": (("obs"), np.array([2 * day, 3 * day]) * scale)},
+                     coords={"obs": np.array([1, 2])})
+    ds.to_netcdf(output_dir / f"GEOSChem.ObsPack.201001{day:02d}_0000z.nc4")
+
+@pytest.fixture
+def fake_obspack_obs():
+    obspack_ids = [f"site{ab}_{day}" for day in range(1, 11) for ab in "ab"]
+    return xr.Dataset({"obspack_id": (("obs"), obspack_ids)},
+                      coords={"obs": np.arange(100, 100 + len(obspack_ids))})
+
+def test_read_geos_incremental_matches_read_geos(tmp_path, fake_obspack_obs):
+    for day in range(1, 6):
+        write_fake_geos_day(tmp_path, day)
+
+    func_out = process_geos_output.read_geos_incremental(tmp_path, fake_obspack_obs, 1, 2010, 2010)
+    expected = process_geos_output.read_geos(tmp_path, fake_obspack_obs, 1, 2010, 2010)
+
+    xr.testing.assert_identical(expected, func_out)
+    assert (tmp_path / "read_geos_cache/manifest.json").is_file()
+
+def test_read_geos_incremental_only_reads_new(tmp_path, fake_obspack_obs):
+    for day in range(1, 6):
+        write_fake_geos_day(tmp_path, day)
+    process_geos_output.read_geos_incremental(tmp_path, fake_obspack_obs, 1, 2010, 2010)
+
+    # extend the run and change one existing day
+    for day in range(6, 9):
+        write_fake_geos_day(tmp_path, day)
+    write_fake_geos_day(tmp_path, 2, scale=10)
+    record = {}
+    func_out = process_geos_output.read_geos_incremental(tmp_path, fake_obspack_obs, 1, 2010, 2010, record=record)
+
+    assert record == {"files_read": 4, "files_reused": 4}
+    xr.testing.assert_identical(process_geos_output.read_geos(tmp_path, fake_obspack_obs, 1, 2010, 2010), func_out)
+    # the first chunk is still used by the unchanged days, so two chunks are kept
+    assert len(list((tmp_path / "read_geos_cache").glob("chunk_*.nc"))) == 2
+
+def test_read_geos_incremental_new_obs_rereads(tmp_path, fake_obspack_obs):
+    for day in range(1, 4):
+        write_fake_geos_day(tmp_path, day)
+    process_geos_output.read_geos_incremental(tmp_path, fake_obspack_obs, 1, 2010, 2010)
+
+    fake_obspack_obs["obs"] = fake_obspack_obs["obs"] + 1000
+    record = {}
+    func_out = process_geos_output.read_geos_incremental(tmp_path, fake_obspack_obs, 1, 2010, 2010, record=record)
+
+    assert record == {"files_read": 3, "files_reused": 0}
+    assert (func_out["obs"] == np.arange(1100, 1106)).all()
+    assert len(list((tmp_path / "read_geos_cache").glob("chunk_*.nc"))) == 1
+
+def test_read_geos_incremental_prunes_removed(tmp_path, fake_obspack_obs):
+    for day in range(1, 4):
+        write_fake_geos_day(tmp_path, day)
+    process_geos_output.read_geos_incremental(tmp_path, fake_obspack_obs, 1, 2010, 2010)
+    # the files removed in one step were read in an earlier chunk than the one kept
+    write_fake_geos_day(tmp_path, 4)
+    process_geos_output.read_geos_incremental(tmp_path, fake_obspack_obs, 1, 2010, 2010)
+
+    for day in range(1, 4):
+        (tmp_path / f"GEOSChem.ObsPack.201001{day:02d}_0000z.nc4").unlink()
+    func_out = process_geos_output.read_geos_incremental(tmp_path, fake_obspack_obs, 1, 2010, 2010)
+
+    xr.testing.assert_identical(process_geos_output.read_geos(tmp_path, fake_obspack_obs, 1, 2010, 2010), func_out)
+    manifest = process_geos_output.read_manifest(tmp_path / "read_geos_cache/manifest.json")
+    assert list(manifest["files"]) == ["GEOSChem.ObsPack.20100104_0000z.nc4"]
+    # the first chunk was only used by the removed files
+    assert len(list((tmp_path / "read_geos_cache").glob("chunk_*.nc"))) == 1
+
+def test_read_baseline_obs_cache_matches_netcdf(tmp_path):
+    times = pd.date_range("2009-12-30", "2011-01-02", freq="7D")
+    obspack_obs = xr.Dataset({"obspack_id": (("obs"), np.array([f"id_{i}" for i in range(len(times))], dtype="S200")),
+                              "time": (("obs"), times),
+                              "value": (("obs"), np.arange(len(times), dtype=float)),
+                              "baseline": (("obs"), np.ones(len(times), dtype=int)),
+                              "site": (("obs"), np.repeat("smoNOAAsurf", len(times)))},
+                             coords={"obs": np.arange(len(times))})
+    obs_file = tmp_path / "baseline_obs.nc"
+    obspack_obs.to_netcdf(obs_file)
+
+    expected = process_geos_output.read_baseline_obs(obs_file, 2010, 2010)
+    obs_cache.convert_obs_file(obs_file)
+    func_out = process_geos_output.read_baseline_obs(obs_file, 2010, 2010)
+
+    xr.testing.assert_identical(func_out, expected)
+    assert (func_out["time"] >= pd.to_datetime("2009-12-31 23:55")).all()
+    assert (func_out["time"] < pd.to_datetime("2010-12-31 23:55")).all()
@@ -0,0 +1,64 @@
+"""
+Tests tracers.py
+
+@author: Angharad Stell
+"""
+import numpy as np
+import pytest
+import xarray as xr
+
+from n2o_inv.intermediates import tracers
+
+@pytest.fixture
+def fake_tagged():
+    n_obs = 5
+    fake_tagged = xr.Dataset({f"CH4_R{i:02d}": (("obs"), np.arange(n_obs) + 10. * i) for i in range(3)},
+                             coords={"obs": np.arange(n_obs)})
+    fake_tagged["CH4_R00"].attrs["units"] = "ppb"
+    return fake_tagged
+
+
+def test_tracer_names():
+    assert tracers.tracer_names("emi_R", 3) == ["emi_R00", "emi_R01", "emi_R02"]
+
+def test_stack_tracers(fake_tagged):
+    stacked = tracers.stack_tracers(fake_tagged, "CH4_R", 3)
+
+    assert stacked.dims == ("region", "obs")
+    assert stacked.attrs["units"] == "ppb"
+    for i in range(3):
+        assert (stacked.sel(region=i) == fake_tagged[f"CH4_R{i:02d}"]).all()
+
+def test_stack_tracers_mismatched_dims(fake_tagged):
+    fake_tagged["CH4_R01"] = (("other"), np.arange(5.))
+
+    with pytest.raises(ValueError):
+        tracers.stack_tracers(fake_tagged, "CH4_R", 3)
+
+def test_unstack_tracers_round_trip(fake_tagged):
+    stacked = tracers.stack_tracers(fake_tagged, "CH4_R", 3)
+
+    xr.testing.assert_equal(tracers.unstack_tracers(stacked, "CH4_R"), fake_tagged)
+
+def test_sum_tracers_matches_loop(fake_tagged):
+    fake_tagged["CH4_R01"][2] = np.nan
+    expected = xr.zeros_like(fake_tagged["CH4_R00"])
+    for i in range(3):
+        expected += fake_tagged[f"CH4_R{i:02d}"]
+
+    func_out = tracers.sum_tracers(fake_tagged, "CH4_R", 3)
+
+    xr.testing.assert_identical(func_out, expected.rename(None))
+
+def test_sum_tracers_mismatched_dims(fake_tagged):
+    fake_tagged["CH4_R01"] = (("other"), np.arange(5.))
+
+    with pytest.raises(ValueError):
+        tracers.sum_tracers(fake_tagged, "CH4_R", 3)
+
+def test_tracer_total_matches_sum_tracers(fake_tagged):
+    fake_tagged["CH4_R01"][2] = np.nan
+
+    func_out = tracers.tracer_total(tracers.stack_tracers(fake_tagged, "CH4_R", 3))
+
+    xr.testing.assert_identical(func_out, tracers.sum_tracers(fake_tagged, "CH4_R", 3))
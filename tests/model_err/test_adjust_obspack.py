@@ -4,11 +4,12 @@ Tests adjust_obspack.py
 @author: Angharad Stell
 """
 import numpy as np
+import pandas as pd
 import pytest
 import xarray as xr
 
 from n2o_inv.model_err import adjust_obspack
-
+from n2o_inv.obs import format_obspack_geoschem
 
 
 @pytest.fixture
@@ -25,11 +26,107 @@ def fake_obspack_nc():
                                coords={"obs":np.array([1, 2, 3, 4, 5])})
     return test_obspack
 
-
-def test_surround_obspack_obs_floor(fake_obspack_nc):
+def old_surround_obspack(obspack_nc):
+    """ How adjust_obspack.py used to surround the obs, with k/9 added to the obs numbers.
+    """
+    offsets = [(-5.0, 0.0), (5.0, 0.0), (0.0, -4.0), (0.0, 4.0), (-5.0, -4.0), (5.0, -4.0), (5.0, 4.0), (-5.0, 4.0)]
+    boxes = [obspack_nc]
+    for k, (lon_offset, lat_offset) in enumerate(offsets, start=1):
+        box = obspack_nc.copy()
+        box["longitude"] = obspack_nc["longitude"] + lon_offset
+        box["latitude"] = obspack_nc["latitude"] + lat_offset
+        box["obs"] = obspack_nc["obs"] + k/9
+        new_ids = np.char.add(np.char.strip(obspack_nc["obspack_id"].values.astype(bytes)), f".{k}".encode())
+        box["obspack_id"].values = format_obspack_geoschem.pad_obspack_id(new_ids)
+        boxes.append(box)
+    merged = xr.merge(boxes)
+    merged["latitude"] = xr.where(merged["latitude"] > 90, 90.0, merged["latitude"])
+    merged["latitude"] = xr.where(merged["latitude"] < -90, -90.0, merged["latitude"])
+    merged["longitude"] = xr.where(merged["longitude"] < -180, 180 + (merged["longitude"] + 180), merged["longitude"])
+    merged["longitude"] = xr.where(merged["longitude"] >= 180, (merged["longitude"] - 180) - 180, merged["longitude"])
+    return merged
+
+
+def test_surround_obspack_obs_parent(fake_obspack_nc):
     func_out = adjust_obspack.surround_obspack(fake_obspack_nc)
     assert len(func_out.obs) == (len(fake_obspack_nc.obs) * 9)
-    assert (np.floor(func_out.obs.values) == np.repeat(fake_obspack_nc.obs.values, 9)).all()
+    assert (func_out.obs_parent.values == np.repeat(fake_obspack_nc.obs.values, 9)).all()
+    assert (func_out.stencil_index.values == np.tile(np.arange(9), 5)).all()
+    assert (func_out.obs.values == func_out.obs_parent.values * 9 + func_out.stencil_index.values).all()
+    assert func_out.obs.dtype.kind == "i"
+
+def test_surround_obspack_matches_old(fake_obspack_nc):
+    expected = old_surround_obspack(fake_obspack_nc)
+
+    func_out = adjust_obspack.surround_obspack(fake_obspack_nc)
+
+    np.testing.assert_array_equal(func_out.longitude, expected.longitude)
+    np.testing.assert_array_equal(func_out.latitude, expected.latitude)
+    np.testing.assert_array_equal(func_out.obspack_id, expected.obspack_id)
+    np.testing.assert_array_equal(np.floor(expected.obs), func_out.obs_parent)
+
+def test_surround_obspack_keeps_dtype(fake_obspack_nc):
+    fake_obspack_nc["longitude"] = fake_obspack_nc["longitude"].astype(np.float32)
+    fake_obspack_nc["value"] = (("obs"), np.arange(5, dtype=np.int32))
+
+    func_out = adjust_obspack.surround_obspack(fake_obspack_nc)
+
+    assert func_out.longitude.dtype == np.float32
+    assert func_out.latitude.dtype == np.float64
+    assert func_out.value.dtype == np.int32
+    assert (func_out.value.values == np.repeat(np.arange(5), 9)).all()
+
+def test_make_stencil_default():
+    func_out = adjust_obspack.make_stencil()
+
+    np.testing.assert_array_equal(func_out[0], [0, 0, 0])
+    assert {tuple(box) for box in func_out} == {tuple(box) for box in adjust_obspack.SURROUNDING_BOXES}
+
+def test_make_stencil_levels():
+    func_out = adjust_obspack.make_stencil(5, 5, altitudes=(-100.0, 0.0, 100.0))
+
+    assert func_out.shape == (75, 3)
+    np.testing.assert_array_equal(func_out[0], [0, 0, 0])
+    assert len(np.unique(func_out, axis=0)) == 75
+    assert func_out[:, 0].max() == 10
+    assert func_out[:, 1].min() == -8
+
+def test_make_stencil_even():
+    with pytest.raises(ValueError):
+        adjust_obspack.make_stencil(4, 3)
+
+def test_stencil_obspack_levels(fake_obspack_nc):
+    fake_obspack_nc["altitude"] = (("obs"), np.array([10.0, 20.0, 30.0, 40.0, 50.0]))
+    stencil = adjust_obspack.make_stencil(5, 5, altitudes=(0.0, 100.0))
+
+    func_out = adjust_obspack.stencil_obspack(fake_obspack_nc, stencil)
+
+    assert len(func_out.obs) == 5 * 50
+    assert len(np.unique(func_out.obs)) == 5 * 50
+    # -180 - 5 and -180 - 10 wrap round
+    assert set(func_out.longitude.values[0:50]) == {-180, -175, -170, 170, 175}
+    assert (func_out.latitude[0:50] == -90).sum() == 2 * 5 * 3
+    assert (func_out.altitude[0:50] == 110).sum() == 25
+    assert func_out.obspack_id[0] == fake_obspack_nc.obspack_id[0]
+    assert func_out.obspack_id.values[49].strip().endswith(b"Event~1.49")
+
+def test_adjust_daily_obspacks_parallel(tmp_path, fake_obspack_nc):
+    dates = pd.date_range("2010-01-01", "2010-01-04")
+    # no obs on the third day
+    for date in dates[[0, 1, 3]]:
+        fake_obspack_nc.to_netcdf(format_obspack_geoschem.daily_obspack_filename(tmp_path, date))
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+
+    assert adjust_obspack.adjust_daily_obspacks(tmp_path, tmp_path / "serial", dates) == 3
+    assert adjust_obspack.adjust_daily_obspacks(tmp_path, tmp_path / "parallel", dates, n_workers=2) == 3
+
+    for date in dates[[0, 1, 3]]:
+        with xr.open_dataset(format_obspack_geoschem.daily_obspack_filename(tmp_path / "serial", date)) as serial, \
+             xr.open_dataset(format_obspack_geoschem.daily_obspack_filename(tmp_path / "parallel", date)) as parallel:
+            xr.testing.assert_identical(serial.load(), parallel.load())
+            xr.testing.assert_identical(serial.load(), adjust_obspack.surround_obspack(fake_obspack_nc))
+    assert not format_obspack_geoschem.daily_obspack_filename(tmp_path / "serial", dates[2]).exists()
 
 
 def test_surround_obspack_lon_neg180(fake_obspack_nc):
@@ -0,0 +1,157 @@
+"""
+Tests calc_model_err.py
+
+@author: Angharad Stell
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from n2o_inv.model_err import calc_model_err
+from n2o_inv.obs import obs_baseline
+
+@pytest.fixture
+def fake_combined():
+    """ Like combined.nc, the 9 boxes around each obs with the obs_time of the obs.
+    """
+    rng = np.random.default_rng(0)
+    site_months = {"CGO": ["2010-01", "2010-03"], "MHD": ["2010-06", "2010-07"], "SMO": ["2010-02", "2010-03"]}
+    sites, times = [], []
+    for site, months in site_months.items():
+        for month in months:
+            n_obs = rng.integers(1, 20)
+            sites.append(np.repeat(site, n_obs))
+            times.append(np.datetime64(f"{month}-01", "ns") + rng.integers(0, 27 * 24 * 3600, n_obs).astype("timedelta64[s]"))
+    sites, times = np.concatenate(sites).astype(object), np.concatenate(times)
+    # obs are in time order
+    order = np.argsort(times, kind="stable")
+    sites, times = sites[order], times[order]
+
+    n_obs = len(times)
+    obs_parent = np.repeat(np.arange(n_obs) + 50, 9)
+    stencil_index = np.tile(np.arange(9), n_obs)
+    combined = xr.Dataset({"obs_parent": (("obs_time"), obs_parent.astype(float)),
+                           "stencil_index": (("obs_time"), stencil_index.astype(float)),
+                           "CH4_sum": (("obs_time"), (325 + rng.normal(size=9 * n_obs)).astype(np.float32)),
+                           "site_code": (("obs_time"), np.repeat(np.unique(sites, return_inverse=True)[1], 9))},
+                          coords={"obs_time": np.repeat(times, 9),
+                                  "obs": (("obs_time"), obs_parent * 9 + stencil_index),
+                                  "site_table": np.unique(sites).astype(str)})
+    return combined
+
+@pytest.fixture
+def fake_stage_files(tmp_path):
+    """ Fake obspack, baseline and geoschem files.
+    """
+    files = []
+    for name in ["obspack_n2o.20100101.nc", "NAME_baseline_MHD_2010.nc", "GEOSChem.ObsPack.20100101_0000z.nc4"]:
+        (tmp_path / name).write_text(name)
+        files.append([tmp_path / name])
+    return files
+
+def fake_stage_keys(fake_stage_files):
+    return calc_model_err.stage_keys(*fake_stage_files, 3, ["MHD"], 1.0, pd.Timestamp("2009-01-01"),
+                                     pd.Timestamp("2010-01-01"), pd.Timestamp("2011-01-01"))
+
+
+def test_month_end():
+    func_out = calc_model_err.month_end(np.array(["2010-01-01T03", "2010-02-28T23", "2012-02-03"],
+                                                 dtype="datetime64[ns]"))
+
+    assert func_out.astype("datetime64[D]").astype(str).tolist() == ["2010-01-31", "2010-02-28", "2012-02-29"]
+
+def test_stencil_model_std():
+    rng = np.random.default_rng(1)
+    ch4_sum = rng.normal(size=27)
+    # shuffled, but all the boxes are there
+    order = rng.permutation(27)
+    obs_parent = np.repeat([3, 1, 2], 9)[order]
+    stencil_index = np.tile(np.arange(9), 3)[order]
+
+    centre, model_std = calc_model_err.stencil_model_std(obs_parent, stencil_index, ch4_sum[order])
+
+    assert (obs_parent[centre] == [1, 2, 3]).all()
+    assert (stencil_index[centre] == 0).all()
+    np.testing.assert_allclose(model_std, ch4_sum.reshape(3, 9)[[1, 2, 0]].std(axis=1))
+
+def test_stencil_model_std_missing_box():
+    obs_parent = np.repeat([1, 2], 9)[1:]
+    stencil_index = np.tile(np.arange(9), 2)[1:]
+
+    with pytest.raises(ValueError):
+        calc_model_err.stencil_model_std(obs_parent, stencil_index, np.ones(17))
+
+def test_stencil_model_std_nan():
+    ch4_sum = np.arange(18.)
+    ch4_sum[3] = np.nan
+
+    centre, model_std = calc_model_err.stencil_model_std(np.repeat([1, 2], 9), np.tile(np.arange(9), 2), ch4_sum)
+
+    np.testing.assert_allclose(model_std, [np.nanstd(ch4_sum[:9]), np.std(ch4_sum[9:])])
+
+def test_reshape_model_err_matches_per_site(tmp_path, fake_combined):
+    unique_sites = fake_combined["site_table"].values
+    expected = calc_model_err.per_site_model_err(fake_combined, unique_sites)
+
+    func_out = calc_model_err.reshape_model_err(fake_combined, unique_sites)
+
+    # months in the middle of a site's months are kept, April and May aren't in any
+    assert len(func_out["obs_time"]) == 5
+    assert np.isnan(func_out.sel(site="CGO")).sum() == 3
+    xr.testing.assert_allclose(func_out, expected)
+    # and the saved files are the same
+    func_out.to_netcdf(tmp_path / "func_out.nc")
+    expected.to_netcdf(tmp_path / "expected.nc")
+    with xr.open_dataset(tmp_path / "func_out.nc") as func_load, xr.open_dataset(tmp_path / "expected.nc") as expected_load:
+        xr.testing.assert_identical(func_load.load(), expected_load.load())
+
+def test_rescale_and_merge_sites():
+    combined = xr.Dataset({"obs_value": (("obs_time"), np.array([330., 330., 330.])),
+                           "network": (("obs_time"), np.array(["AGAGEsurf", "NOAAsurf", "NOAAsurf"], dtype=object)),
+                           "site": (("obs_time"), np.array(["mhdAGAGEsurf", "mhdNOAAsurf", "spoNOAAsurf"], dtype=object))},
+                          coords={"obs_time": np.arange(3)})
+    before = combined.copy(deep=True)
+
+    func_out = calc_model_err.rescale_and_merge_sites(combined, 1.1, ["MHD"])
+
+    np.testing.assert_allclose(func_out["obs_value"], [300., 330., 330.])
+    assert func_out["site_table"].values[func_out["site_code"].values].tolist() == ["mhdNOAGsurf", "mhdNOAGsurf", "spoNOAAsurf"]
+    assert "site" not in func_out
+    # the stage before isn't changed, as it may be reused
+    xr.testing.assert_identical(combined, before)
+
+@pytest.mark.parametrize("change", [{"BASELINE_RULES_VERSION": obs_baseline.BASELINE_RULES_VERSION + 1},
+                                    {"DODGY_SITES": obs_baseline.DODGY_SITES[1:]}])
+def test_stage_keys_baseline_rules(fake_stage_files, monkeypatch, change):
+    before = fake_stage_keys(fake_stage_files)
+
+    for name, value in change.items():
+        monkeypatch.setattr(obs_baseline, name, value)
+    func_out = fake_stage_keys(fake_stage_files)
+
+    # the obs are reused, the baseline and everything that uses it is redone
+    assert func_out["raw_obs"] == before["raw_obs"]
+    for stage in ["baseline", "geos", "merge", "site_codes"]:
+        assert func_out[stage] != before[stage]
+
+def test_perturbation_baseline():
+    times = np.array(["2009-12-31T23:56", "2010-01-01T00:00", "2010-05-01", "2011-01-01"], dtype="datetime64[ns]")
+    baseline = np.array([1., 1., 0., 1.])
+
+    func_out = calc_model_err.perturbation_baseline(times, baseline, pd.Timestamp("2010-03-01"))
+
+    assert func_out.tolist() == [False, True, False, True]
+    # the same for the combined.nc variables
+    combined = xr.Dataset({"baseline": (("obs_time"), baseline)}, coords={"obs_time": times})
+    assert (calc_model_err.perturbation_baseline(combined["obs_time"], combined["baseline"],
+                                                 pd.Timestamp("2010-03-01")).values == func_out).all()
+
+def test_merge_obs_geos_old_obspack():
+    # obs made before adjust_obspack.py added obs_parent and stencil_index
+    obspack_baseline = xr.Dataset({"time": (("obs"), np.array(["2010-01-01"], dtype="datetime64[ns]")),
+                                   "stencil_index": (("obs"), np.array([0]))},
+                                  coords={"obs": np.array([0])})
+
+    with pytest.raises(ValueError, match="adjust_obspack.py"):
+        calc_model_err.merge_obs_geos(obspack_baseline, xr.Dataset(), pd.Timestamp("2010-01-01"))
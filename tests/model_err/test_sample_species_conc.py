@@ -0,0 +1,140 @@
+"""
+Tests sample_species_conc.py
+
+@author: Angharad Stell
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from n2o_inv.model_err import adjust_obspack, sample_species_conc
+
+NO_REGIONS = 3
+LAT = np.concatenate([[-89.], np.arange(-86., 87., 4.), [89.]])
+LON = np.arange(-180., 180., 5.)
+HYAM = np.array([0., 50., 100.])
+HYBM = np.array([0.99, 0.8, 0.4])
+
+def write_fake_species_conc(out_dir, times, rng):
+    """ A GEOSChem.SpeciesConc file for the first of the times' month, with those time steps.
+    """
+    shape = (len(times), len(HYAM), len(LAT), len(LON))
+    species_conc = xr.Dataset({f"SpeciesConc_CH4_R{region:02d}": (("time", "lev", "lat", "lon"),
+                                                                   rng.uniform(1e-8, 2e-8, shape))
+                               for region in range(NO_REGIONS)},
+                              coords={"time": times, "lev": np.arange(len(HYAM)), "lat": LAT, "lon": LON})
+    species_conc["hyam"] = (("lev"), HYAM)
+    species_conc["hybm"] = (("lev"), HYBM)
+    species_conc["P0"] = 1000.
+    species_conc_file = out_dir / f"GEOSChem.SpeciesConc.{pd.Timestamp(times[0]).strftime('%Y%m%d')}_0000z.nc4"
+    species_conc.to_netcdf(species_conc_file)
+    return species_conc_file
+
+@pytest.fixture
+def fake_species_conc(tmp_path):
+    rng = np.random.default_rng(0)
+    return [write_fake_species_conc(tmp_path, [np.datetime64(f"2010-{month:02d}-01", "ns")], rng)
+            for month in range(1, 4)]
+
+@pytest.fixture
+def fake_obs():
+    rng = np.random.default_rng(1)
+    n_obs = 150
+    start = np.datetime64("2010-01-01", "ns")
+    times = start + np.sort(rng.integers(0, 90 * 24 * 3600, n_obs)).astype("timedelta64[s]")
+    sites = rng.choice(["MHD", "SPO", "ZEP"], n_obs)
+    return xr.Dataset({"longitude": (("obs"), rng.uniform(-180., 180., n_obs)),
+                       "latitude": (("obs"), rng.choice([-89.5, -88.1, -50., 0.7, 30.3, 87.9, 90.], n_obs)),
+                       "altitude": (("obs"), rng.uniform(0., 6000., n_obs)),
+                       "time": (("obs"), times),
+                       "site": (("obs"), sites),
+                       "site_code": (("obs"), np.unique(sites, return_inverse=True)[1])},
+                      coords={"obs": np.arange(n_obs) + 100, "site_table": np.unique(sites)})
+
+def old_model_err(species_conc_files, obspack_obs):
+    """ The model err from the cells around the obs, done per box and site as in calc_model_err.py.
+    """
+    with xr.open_mfdataset(species_conc_files) as load:
+        species_conc = load.load()
+    ch4_sum = sum(species_conc[f"SpeciesConc_CH4_R{region:02d}"] for region in range(NO_REGIONS)) * 1e9
+    ch4_sum["lev"] = np.log((HYAM + HYBM * 1000.)/1000) * -7640
+
+    obspack_obs = obspack_obs.copy()
+    obspack_obs["obspack_id"] = (("obs"), np.repeat(b"id", len(obspack_obs["obs"])))
+    boxes = adjust_obspack.surround_obspack(obspack_obs)
+    # nearest longitude, going round the globe
+    box_lon = LON[np.round((boxes["longitude"].values + 180) / 5).astype(int) % len(LON)]
+    sampled = [float(ch4_sum.sel(time=time, method="ffill").sel(lev=alt, lat=lat, method="nearest").sel(lon=lon))
+               for time, alt, lat, lon in zip(boxes["time"].values, boxes["altitude"].values,
+                                              boxes["latitude"].values, box_lon)]
+    boxes["CH4_sum"] = (("obs"), np.array(sampled))
+    boxes = boxes.assign_coords(obs_time=boxes["time"]).swap_dims({"obs": "obs_time"})
+
+    resampled_sites = []
+    unique_sites = np.unique(boxes["site"])
+    for site in unique_sites:
+        onesite = boxes.where(boxes["site"] == site, drop=True)
+        onesite_ninth = onesite.where(onesite["stencil_index"] == 0, drop=True)
+        model_std = onesite[["CH4_sum", "obs_parent"]].groupby("obs_parent").std()
+        onesite_ninth["model_std"] = (("obs_time"), model_std["CH4_sum"].values)
+        resampled_sites.append(onesite_ninth["model_std"].resample(obs_time="M").median())
+    site_combined = xr.concat(resampled_sites, dim="site")
+    site_combined["site"] = (("site"), unique_sites)
+    return site_combined
+
+
+def test_level_heights():
+    func_out = sample_species_conc.level_heights(HYAM, HYBM, 1000.)
+
+    assert func_out[0] == pytest.approx(-7640 * np.log(0.99))
+    assert (np.diff(func_out) > 0).all()
+
+def test_nearest_lon_index():
+    func_out = sample_species_conc.nearest_lon_index(LON, np.array([-180., -177.6, 177.6, 179.9, 0.1, 2.6]))
+
+    assert func_out.tolist() == [0, 0, 0, 0, 36, 37]
+
+def test_stencil_std():
+    field = np.arange(2 * 4).reshape(2, 1, 2, 2).astype(float)
+
+    func_out = sample_species_conc.stencil_std(field, np.array([0, 1]), np.array([[0, 1], [0, 3]]))
+
+    np.testing.assert_array_equal(func_out, [np.std([0., 1.]), np.std([4., 7.])])
+
+def test_stream_model_err_matches_old(fake_species_conc, fake_obs):
+    expected = old_model_err(fake_species_conc, fake_obs)
+
+    monthly = list(sample_species_conc.stream_model_err(fake_species_conc, fake_obs, NO_REGIONS))
+    func_out = sample_species_conc.combine_model_err(monthly, expected["site"].values)
+
+    # one month at a time
+    assert len(monthly) == 3
+    assert [len(month["obs_time"]) for month in monthly] == [1, 1, 1]
+    xr.testing.assert_allclose(func_out.drop_vars("site"), expected.drop_vars("site"))
+    assert (func_out["site"].values == expected["site"].values).all()
+
+def test_stream_model_err_split_months(tmp_path, fake_obs):
+    # output every 10 days, in files that don't line up with the months
+    rng = np.random.default_rng(2)
+    times = pd.date_range("2010-01-01", "2010-04-01", freq="10D").values
+    species_conc_files = [write_fake_species_conc(tmp_path, times[i:i + 2], rng) for i in range(0, len(times), 2)]
+    expected = old_model_err(species_conc_files, fake_obs)
+
+    monthly = list(sample_species_conc.stream_model_err(species_conc_files, fake_obs, NO_REGIONS))
+    func_out = sample_species_conc.combine_model_err(monthly, expected["site"].values)
+
+    assert len(np.concatenate([month["obs_time"].values for month in monthly])) == 3
+    xr.testing.assert_allclose(func_out.drop_vars("site"), expected.drop_vars("site"))
+
+def test_sample_model_std_before_output(fake_species_conc, fake_obs):
+    fake_obs["time"].values[:5] = np.datetime64("2009-12-31", "ns")
+
+    positions = np.concatenate([positions for positions, _ in
+                                sample_species_conc.sample_model_std(fake_species_conc, fake_obs, NO_REGIONS)])
+
+    assert positions.tolist() == list(range(5, len(fake_obs["obs"])))
+
+def test_sample_model_std_no_files(fake_obs):
+    with pytest.raises(IOError):
+        next(sample_species_conc.sample_model_std([], fake_obs, NO_REGIONS))
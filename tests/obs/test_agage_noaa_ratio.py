@@ -0,0 +1,85 @@
+"""
+Tests agage_noaa_ratio.py
+
+@author: Angharad Stell
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from n2o_inv.obs import agage_noaa_ratio
+
+@pytest.fixture
+def fake_site_obs():
+    rng = np.random.default_rng(0)
+    start = np.datetime64("2010-01-01T00:00:00", "ns")
+
+    agage_times = start + np.sort(rng.integers(0, 10 * 24 * 3600, 200)).astype("timedelta64[s]")
+    # NOAA times near some of the AGAGE times (including exactly 15 mins away), and some random
+    near = agage_times[::7] + rng.choice([-900, -899, 0, 300, 899, 900], len(agage_times[::7])).astype("timedelta64[s]")
+    noaa_times = np.concatenate([near, start + rng.integers(0, 10 * 24 * 3600, 50).astype("timedelta64[s]")])
+    noaa_times = noaa_times + rng.integers(-2, 3, len(noaa_times)).astype("timedelta64[ms]")
+    noaa_values = 325 + rng.normal(size=len(noaa_times))
+    noaa_values[::11] = np.nan
+
+    n_agage, n_noaa = len(agage_times), len(noaa_times)
+    obspack_obs = xr.Dataset({"time": (("obs"), np.concatenate([agage_times, noaa_times])),
+                              "value": (("obs"), np.concatenate([325 + rng.normal(size=n_agage), noaa_values]))},
+                             coords={"obs": np.arange(n_agage + n_noaa)})
+    site_names = np.array(["mhdAGAGEsurf"] * n_agage + ["mhdNOAAsurf"] * n_noaa)
+    return obspack_obs, site_names
+
+def old_match_noaa(agage_site, noaa_site):
+    """ How agage_noaa_ratio.py used to match the obs.
+    """
+    agage_site = agage_site.copy()
+    agage_site["noaa_value"] = xr.full_like(agage_site["value"], np.nan, dtype=np.double)
+    for obs in range(len(agage_site["obs"])):
+        time_diff = abs((agage_site["time"][obs] - noaa_site["time"]) / 1E9).astype(int)
+        close_times = time_diff < (15 * 60)
+        if any(close_times):
+            agage_site["noaa_value"][obs] = noaa_site.where(close_times, drop=True)["value"].mean()
+    agage_site["agage-noaa_ratio"] = agage_site["value"] / agage_site["noaa_value"]
+    return agage_site
+
+
+def test_window_bounds_open_interval():
+    sorted_times = np.array([0, 10, 20, 30])
+
+    starts, stops = agage_noaa_ratio.window_bounds(sorted_times, np.array([20, 5, 100]), 10)
+
+    assert starts.tolist() == [2, 0, 4]
+    assert stops.tolist() == [3, 2, 4]
+
+def test_window_nanmean():
+    sorted_times = np.array([0, 1, 2, 10])
+    values = np.array([1., np.nan, 3., 5.])
+
+    func_out = agage_noaa_ratio.window_nanmean(sorted_times, values, np.array([1, 10, 6, 1.5]), 2)
+
+    np.testing.assert_array_equal(func_out, [2., 5., np.nan, 2.])
+
+def test_match_noaa_matches_old(fake_site_obs):
+    obspack_obs, site_names = fake_site_obs
+    agage_site, noaa_site = agage_noaa_ratio.site_obs(obspack_obs, site_names, "MHD")
+    expected = old_match_noaa(agage_site, noaa_site)
+
+    func_out = agage_noaa_ratio.match_noaa(agage_site, noaa_site)
+
+    assert np.isfinite(func_out["noaa_value"]).sum() > 10
+    xr.testing.assert_allclose(func_out, expected)
+    assert (np.isnan(func_out["noaa_value"]) == np.isnan(expected["noaa_value"])).all()
+
+def test_match_sites_parallel(fake_site_obs):
+    obspack_obs, site_names = fake_site_obs
+    # a second site, with the same obs
+    obspack_obs = xr.concat([obspack_obs, obspack_obs.assign_coords(obs=obspack_obs["obs"] + 1000)], dim="obs")
+    site_names = np.concatenate([site_names, np.char.replace(site_names, "mhd", "cgo")])
+
+    serial = agage_noaa_ratio.match_sites(obspack_obs, site_names, ["MHD", "CGO"])
+    parallel = agage_noaa_ratio.match_sites(obspack_obs, site_names, ["MHD", "CGO"], n_workers=2)
+
+    for serial_site, parallel_site in zip(serial, parallel):
+        xr.testing.assert_identical(serial_site, parallel_site)
+    assert (serial[1]["obs"] >= 1000).all()
@@ -11,6 +11,12 @@ from n2o_inv.obs import agage_obs
 def test_dt2cal():
     assert agage_obs.dt2cal(np.datetime64("2012-02-29T12:57:09")) == [2012, 2, 29, 12, 57, 9]
 
+def test_dt2cal_array():
+    dt = np.array(["2012-02-29T12:57:09", "1999-12-31T23:59:59"], dtype="datetime64[ns]")
+    func_out = agage_obs.dt2cal_array(dt)
+    assert func_out.shape == (2, 6)
+    assert func_out.tolist() == [[2012, 2, 29, 12, 57, 9], [1999, 12, 31, 23, 59, 59]]
+
 def test_create_obspack_id():
     site = "ABC"
     year = 2012
@@ -20,6 +26,17 @@ def test_create_obspack_id():
     assert agage_obs.create_obspack_id(site, year, month, day, identifier) == \
         b"obspack_multi-species_1_AGAGEInSitu_v1.0_2012-02-29~n2o_abc_surface-insitu_1_agage_Event~999"
 
+def test_create_obspack_ids_matches_scalar():
+    years = np.array([2012., 1999.])
+    months = np.array([2., 12.])
+    days = np.array([29., 1.])
+    identifiers = np.array([999, 1000])
+    func_out = agage_obs.create_obspack_ids("ABC", years, months, days, identifiers)
+    expected = np.array([agage_obs.create_obspack_id("ABC", years[i], months[i], days[i], identifiers[i])
+                         for i in range(2)])
+    assert func_out.dtype == expected.dtype
+    assert (func_out == expected).all()
+
 def test_create_noaa_style_flag():
     status_flag = np.array([0, 1])
     correct_answer = [b"...", b"a.."]
@@ -36,4 +53,8 @@ def test_datetime_to_unix_month():
     assert agage_obs.datetime_to_unix(np.datetime64("1970-02-01T00:00:00")) == (60*60*24*31)
 
 def test_datetime_to_unix_year():
-    assert agage_obs.datetime_to_unix(np.datetime64("1971-01-01T00:00:00")) == (60*60*24*365)
\ No newline at end of file
+    assert agage_obs.datetime_to_unix(np.datetime64("1971-01-01T00:00:00")) == (60*60*24*365)
+
+def test_create_noaa_style_flags():
+    status_flag = np.array([0, 1, 2, 0])
+    assert (agage_obs.create_noaa_style_flags(status_flag) == np.array([b"...", b"a..", b"a..", b"..."])).all()
@@ -13,20 +13,6 @@ import xarray as xr
 
 from n2o_inv.obs import format_obspack_geoschem
 
-def test_date_mask():
-    days = range(1, 30)
-    time_comp_list = np.array([[2012, 2, D, 9, 7, 0] for D in days])
-
-    df = xr.Dataset({"time_components": (("obs", "calendar_components"), time_comp_list)},
-                    coords={"obs": days, "calendar_components": range(6)})
-
-    desired_date = pd.date_range("2012-02-15", "2012-02-15", freq="D")[0]   
-
-    desired_mask = np.array([False]*len(days))
-    desired_mask[14] = True
-
-    assert (format_obspack_geoschem.date_mask(df, desired_date) == desired_mask).all()
-
 def test_preprocess_surface():
     in_df = xr.Dataset({"latitude":(("obs"), np.array([0])),
                         "longitude":(("obs"), np.array([0])), 
@@ -95,24 +81,246 @@ def test_read_noaa_obspack_runs():
     filename = noaa_obspack_file()
     format_obspack_geoschem.read_noaa_obspack(filename)
 
-def test_geoschem_date_mask_2355():
-    df = xr.Dataset({"time_components":(("obs", "calendar_components"), [[2012, 2, 29, 23, 55, 0]]),
-                     "fake_value":(("obs"), np.array([300]))},
-                     coords={"obs": np.array([888]), "calendar_components": range(6)})
+@pytest.fixture
+def fake_sorted_obspack():
+    rng = np.random.default_rng(1)
+    # plenty of obs near 23.55
+    times = pd.to_datetime("2012-02-27") + pd.to_timedelta(np.sort(rng.integers(0, 5 * 24 * 60, 200)), unit="min")
+    times = times.append(pd.DatetimeIndex(["2012-02-28 23:55", "2012-02-28 23:54:59", "2012-02-29 23:55:00"])).sort_values()
+    time_components = np.stack([times.year, times.month, times.day, times.hour, times.minute, times.second], axis=1)
+    seconds = ((times - pd.Timestamp("1970-01-01")) // pd.Timedelta(1, "s")).to_numpy()
+    obspack_data = xr.Dataset({"time": (("obs"), seconds),
+                               "time_components": (("obs", "calendar_components"), time_components),
+                               "obspack_id": (("obs"), np.array([f"id~{i}".encode() for i in range(len(times))], dtype=object)),
+                               "value": (("obs"), rng.normal(325, 1, len(times)))},
+                              coords={"obs": np.arange(len(times))})
+    # as in the script, the data has been through where before being split into days
+    return obspack_data.where(obspack_data["value"] > 0)
 
+def geoschem_days_with_obs(time, dates):
+    # which of the geoschem days a single obs is read on
+    seconds = ((pd.DatetimeIndex([time]) - pd.Timestamp("1970-01-01")) // pd.Timedelta(1, "s")).to_numpy()
+    starts, stops = format_obspack_geoschem.geoschem_day_bounds(seconds, dates)
+    return list((starts == 0) & (stops == 1))
 
+def test_geoschem_day_bounds_2355():
     dates = pd.date_range("2012-02-28", "2012-03-01")
-    correct_answer = [False, False, True, False]
-    for i in range(len(dates)):
-        assert format_obspack_geoschem.geoschem_date_mask(df, dates[i]) == correct_answer[i]
+    assert geoschem_days_with_obs("2012-02-29 23:55", dates) == [False, False, True]
 
-def test_geoschem_date_mask_2354():
-    df = xr.Dataset({"time_components":(("obs", "calendar_components"), [[2012, 2, 29, 23, 54, 0]]),
-                     "fake_value":(("obs"), np.array([300]))},
-                     coords={"obs": np.array([888]), "calendar_components": range(6)})
+def test_geoschem_day_bounds_2354():
+    dates = pd.date_range("2012-02-28", "2012-03-01")
+    assert geoschem_days_with_obs("2012-02-29 23:54", dates) == [False, True, False]
 
+def test_geoschem_day_bounds_several():
+    times = pd.DatetimeIndex(["2012-02-28 23:54:59", "2012-02-28 23:55"])
+    seconds = ((times - pd.Timestamp("1970-01-01")) // pd.Timedelta(1, "s")).to_numpy()
 
-    dates = pd.date_range("2012-02-28", "2012-03-01")
-    correct_answer = [False, True, False, False]
-    for i in range(len(dates)):
-        assert format_obspack_geoschem.geoschem_date_mask(df, dates[i]) == correct_answer[i]
+    starts, stops = format_obspack_geoschem.geoschem_day_bounds(seconds, pd.date_range("2012-02-28", "2012-02-29"))
+
+    assert (starts == [0, 1]).all()
+    assert (stops == [1, 2]).all()
+
+def test_geoschem_day_bounds_unsorted():
+    with pytest.raises(ValueError):
+        format_obspack_geoschem.geoschem_day_bounds(np.array([2, 1]), pd.date_range("2012-02-28", "2012-02-29"))
+
+def test_pad_obspack_id():
+    obspack_ids = np.array([b"abc", b"x" * 250], dtype=object)
+
+    func_out = format_obspack_geoschem.pad_obspack_id(obspack_ids)
+
+    assert func_out[0] == b"abc" + b" " * 197
+    assert func_out[1] == b"x" * 250
+
+def assert_same_obspack_file(func_out_file, expected_file):
+    # the same obs as the old way, which didn't save a fingerprint
+    with xr.open_dataset(func_out_file) as func_out, xr.open_dataset(expected_file) as expected:
+        assert func_out.attrs.pop(format_obspack_geoschem.FINGERPRINT_ATTR) is not None
+        xr.testing.assert_identical(func_out, expected)
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_write_daily_obspacks(tmp_path, n_workers):
+    times = pd.DatetimeIndex(["2012-02-27 10:00", "2012-02-27 23:54:59", "2012-02-27 23:55",
+                              "2012-02-28 12:00", "2012-02-28 23:59", "2012-03-01 23:55"])
+    seconds = ((times - pd.Timestamp("1970-01-01")) // pd.Timedelta(1, "s")).to_numpy()
+    obspack_data = xr.Dataset({"time": (("obs"), seconds),
+                               "obspack_id": (("obs"), format_obspack_geoschem.pad_obspack_id(
+                                   [f"id~{i}".encode() for i in range(len(times))])),
+                               "value": (("obs"), np.arange(len(times), dtype=float))},
+                              coords={"obs": np.arange(len(times))})
+    # the day starts at 23.55 the day before, and 2012-03-01 has no obs
+    expected = {"20120227": [0, 1], "20120228": [2, 3], "20120229": [4], "20120302": [5]}
+
+    written, skipped = format_obspack_geoschem.write_daily_obspacks(obspack_data, pd.date_range("2012-02-26", "2012-03-03"),
+                                                                   tmp_path, n_workers)
+
+    assert (written, skipped) == (len(expected), 0)
+    assert sorted(path.name for path in tmp_path.glob("*.nc")) == [f"obspack_n2o.{day}.nc" for day in expected]
+    for day, obs in expected.items():
+        with xr.open_dataset(tmp_path / f"obspack_n2o.{day}.nc") as load:
+            assert load.attrs.pop(format_obspack_geoschem.FINGERPRINT_ATTR) is not None
+            xr.testing.assert_identical(load, obspack_data.isel(obs=obs))
+
+def test_write_daily_obspacks_skips_existing(tmp_path, fake_sorted_obspack):
+    dates = pd.date_range("2012-02-27", "2012-03-02")
+    written, _ = format_obspack_geoschem.write_daily_obspacks(fake_sorted_obspack, dates, tmp_path)
+
+    assert format_obspack_geoschem.write_daily_obspacks(fake_sorted_obspack, dates, tmp_path) == (0, written)
+    assert format_obspack_geoschem.write_daily_obspacks(fake_sorted_obspack, dates, tmp_path,
+                                                        overwrite=True) == (written, 0)
+    # no temporary files left behind
+    assert len(list(tmp_path.glob(".*"))) == 0
+
+def test_write_daily_obspacks_rewrites_changed(tmp_path, fake_sorted_obspack):
+    dates = pd.date_range("2012-02-27", "2012-03-02")
+    written, _ = format_obspack_geoschem.write_daily_obspacks(fake_sorted_obspack, dates, tmp_path)
+
+    # change one obs, only the file for its day is remade
+    changed = fake_sorted_obspack.copy(deep=True)
+    changed["value"][0] = changed["value"][0] + 1
+    assert format_obspack_geoschem.write_daily_obspacks(changed, dates, tmp_path) == (1, written - 1)
+    date = pd.to_datetime(changed["time"].values[0] + 5 * 60, unit="s").floor("D")
+    with xr.open_dataset(format_obspack_geoschem.daily_obspack_filename(tmp_path, date)) as load:
+        assert load["value"].values[0] == changed["value"].values[0]
+
+    # files made before fingerprints were saved are remade once
+    filename = format_obspack_geoschem.daily_obspack_filename(tmp_path, date)
+    with xr.open_dataset(filename) as load:
+        unfingerprinted = load.load()
+    del unfingerprinted.attrs[format_obspack_geoschem.FINGERPRINT_ATTR]
+    unfingerprinted.to_netcdf(filename)
+    assert format_obspack_geoschem.write_daily_obspacks(changed, dates, tmp_path) == (1, written - 1)
+
+@pytest.fixture
+def fake_constant_met_obspack():
+    rng = np.random.default_rng(2)
+    periods = [("2015-12-30", "2016-01-03"), ("2016-02-26", "2016-03-03"), ("2017-02-26", "2017-03-02")]
+    times = pd.DatetimeIndex([])
+    for start, end in periods:
+        minutes = rng.integers(0, (pd.to_datetime(end) - pd.to_datetime(start)) // pd.Timedelta(1, "min"), 60)
+        times = times.append(pd.to_datetime(start) + pd.to_timedelta(minutes, unit="min"))
+    # obs right at the edge of the day, and a day with no obs
+    times = times.append(pd.DatetimeIndex(["2016-02-29 23:56", "2017-02-28 23:55", "2017-03-01 01:00"])).sort_values()
+    times = times[(times < pd.to_datetime("2016-03-01 23:55")) | (times > pd.to_datetime("2016-03-02 23:55"))]
+    time_components = np.stack([times.year, times.month, times.day, times.hour, times.minute, times.second],
+                               axis=1).astype(float)
+    seconds = ((times - pd.Timestamp("1970-01-01")) // pd.Timedelta(1, "s")).to_numpy().astype(float)
+    obspack_ids = np.array([f"id~{i}".encode() for i in range(len(times))], dtype=object)
+    obspack_data = xr.Dataset({"time": (("obs"), seconds),
+                               "time_components": (("obs", "calendar_components"), time_components),
+                               "obspack_id": (("obs"), format_obspack_geoschem.pad_obspack_id(obspack_ids)),
+                               "value": (("obs"), rng.normal(325, 1, len(times)))},
+                              coords={"obs": np.arange(len(times))})
+    return obspack_data
+
+def old_constant_met_loop(obspack_data, dates, constant_met_year, out_dir):
+    # the constant met part of the script before it was vectorised
+    starts, stops = format_obspack_geoschem.geoschem_day_bounds(obspack_data["time"].values, dates)
+    for date, start, stop in zip(dates, starts, stops):
+        obspack_date = obspack_data.isel(obs=slice(start, stop))
+        if len(obspack_date["obs"]) > 0:
+            no_years_constant = date.year - constant_met_year
+            obspack_date_copy = obspack_date.copy(deep=True)
+            for i in range(len(obspack_date_copy["time_components"])):
+                obspack_date_copy["time_components"][i][0] = np.float64(constant_met_year)
+                if obspack_date_copy["time_components"][i][1] == 2 and obspack_date_copy["time_components"][i][2] == 29:
+                    leap_year = True
+                    obspack_date_copy["time_components"][i][2] = 28
+                else:
+                    leap_year = False
+            time_minus_year = pd.to_datetime(obspack_date_copy["time"].values, unit="s")  - pd.offsets.DateOffset(years=no_years_constant)
+            obspack_date_copy["time"].values = (time_minus_year - pd.to_datetime("1970-01-01")).total_seconds()
+            if obspack_date["time_components"][i][1] == 2 and obspack_date["time_components"][i][2] == 28:
+                obspack_date_0228 = obspack_date_copy.copy(deep=True)
+            if leap_year:
+                obspack_date_copy = obspack_date_copy.merge(obspack_date_0228)
+            constant_met_path = out_dir / f"su_{no_years_constant:02d}"
+            constant_met_path.mkdir(parents=True, exist_ok=True)
+            if leap_year:
+                obspack_date_copy.to_netcdf(constant_met_path / f"obspack_n2o.{constant_met_year}{date.strftime('%m')}28.nc")
+            else:
+                obspack_date_copy.to_netcdf(constant_met_path / f"obspack_n2o.{constant_met_year}{date.strftime('%m%d')}.nc")
+
+def test_write_constant_met_obspacks_matches_loop(tmp_path, fake_constant_met_obspack):
+    dates = pd.date_range("2015-12-31", "2017-03-03")
+    old_constant_met_loop(fake_constant_met_obspack, dates, 2015, tmp_path / "old")
+
+    written, skipped = format_obspack_geoschem.write_constant_met_obspacks(fake_constant_met_obspack, dates, 2015,
+                                                                            tmp_path / "new")
+
+    expected_files = sorted(path.relative_to(tmp_path / "old") for path in (tmp_path / "old").rglob("*.nc"))
+    func_out_files = sorted(path.relative_to(tmp_path / "new") for path in (tmp_path / "new").rglob("*.nc"))
+    assert func_out_files == expected_files
+    assert written == len(expected_files)
+    assert skipped == 0
+    for filename in expected_files:
+        assert_same_obspack_file(tmp_path / "new" / filename, tmp_path / "old" / filename)
+
+    # a rerun with the same obs doesn't rewrite anything
+    assert format_obspack_geoschem.write_constant_met_obspacks(fake_constant_met_obspack, dates, 2015,
+                                                               tmp_path / "new") == (0, written)
+
+def test_constant_met_obspacks_leap_day(fake_constant_met_obspack):
+    dates = pd.date_range("2016-02-28", "2016-03-01")
+
+    files = {filename: obs for _, filename, obs in
+             format_obspack_geoschem.constant_met_obspacks(fake_constant_met_obspack, dates, 2015)}
+
+    # 29th Feb is merged into the 28th
+    assert "obspack_n2o.20150229.nc" not in files
+    feb28 = files["obspack_n2o.20150228.nc"]
+    assert (feb28["time_components"][:, 0] == 2015).all()
+    assert not ((feb28["time_components"][:, 1] == 2) & (feb28["time_components"][:, 2] == 29)).any()
+    assert (pd.to_datetime(feb28["time"].values, unit="s").year == 2015).all()
+
+@pytest.fixture
+def fake_noaa_release(tmp_path):
+    release = tmp_path / "obspack_multi-species_1_CCGGSurfaceFlask_v2.0_2021-02-09"
+    (release / "data/nc").mkdir(parents=True)
+    for i, site in enumerate(["aaa", "bbb"]):
+        n_obs = 3
+        obspack_num = np.arange(n_obs) + 10 * i
+        site_obs = xr.Dataset({"latitude": (("obs"), np.repeat(10. * i, n_obs)),
+                               "longitude": (("obs"), np.repeat(20. * i, n_obs)),
+                               "altitude": (("obs"), np.repeat(5., n_obs)),
+                               "time": (("obs"), 1262304000 + 3600 * obspack_num, {"units": "seconds since 1970-01-01T00:00:00Z"}),
+                               "time_components": (("obs", "calendar_components"), np.tile([2010, 1, 1, 0, 0, 0], (n_obs, 1))),
+                               "obspack_id": (("obs"), np.array([f"obspack~n2o_{site}~{j}".encode() for j in obspack_num])),
+                               "obspack_num": (("obs"), obspack_num),
+                               "value": (("obs"), np.repeat(3.2e-7, n_obs), {"units": "mol mol-1"}),
+                               "qcflag": (("obs"), np.repeat(b"...", n_obs))},
+                              attrs={"dataset_name": f"n2o_{site}"})
+        site_obs.to_netcdf(release / f"data/nc/n2o_{site}_surface-flask_1_ccgg_event.nc")
+    return release
+
+def test_read_noaa_obspack_cached_matches(tmp_path, fake_noaa_release):
+    expected = format_obspack_geoschem.read_noaa_obspack(fake_noaa_release)
+
+    # first read makes the cache, second read uses it
+    format_obspack_geoschem.read_noaa_obspack_cached(fake_noaa_release, tmp_path / "cache")
+    func_out = format_obspack_geoschem.read_noaa_obspack_cached(fake_noaa_release, tmp_path / "cache")
+
+    xr.testing.assert_identical(func_out, expected)
+    assert not func_out["value"].values.flags.writeable
+    assert func_out["time"].encoding["dtype"] == expected["time"].encoding["dtype"]
+
+def test_read_noaa_obspack_cached_projection(tmp_path, fake_noaa_release):
+    func_out = format_obspack_geoschem.read_noaa_obspack_cached(fake_noaa_release, tmp_path / "cache",
+                                                                 variables=["time"])
+
+    assert list(func_out.data_vars) == ["time"]
+    assert func_out["obs"].max() == 12
+
+def test_read_noaa_obspack_cached_remade(tmp_path, fake_noaa_release):
+    format_obspack_geoschem.read_noaa_obspack_cached(fake_noaa_release, tmp_path / "cache")
+
+    # replace a site file with one more obs
+    site_file = fake_noaa_release / "data/nc/n2o_bbb_surface-flask_1_ccgg_event.nc"
+    with xr.open_dataset(site_file, decode_times=False) as load:
+        site_obs = load.load()
+    site_obs = xr.concat([site_obs, site_obs.isel(obs=[-1]).assign(obspack_num=(("obs"), [13]))], dim="obs")
+    site_obs.to_netcdf(site_file)
+
+    func_out = format_obspack_geoschem.read_noaa_obspack_cached(fake_noaa_release, tmp_path / "cache")
+
+    assert func_out["obs"].max() == 13
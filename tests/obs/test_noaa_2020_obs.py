@@ -0,0 +1,130 @@
+"""
+Tests noaa_2020_obs.py
+
+@author: Angharad Stell
+"""
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from n2o_inv.obs import noaa_2020_obs, obs_registry
+
+def write_fake_event_file(event_file, site, times):
+    header = ["# number_of_header_lines: 4",
+              "# description: fake NOAA event file",
+              "# contact: nobody",
+              "# data_fields: site year month day hour minute second ..."]
+    lines = []
+    for i, time in enumerate(times):
+        fields = [site.upper(), f"{time.year:4d}", f"{time.month:02d}", f"{time.day:02d}",
+                  f"{time.hour:02d}", f"{time.minute:02d}", f"{time.second:02d}",
+                  f"{1000 + i}", "P", "0", "0", f"{320 + i:.3f}", "0.200", "..." if i % 3 else ".X.",
+                  "0", "0", "0", "0", "0", "0", "0", f"{10 + i:.4f}", f"{-20 - i:.4f}", f"{100 + i:.2f}", "1.0", "2.0"]
+        lines.append(" ".join(fields))
+    event_file.write_text("\n".join(header + lines) + "\n")
+
+@pytest.fixture
+def fake_event_files(tmp_path):
+    files = []
+    for j, site in enumerate(["abc", "def", "ghi"]):
+        event_file = tmp_path / f"n2o_{site}_surface-flask_1_ccgg_event.txt"
+        # the last site has nothing after the final time
+        start = "2019-12-20" if j < 2 else "2018-01-01"
+        write_fake_event_file(event_file, site, pd.date_range(start, periods=6 + j, freq="3D7H"))
+        files.append(event_file)
+    return files
+
+def old_read_event_file(file, final_date):
+    """ How noaa_2020_obs.py used to read a site file.
+    """
+    with open(file) as f:
+        firstline = f.readline().rstrip()
+    no_head_lines = int(re.search("# number_of_header_lines: (.*)", firstline).group(1))
+    site_file = pd.read_csv(file,
+                            sep=' ', skipinitialspace=True,
+                            usecols=[1,2,3,4,5,6,11,12,13,21,22,23],
+                            names=["year", "month", "day", "hour", "minute", "second",
+                                   "value", "value_unc", "qcflag", "latitude", "longitude", "altitude"],
+                            header=(no_head_lines+1))
+    time_var = pd.to_datetime(site_file[["year", "month", "day", "hour", "minute", "second"]]).to_numpy()
+    site_file["time"] = time_var.astype('datetime64[s]').astype("int")
+    return site_file.loc[site_file["time"] > final_date]
+
+final_date = int(pd.Timestamp("2020-01-01").timestamp())
+
+
+def test_read_noaa_event_file_matches_old(fake_event_files):
+    for event_file in fake_event_files:
+        expected = old_read_event_file(event_file, final_date).reset_index(drop=True)
+
+        func_out = noaa_2020_obs.read_noaa_event_file(event_file, final_date)
+
+        assert (func_out["site"] == noaa_2020_obs.event_file_site(event_file)).all()
+        pd.testing.assert_frame_equal(func_out.drop(columns="site"), expected)
+
+def test_read_noaa_event_files_parallel(fake_event_files):
+    serial = noaa_2020_obs.read_noaa_event_files(fake_event_files, final_date)
+    parallel = noaa_2020_obs.read_noaa_event_files(fake_event_files, final_date, n_workers=2)
+
+    pd.testing.assert_frame_equal(serial, parallel)
+    # the site with no new data is skipped, the others are in file order
+    assert list(pd.unique(serial["site"])) == ["abc", "def"]
+
+def test_read_noaa_event_files_none_after(fake_event_files):
+    func_out = noaa_2020_obs.read_noaa_event_files(fake_event_files, final_date + 10**9)
+
+    assert len(func_out) == 0
+
+def test_noaa_event_obspack_matches_old(tmp_path, fake_event_files):
+    event_table = noaa_2020_obs.read_noaa_event_files(fake_event_files, final_date)
+    obs_numbers = np.arange(100, 100 + len(event_table))
+
+    # the old per site conversion
+    site_xr_list = []
+    for site, site_file_2020 in event_table.groupby("site", sort=False):
+        site_numbers = obs_numbers[site_file_2020.index]
+        site_file_2020 = site_file_2020.drop(columns="site").reset_index(drop=True)
+        site_xr = site_file_2020.to_xarray()
+        # what agage_obs.dt2cal gives for the times
+        site_xr["time_components"] = (("index", "calendar_components"),
+                                      site_file_2020[["year", "month", "day", "hour", "minute", "second"]].to_numpy(float))
+        site_xr["obspack_id"] = (("index"), [noaa_2020_obs.create_obspack_id(site, site_file_2020["year"][i],
+                                                                             site_file_2020["month"][i],
+                                                                             site_file_2020["day"][i], site_numbers[i])
+                                             for i in range(len(site_file_2020))])
+        site_xr["qcflag"] = (("index"), [i.encode() for i in site_xr["qcflag"].values])
+        site_xr = site_xr.drop(["year", "month", "day", "hour", "minute", "second"])
+        site_xr = site_xr.assign_coords({"obs": (("index"), site_numbers)})
+        site_xr = site_xr.swap_dims({"index":"obs"}).reset_coords().drop("index")
+        site_xr_list.append(site_xr)
+    expected = xr.merge(site_xr_list)
+
+    func_out = noaa_2020_obs.noaa_event_obspack(event_table, obs_numbers)
+
+    xr.testing.assert_equal(func_out, expected)
+    # and the saved files are the same
+    func_out.to_netcdf(tmp_path / "func_out.nc")
+    expected.to_netcdf(tmp_path / "expected.nc")
+    with xr.open_dataset(tmp_path / "func_out.nc") as func_load, xr.open_dataset(tmp_path / "expected.nc") as expected_load:
+        xr.testing.assert_identical(func_load.load(), expected_load.load())
+
+def test_allocate_event_obs_numbers_grown(tmp_path, fake_event_files):
+    registry_file = obs_registry.obs_registry_file(tmp_path)
+    first_table = noaa_2020_obs.read_noaa_event_files(fake_event_files, final_date)
+    first = noaa_2020_obs.allocate_event_obs_numbers(registry_file, first_table)
+
+    # the first site's event file gets more obs
+    write_fake_event_file(fake_event_files[0], "abc", pd.date_range("2019-12-20", periods=9, freq="3D7H"))
+    grown_table = noaa_2020_obs.read_noaa_event_files(fake_event_files, final_date)
+    grown = noaa_2020_obs.allocate_event_obs_numbers(registry_file, grown_table)
+
+    # the obs that were already there keep their numbers, the new ones come after all of them
+    first_ids = dict(zip(zip(first_table["site"], first_table["time"]), first))
+    grown_ids = dict(zip(zip(grown_table["site"], grown_table["time"]), grown))
+    assert all(grown_ids[obs] == number for obs, number in first_ids.items())
+    assert sorted(set(grown_ids.values()) - set(first_ids.values())) == list(range(len(first), len(grown)))
+    # and running again doesn't change anything
+    assert (noaa_2020_obs.allocate_event_obs_numbers(registry_file, grown_table) == grown).all()
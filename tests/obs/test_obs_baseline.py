@@ -80,6 +80,55 @@ def test_raw_obs_to_baseline_AGAGEsurf():
 
     assert (output["baseline"] == [1, 0]).all()
 
+def old_raw_obs_to_baseline(obspack_obs, baseline_dict):
+    """ How raw_obs_to_baseline used to loop through the sites.
+    """
+    obspack_obs["baseline"] = xr.zeros_like(obspack_obs["value"])
+    for site in np.unique(obspack_obs["site"]):
+        if site in obs_baseline.DODGY_SITES or "NOAAair" in site:
+            continue
+        site_mask = obspack_obs["site"] == site
+        if "AGAGEsurf" in site:
+            # linearly interpolate the flag as 0 and 1, newer xarray takes the nearest flag for booleans
+            df = baseline_dict[site[0:3].upper()].astype(float)
+            obspack_obs["baseline"][site_mask] = (df.interp(time=obspack_obs["time"][site_mask].values)["baseline_NAME"] == True).astype(int).values
+        else:
+            obspack_obs["baseline"][site_mask] = 1
+    return obspack_obs
+
+def test_raw_obs_to_baseline_matches_old():
+    rng = np.random.default_rng(1)
+    n_obs = 500
+    sites = rng.choice(["tstAGAGEsurf", "abcAGAGEsurf", "tstNOAAsurf", "grfNOAAsurf", "tstNOAAair"], n_obs)
+    # times on and between the baseline times, and some outside them
+    times = pd.to_datetime("2010-01-01") + pd.to_timedelta(rng.integers(-2, 30 * 4, n_obs) * 6, unit="h")
+    times = times + pd.to_timedelta(rng.choice([0, 0, 90], n_obs), unit="min")
+    obspack_obs = xr.Dataset({"value": (("obs"), rng.normal(330, 1, n_obs)),
+                              "site": (("obs"), sites),
+                              "time": (("obs"), times)},
+                             coords={"obs": np.arange(n_obs)})
+    baseline_dict = {site: xr.Dataset({"baseline_NAME": (("time"), rng.random(n_time) > 0.3)},
+                                      coords={"time": pd.date_range(start, periods=n_time, freq="12H")})
+                     for site, start, n_time in [("TST", "2010-01-01", 50), ("ABC", "2010-01-05", 40)]}
+
+    expected = old_raw_obs_to_baseline(obspack_obs.copy(deep=True), baseline_dict)
+    output = obs_baseline.raw_obs_to_baseline(obspack_obs.copy(deep=True), baseline_dict)
+
+    assert expected["baseline"].sum() > 0
+    xr.testing.assert_identical(output, expected)
+
+def test_raw_obs_to_baseline_plots(tmp_path):
+    obspack_obs = xr.Dataset({"value": (("obs"), np.array([330, 340])),
+                              "site": (("obs"), np.array(["tstAGAGEsurf", "tstNOAAsurf"])),
+                              "time": (("obs"), pd.date_range("2010-01-01", "2010-01-02", freq="D"))},
+                              coords={"obs": np.array([1, 2])})
+    baseline_dict = {"TST": xr.Dataset({"baseline_NAME":(("time"), np.array([True, False]))},
+                                       coords={"time": pd.date_range("2010-01-01", "2010-01-02", freq="D")})}
+
+    obs_baseline.raw_obs_to_baseline(obspack_obs, baseline_dict, tmp_path)
+
+    assert [plot.name for plot in tmp_path.iterdir()] == ["tstAGAGEsurf_baseline.png"]
+
 # going to require config set up right...
 def test_make_agage_baseline_dict():
     config = configparser.ConfigParser()
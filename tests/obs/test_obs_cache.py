@@ -0,0 +1,72 @@
+"""
+Tests obs_cache.py
+
+@author: Angharad Stell
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from n2o_inv.obs import obs_cache
+
+@pytest.fixture
+def fake_obs_file(tmp_path):
+    n_obs = 6
+    fake_obs = xr.Dataset({"obspack_id": (("obs"), np.array([f"id~n2o_site_{i}" for i in range(n_obs)], dtype="S200")),
+                           "time": (("obs"), pd.date_range("2010-01-01", periods=n_obs, freq="D")),
+                           "value": (("obs"), np.linspace(320, 330, n_obs), {"units": "ppb"}),
+                           "qcflag": (("obs"), np.array([b"...", b"..X", b"...", b"...", b"...", b"..."])),
+                           "site": (("obs"), np.array(["mhdAGAGEsurf", "mhdNOAAsurf", "mhdAGAGEsurf",
+                                                       "smoNOAAsurf", "hipNOAAair", "smoNOAAsurf"])),
+                           "network": (("obs"), np.array(["AGAGEsurf", "NOAAsurf", "AGAGEsurf",
+                                                          "NOAAsurf", "NOAAair", "NOAAsurf"]))},
+                          coords={"obs": np.arange(10, 10 + n_obs)})
+    obs_file = tmp_path / "baseline_obs.nc"
+    fake_obs.to_netcdf(obs_file)
+    return obs_file
+
+
+def test_load_obs_cache_round_trip(fake_obs_file):
+    obs_cache.convert_obs_file(fake_obs_file)
+    func_out = obs_cache.load_obs_cache(obs_cache.obs_cache_dir(fake_obs_file))
+
+    with xr.open_dataset(fake_obs_file) as load:
+        expected = load.load()
+    xr.testing.assert_equal(func_out, expected)
+    assert func_out["value"].attrs["units"] == "ppb"
+    assert func_out["obspack_id"].dtype == np.dtype("S200")
+
+def test_load_obs_cache_read_only(fake_obs_file):
+    obs_cache.convert_obs_file(fake_obs_file)
+    func_out = obs_cache.load_obs_cache(obs_cache.obs_cache_dir(fake_obs_file))
+
+    assert not func_out["value"].values.flags.writeable
+    assert not func_out["obspack_id"].values.flags.writeable
+
+def test_load_obs_cache_codes(fake_obs_file):
+    obs_cache.convert_obs_file(fake_obs_file)
+    func_out = obs_cache.load_obs_cache(obs_cache.obs_cache_dir(fake_obs_file), decode_codes=False)
+
+    assert func_out["site"].dtype == np.int32
+    table = np.array(func_out["site"].attrs["table"])
+    assert (table[func_out["site"].values] == ["mhdAGAGEsurf", "mhdNOAAsurf", "mhdAGAGEsurf",
+                                                "smoNOAAsurf", "hipNOAAair", "smoNOAAsurf"]).all()
+
+def test_open_obs_uses_cache(fake_obs_file):
+    obs_cache.convert_obs_file(fake_obs_file)
+    func_out = obs_cache.open_obs(fake_obs_file)
+
+    assert not func_out["value"].values.flags.writeable
+
+def test_open_obs_out_of_date_cache(fake_obs_file):
+    obs_cache.convert_obs_file(fake_obs_file)
+    # pretend the netcdf has been remade since the cache was
+    stat = fake_obs_file.stat()
+    os.utime(fake_obs_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    func_out = obs_cache.open_obs(fake_obs_file)
+
+    assert func_out["value"].values.flags.writeable
@@ -0,0 +1,143 @@
+"""
+Tests obs_registry.py
+
+@author: Angharad Stell
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from n2o_inv.obs import format_obspack_geoschem, obs_registry
+
+@pytest.fixture
+def registry_file(tmp_path):
+    return obs_registry.obs_registry_file(tmp_path)
+
+@pytest.fixture
+def fake_noaa_release(tmp_path):
+    release = tmp_path / format_obspack_geoschem.NOAA_SURFACE_RELEASE
+    (release / "data/nc").mkdir(parents=True)
+    n_obs = 3
+    obspack_num = np.arange(n_obs) + 10
+    site_obs = xr.Dataset({"latitude": (("obs"), np.repeat(10., n_obs)),
+                           "longitude": (("obs"), np.repeat(20., n_obs)),
+                           "altitude": (("obs"), np.repeat(5., n_obs)),
+                           "time": (("obs"), 1262304000 + 3600 * obspack_num, {"units": "seconds since 1970-01-01T00:00:00Z"}),
+                           "time_components": (("obs", "calendar_components"), np.tile([2010, 1, 1, 0, 0, 0], (n_obs, 1))),
+                           "obspack_id": (("obs"), np.array([f"obspack~n2o_aaa~{j}".encode() for j in obspack_num])),
+                           "obspack_num": (("obs"), obspack_num),
+                           "value": (("obs"), np.repeat(3.2e-7, n_obs)),
+                           "qcflag": (("obs"), np.repeat(b"...", n_obs))})
+    site_obs.to_netcdf(release / "data/nc/n2o_aaa_surface-flask_1_ccgg_event.nc")
+    return release
+
+def allocate_site(args):
+    registry_file, site = args
+    return obs_registry.allocate(registry_file, site, "2010_2020", 100)
+
+
+def test_allocate_contiguous(registry_file):
+    first = obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2020", 10)
+    second = obs_registry.allocate(registry_file, "AGAGE_CGO", "2010_2020", 5)
+
+    assert (obs_registry.obs_numbers(first) == np.arange(0, 10)).all()
+    assert (obs_registry.obs_numbers(second) == np.arange(10, 15)).all()
+
+def test_allocate_idempotent(registry_file):
+    first = obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2020", 10)
+    obs_registry.allocate(registry_file, "AGAGE_CGO", "2010_2020", 5)
+
+    assert obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2020", 10) == first
+    assert obs_registry.lookup(registry_file, "AGAGE_MHD", "2010_2020") == first
+
+def test_allocate_new_release(registry_file):
+    obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2020", 10)
+
+    func_out = obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2021", 12)
+
+    assert (func_out["start"], func_out["stop"]) == (10, 22)
+
+def test_allocate_different_size(registry_file):
+    obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2020", 10)
+
+    with pytest.raises(ValueError):
+        obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2020", 11)
+
+def test_allocate_growing(registry_file):
+    first = obs_registry.allocate_growing(registry_file, "AGAGE_MHD", "2020", np.arange(5))
+    obs_registry.allocate(registry_file, "AGAGE_CGO", "2010_2020", 10)
+
+    func_out = obs_registry.allocate_growing(registry_file, "AGAGE_MHD", "2020", np.arange(8))
+
+    assert (first == np.arange(5)).all()
+    # the new obs go after everything else
+    assert func_out.tolist() == [0, 1, 2, 3, 4, 15, 16, 17]
+    assert (obs_registry.allocate_growing(registry_file, "AGAGE_MHD", "2020", np.arange(8)) == func_out).all()
+
+def test_allocate_growing_changed(registry_file):
+    obs_registry.allocate_growing(registry_file, "NOAA_2020_mhd", "surface", [0, 2, 2, 4, 6])
+
+    # a late flask in between, another of a pair, and one that has gone
+    func_out = obs_registry.allocate_growing(registry_file, "NOAA_2020_mhd", "surface", [0, 2, 2, 2, 3, 6])
+
+    assert func_out.tolist() == [0, 1, 2, 5, 6, 4]
+    # the number of the obs that has gone isn't used again
+    assert obs_registry.allocate_growing(registry_file, "NOAA_2020_mhd", "surface", [0, 4, 7]).tolist() == [0, 3, 7]
+
+def test_allocate_growing_unsorted(registry_file):
+    with pytest.raises(ValueError):
+        obs_registry.allocate_growing(registry_file, "AGAGE_MHD", "2020", [0, 2, 1])
+
+def test_allocate_growing_failed_change_not_written(registry_file):
+    obs_registry.allocate(registry_file, "AGAGE_MHD", "2020", 3)
+
+    with pytest.raises(ValueError):
+        obs_registry.allocate_growing(registry_file, "AGAGE_MHD", "2020", np.arange(4))
+
+    assert list(obs_registry.read_registry(registry_file)["ranges"]) == ["AGAGE_MHD/2020"]
+
+def test_allocate_after_reserved(registry_file):
+    obs_registry.reserve(registry_file, "noaa_obspack", "surface", 5, 1000, {"final_time": 42})
+    obs_registry.reserve(registry_file, "noaa_obspack", "aircraft", 20, 2000)
+
+    func_out = obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2020", 10)
+
+    assert func_out["start"] == 2000
+    assert obs_registry.lookup(registry_file, "noaa_obspack", "surface")["final_time"] == 42
+
+def test_reserve_overlaps_allocated(registry_file):
+    obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2020", 10)
+
+    with pytest.raises(ValueError):
+        obs_registry.reserve(registry_file, "noaa_obspack", "surface", 5, 1000)
+
+def test_failed_change_not_written(registry_file):
+    obs_registry.allocate(registry_file, "AGAGE_MHD", "2010_2020", 10)
+    before = obs_registry.read_registry(registry_file)
+
+    with pytest.raises(RuntimeError):
+        with obs_registry.locked_registry(registry_file) as registry:
+            registry["ranges"].clear()
+            raise RuntimeError
+
+    assert obs_registry.read_registry(registry_file) == before
+
+def test_allocate_concurrent(registry_file):
+    sites = [f"site{i}" for i in range(8)]
+    with ProcessPoolExecutor(4) as executor:
+        entries = list(executor.map(allocate_site, [(registry_file, site) for site in sites]))
+
+    starts = sorted(entry["start"] for entry in entries)
+    assert starts == list(range(0, 800, 100))
+    assert len(obs_registry.read_registry(registry_file)["ranges"]) == 8
+
+def test_reserve_noaa_obspack(tmp_path, registry_file, fake_noaa_release):
+    func_out = obs_registry.reserve_noaa_obspack(registry_file, fake_noaa_release, tmp_path / "cache")
+
+    assert (func_out["start"], func_out["stop"]) == (10, 13)
+    assert func_out["final_time"] == 1262304000 + 3600 * 12
+    # the release isn't read again once it is registered
+    (fake_noaa_release / "data/nc/n2o_aaa_surface-flask_1_ccgg_event.nc").unlink()
+    assert obs_registry.reserve_noaa_obspack(registry_file, fake_noaa_release, tmp_path / "cache") == func_out
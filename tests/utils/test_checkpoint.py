@@ -0,0 +1,93 @@
+"""
+Tests checkpoint.py
+
+@author: Angharad Stell
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from n2o_inv.utils import checkpoint
+
+@pytest.fixture
+def fake_obs():
+    return xr.Dataset({"value": (("obs"), np.arange(5.)),
+                       "site": (("obs"), np.array(["mhd", "cgo", "mhd", "smo", "thd"], dtype=object)),
+                       "time": (("obs"), pd.date_range("2010-01-01", periods=5, freq="h").values)},
+                      coords={"obs": np.arange(5)})
+
+def run_stages(checkpoint_dir, fake_obs, scale, offset, calls):
+    """ Two chained stages, counting how many times each is worked out.
+    """
+    def scaled():
+        calls.append("scale")
+        return fake_obs.assign(value=fake_obs["value"] * scale)
+
+    def offsetted():
+        calls.append("offset")
+        return scaled_obs.assign(value=scaled_obs["value"] + offset)
+
+    scale_key = checkpoint.stage_key("scale", {"scale": scale})
+    scaled_obs = checkpoint.cached_stage(checkpoint_dir, "scale", scale_key, scaled)
+    offset_key = checkpoint.stage_key("offset", {"offset": offset}, [scale_key])
+    return checkpoint.cached_stage(checkpoint_dir, "offset", offset_key, offsetted)
+
+
+def test_stage_key():
+    key = checkpoint.stage_key("baseline", {"perturb_start": pd.Timestamp("2010-01-01"), "sites": ["MHD"]}, ["abc"])
+
+    assert key == checkpoint.stage_key("baseline", {"sites": ["MHD"], "perturb_start": pd.Timestamp("2010-01-01")}, ["abc"])
+    assert key != checkpoint.stage_key("baseline", {"perturb_start": pd.Timestamp("2010-01-02"), "sites": ["MHD"]}, ["abc"])
+    assert key != checkpoint.stage_key("baseline", {"perturb_start": pd.Timestamp("2010-01-01"), "sites": ["MHD"]}, ["abd"])
+    assert key != checkpoint.stage_key("merge", {"perturb_start": pd.Timestamp("2010-01-01"), "sites": ["MHD"]}, ["abc"])
+
+def test_files_fingerprint(tmp_path):
+    for name in ["b.nc", "a.nc"]:
+        (tmp_path / name).write_text("some data")
+    before = checkpoint.files_fingerprint(tmp_path.glob("*.nc"))
+
+    (tmp_path / "b.nc").write_text("some more data")
+
+    assert [entry["name"] for entry in before] == [str(tmp_path / "a.nc"), str(tmp_path / "b.nc")]
+    assert checkpoint.files_fingerprint(tmp_path.glob("*.nc")) != before
+
+def test_cached_stage(tmp_path, fake_obs):
+    calls = []
+    first = run_stages(tmp_path / "checkpoints", fake_obs, 2., 1., calls)
+    second = run_stages(tmp_path / "checkpoints", fake_obs, 2., 1., calls)
+
+    assert calls == ["scale", "offset"]
+    assert (first["value"].values == fake_obs["value"].values * 2 + 1).all()
+    xr.testing.assert_identical(first, second)
+    # the output is the same as if the stage wasn't cached
+    xr.testing.assert_identical(first, fake_obs.assign(value=fake_obs["value"] * 2 + 1))
+
+def test_cached_stage_late_change(tmp_path, fake_obs):
+    calls = []
+    run_stages(tmp_path, fake_obs, 2., 1., calls)
+
+    func_out = run_stages(tmp_path, fake_obs, 2., 3., calls)
+
+    # only the late stage is redone
+    assert calls == ["scale", "offset", "offset"]
+    assert (func_out["value"].values == fake_obs["value"].values * 2 + 3).all()
+
+def test_cached_stage_early_change(tmp_path, fake_obs):
+    calls = []
+    run_stages(tmp_path, fake_obs, 2., 1., calls)
+
+    func_out = run_stages(tmp_path, fake_obs, 3., 1., calls)
+
+    # the later stage is redone too, as it uses the early one
+    assert calls == ["scale", "offset", "scale", "offset"]
+    assert (func_out["value"].values == fake_obs["value"].values * 3 + 1).all()
+
+def test_cached_stage_failed(tmp_path):
+    def broken():
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        checkpoint.cached_stage(tmp_path, "broken", "abc", broken)
+
+    assert list(tmp_path.iterdir()) == []
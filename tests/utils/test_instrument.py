@@ -0,0 +1,55 @@
+"""
+Tests instrument.py
+
+@author: Angharad Stell
+"""
+import json
+
+import pytest
+
+from n2o_inv.utils import instrument
+
+
+def test_stage_off_by_default(tmp_path, monkeypatch):
+    monkeypatch.delenv(instrument.ENV_VAR, raising=False)
+    monkeypatch.chdir(tmp_path)
+
+    with instrument.stage("nothing") as record:
+        record["n_files"] = 1
+
+    assert list(tmp_path.iterdir()) == []
+
+def test_stage_writes_record(tmp_path, monkeypatch):
+    record_file = tmp_path / "stages.jsonl"
+    monkeypatch.setenv(instrument.ENV_VAR, str(record_file))
+
+    with instrument.stage("read", output_dir="run_00") as record:
+        for i in range(3):
+            (tmp_path / f"file_{i}.txt").write_text("some data")
+            with open(tmp_path / f"file_{i}.txt") as f:
+                f.read()
+        record["n_files"] = 3
+    with instrument.stage("write"):
+        pass
+
+    records = [json.loads(line) for line in record_file.read_text().splitlines()]
+    assert [record["stage"] for record in records] == ["read", "write"]
+    assert records[0]["output_dir"] == "run_00"
+    assert records[0]["n_files"] == 3
+    assert records[0]["files_opened"] == 6
+    assert records[1]["files_opened"] == 0
+    assert records[0]["wall_s"] >= 0
+    assert records[0]["peak_rss_kb"] > 0
+    assert records[0]["run_id"] == records[1]["run_id"]
+
+def test_stage_records_error(tmp_path, monkeypatch):
+    record_file = tmp_path / "stages.jsonl"
+    monkeypatch.setenv(instrument.ENV_VAR, str(record_file))
+
+    with pytest.raises(ValueError):
+        with instrument.stage("broken"):
+            raise ValueError("oops")
+
+    record = json.loads(record_file.read_text())
+    assert record["stage"] == "broken"
+    assert record["error"] == "ValueError"
@@ -8,6 +8,7 @@ import pandas as pd
 import pytest
 import xarray as xr
 
+from n2o_inv.intermediates import tracers
 from n2o_inv.validation import make_ems
 
 @pytest.fixture
@@ -72,3 +73,72 @@ def test_rescale_ems_one(fake_ems):
     out = make_ems.rescale_ems(fake_ems, alphas, 4)
     assert (out["emi_n2o"] == 2).all()
 
+
+@pytest.fixture
+def fake_alpha_samples(tmp_path):
+    """ Like the file written by extract_alphas.R, one row of all the alphas per sample.
+    """
+    rng = np.random.default_rng(0)
+    alpha_samples = pd.DataFrame(rng.uniform(-0.5, 0.5, (10, 12 * 4)),
+                                 index=np.arange(1, 11),
+                                 columns=[f"alpha{i}" for i in range(12 * 4)])
+    samples_file = tmp_path / "alpha-samples-mcmc-test.csv"
+    alpha_samples.to_csv(samples_file)
+    return samples_file, alpha_samples.to_numpy().reshape(10, 12, 4)
+
+def test_choose_samples():
+    assert make_ems.choose_samples(10).tolist() == list(range(10))
+    assert make_ems.choose_samples(10, 20).tolist() == list(range(10))
+    assert make_ems.choose_samples(10, 4).tolist() == [0, 3, 6, 9]
+    assert len(np.unique(make_ems.choose_samples(11000, 10999))) == 10999
+
+def test_read_alpha_samples(fake_alpha_samples):
+    samples_file, alphas = fake_alpha_samples
+    assert make_ems.count_samples(samples_file) == 10
+
+    chunks = list(make_ems.read_alpha_samples(samples_file, 12, 4, [1, 2, 5, 8, 9], chunk_size=2, read_rows=3))
+
+    assert [numbers.tolist() for numbers, _ in chunks] == [[1, 2], [5, 8], [9]]
+    np.testing.assert_allclose(np.concatenate([chunk for _, chunk in chunks]), alphas[[1, 2, 5, 8, 9]])
+
+def test_read_alpha_samples_wrong_size(fake_alpha_samples):
+    samples_file, _ = fake_alpha_samples
+
+    with pytest.raises(ValueError):
+        next(make_ems.read_alpha_samples(samples_file, 12, 5, [0]))
+
+def test_ensemble_total_ems(fake_ems, fake_alpha_samples):
+    _, alphas = fake_alpha_samples
+    stacked = tracers.stack_tracers(fake_ems, "emi_R", 4).values
+
+    func_out = make_ems.ensemble_total_ems(stacked, alphas[:3])
+
+    for sample in range(3):
+        expected = make_ems.rescale_ems(fake_ems, alphas[sample], 4)["emi_n2o"]
+        np.testing.assert_allclose(func_out[sample], expected)
+
+def test_write_ensemble_ems(tmp_path, fake_ems, fake_alpha_samples):
+    samples_file, alphas = fake_alpha_samples
+
+    ensemble_files = make_ems.write_ensemble_ems(fake_ems, samples_file, tmp_path / "ensemble", 12, 4,
+                                                 np.arange(10), chunk_size=4)
+
+    assert len(ensemble_files) == 3
+    with xr.open_mfdataset(ensemble_files, combine="nested", concat_dim="sample") as load:
+        func_out = load.load()
+    assert func_out["sample"].values.tolist() == list(range(10))
+    for sample in [0, 4, 9]:
+        expected = make_ems.rescale_ems(fake_ems, alphas[sample], 4)["emi_n2o"]
+        np.testing.assert_allclose(func_out["emi_n2o"].sel(sample=sample), expected)
+
+def test_ensemble_stats_ems(fake_ems, fake_alpha_samples):
+    samples_file, alphas = fake_alpha_samples
+    all_ems = np.stack([make_ems.rescale_ems(fake_ems, alphas[sample], 4)["emi_n2o"].values for sample in range(10)])
+
+    func_out = make_ems.ensemble_stats_ems(fake_ems, samples_file, 12, 4, np.arange(10), chunk_size=3)
+
+    assert func_out.attrs["n_samples"] == 10
+    np.testing.assert_allclose(func_out["emi_n2o_mean"], all_ems.mean(axis=0))
+    np.testing.assert_allclose(func_out["emi_n2o_std"], all_ems.std(axis=0, ddof=1))
+    np.testing.assert_allclose(func_out["emi_n2o_min"], all_ems.min(axis=0))
+    np.testing.assert_allclose(func_out["emi_n2o_max"], all_ems.max(axis=0))